@@ -0,0 +1,35 @@
+"""Checks the author's MD5 engine against hashlib.md5, including messages of several 64 byte blocks.
+
+Run from this directory: python -m unittest test_md5
+"""
+import hashlib
+import os
+import tempfile
+import unittest
+
+import week7_program_code_suggitt as md5
+
+SIZES = [0, 10, 55, 56, 63, 64, 65, 100, 1000, 4096 + 7]
+
+class Md5Test(unittest.TestCase):
+	def test_process_data_matches_hashlib(self):
+		for size in SIZES:
+			message = bytes(i * 7 & 0xff for i in range(size))
+			with self.subTest(size=size):
+				self.assertEqual(md5.process_data(bytearray(message)), hashlib.md5(message).hexdigest())
+
+	def test_hash_chunk_matches_hashlib(self):
+		chunk_size = 1000
+		message = os.urandom(3 * chunk_size + 123)
+		with tempfile.TemporaryDirectory() as tmp:
+			fname = os.path.join(tmp, 'data.bin')
+			with open(fname, 'wb') as fwriter:
+				fwriter.write(message)
+			for index in range(4):
+				chunk = message[index * chunk_size:(index + 1) * chunk_size]
+				with self.subTest(index=index):
+					self.assertEqual(md5.hash_chunk((fname, index, chunk_size, 'author')),
+						(index, hashlib.md5(chunk).hexdigest()))
+
+if __name__ == '__main__':
+	unittest.main()
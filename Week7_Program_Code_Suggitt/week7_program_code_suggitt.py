@@ -3,19 +3,36 @@
 
 Input comes from either a file defined in the terminal argument or queries stdin. Calculates and prints the input's MD5
 hash. Given command flags, prints results of hashlib.md5(), my implementation, or both MD5 implementations. These should
-return the same value.
+return the same value. The -B flag instead benchmarks every implementation and can compare against a saved baseline.
+The -M and -V flags build and verify a Merkle tree of MD5s over fixed-size chunks of a file, hashed in parallel and
+resumable.
 Created by Travis Suggitt for Week 7 assignment of CS450 Data Networks at Regis University.
 Date: 2-28-2021
 """
 import sys
 import argparse
 import hashlib
+import json
+import time
+import cProfile
+import pstats
+import os
+import multiprocessing
 
 BLOCK_BITS = 512
 BLOCK_BYTES = BLOCK_BITS//8
 PREPAD_BITS = 448
 PREPAD_BYTES = PREPAD_BITS//8
 HEX_BYTES = 4
+BENCH_SIZES = [64, 1024, 16384, 65536]
+BENCH_MIN_SECONDS = 0.5
+BENCH_THRESHOLD_PCT = 10.0
+PROFILED_FUNCS = ['modF', 'modG', 'modH', 'modI', 'words_as_array', 'process_block']
+CHUNK_BYTES = 4 * 1024 * 1024
+TREE_EXT = '.md5tree'
+VERIFY_EXT = '.md5verify'
+SAVE_EVERY = 16
+TREE_VERSION = 2 # Trees from version 1 hashed with the author engine's broken block chaining
 
 def get_hashlib_md5(data):
 	"""Gives the MD5 hash as calculated by hashlib.md5
@@ -196,8 +213,8 @@ def process_data(data):
 	"""Perform MD5 on a byte string
 
 	First appends 0's to input so that input length(bits) is 448 mod 512. Then appends 64 bit representation of original
-	input length. Each 64 bit block is sequentially processed in process_block() and added together in 4 words. Finally,
-	the words are appended and returned.
+	input length. Each 64 byte block is sequentially processed in process_block(), starting from the 4 words left by the
+	block before it, and its output is added to those words. Finally, the words are appended and returned.
 	Full MD5 algorithm can be found in RFC 1321 (https://tools.ietf.org/html/rfc1321).
 
 	:param data: Byte string of data to create an MD5 hash of
@@ -217,7 +234,7 @@ def process_data(data):
 
 	init_words = [a, b, c, d]
 	for i in range(0, len(data), BLOCK_BYTES):
-		process_words = process_block(data[i:i + BLOCK_BYTES], a, b, c, d)
+		process_words = process_block(data[i:i + BLOCK_BYTES], *init_words)
 
 		for j, val in enumerate(process_words):
 			init_words[j] += val
@@ -246,6 +263,387 @@ def read_file(fname):
 		print(err)
 		print('Shutting down...')
 
+def get_engines():
+	"""Returns the MD5 engines available for benchmarking
+
+	Each engine takes a bytearray and returns an MD5 hex string. Faster engines should be added here so the benchmark
+	picks them up.
+
+	:return: dictionary of engine name to function
+	"""
+	return {
+		'author': process_data,
+		'hashlib': get_hashlib_md5,
+	}
+
+def benchmark_engine(engine, message, min_seconds=BENCH_MIN_SECONDS):
+	"""Times an MD5 engine on one message until at least min_seconds have passed
+
+	A fresh bytearray is made for every round since process_data() pads its input in place.
+
+	:param engine: function taking a bytearray and returning an MD5 hex string
+	:param message: bytes object to hash
+	:param min_seconds: minimum total time to spend hashing
+	:return: dictionary of rounds, seconds, blocks_per_sec and mb_per_sec
+	"""
+	blocks = len(message)//BLOCK_BYTES + 1
+	if len(message) % BLOCK_BYTES >= PREPAD_BYTES:
+		blocks += 1
+	min_ns = int(min_seconds * 1e9)
+	rounds = 0
+	elapsed = 0
+	while elapsed < min_ns or rounds == 0:
+		data = bytearray(message)
+		start = time.perf_counter_ns()
+		engine(data)
+		elapsed += time.perf_counter_ns() - start
+		rounds += 1
+	seconds = elapsed / 1e9
+	return {
+		'rounds': rounds,
+		'seconds': seconds,
+		'blocks_per_sec': blocks * rounds / seconds,
+		'mb_per_sec': len(message) * rounds / seconds / 1e6,
+	}
+
+def profile_rounds(message):
+	"""Profiles process_data() and breaks the time down by round function
+
+	:param message: bytes object to hash
+	:return: dictionary of function name to calls, total (own) seconds and cumulative seconds
+	"""
+	profiler = cProfile.Profile()
+	profiler.runcall(process_data, bytearray(message))
+	stats = pstats.Stats(profiler).stats
+	breakdown = {}
+	for (fname, line, func), (cc, ncalls, tottime, cumtime, callers) in stats.items():
+		if func in PROFILED_FUNCS and fname == __file__:
+			breakdown[func] = {'calls': ncalls, 'tottime': tottime, 'cumtime': cumtime}
+	return breakdown
+
+def compare_baseline(results, baseline, threshold):
+	"""Finds throughput regressions against a saved baseline
+
+	:param results: benchmark results in the same layout as the baseline
+	:param baseline: previously saved benchmark results
+	:param threshold: allowed throughput drop in percent
+	:return: list of regression description strings, empty if none. Entries without throughput are skipped
+	"""
+	regressions = []
+	for engine, sizes in baseline.items():
+		for size, old in sizes.items():
+			new = results.get(engine, {}).get(size)
+			if new is None:
+				continue
+			# A 0 byte message has no MB/s but still hashes one padding block
+			key, unit = ('mb_per_sec', 'MB/s') if old['mb_per_sec'] else ('blocks_per_sec', 'blocks/s')
+			if not old[key]:
+				continue
+			drop = (1 - new[key] / old[key]) * 100
+			if drop > threshold:
+				regressions.append('{} at {} bytes: {:.2f} {} -> {:.2f} {} ({:.1f}% slower)'.format(
+					engine, size, old[key], unit, new[key], unit, drop))
+	return regressions
+
+def run_benchmark(args):
+	"""Runs the benchmark for every engine and message size
+
+	Every engine's digest is checked against hashlib.md5() before it is timed. Prints a throughput table and optionally
+	a per round function profile. Results can be compared to a JSON baseline, in which case a throughput drop past the
+	threshold is an error, and then saved as a new baseline.
+
+	:param args: parsed command line arguments
+	:return: 0 when every digest matches and no regression is found, otherwise 1
+	"""
+	sizes = args.sizes
+	engines = get_engines()
+	results = {}
+	print('{:<10}{:>10}{:>16}{:>12}'.format('engine', 'bytes', 'blocks/s', 'MB/s'))
+	for name, engine in engines.items():
+		results[name] = {}
+		for size in sizes:
+			message = bytes(i & 0xff for i in range(size))
+			digest = engine(bytearray(message))
+			if digest != get_hashlib_md5(bytearray(message)):
+				print('{} gives {} for {} bytes, hashlib.md5() gives {}'.format(name, digest, size,
+					get_hashlib_md5(bytearray(message))))
+				print('Shutting down...')
+				return 1
+			result = benchmark_engine(engine, message, args.min_time)
+			results[name][str(size)] = result
+			print('{:<10}{:>10}{:>16.1f}{:>12.3f}'.format(name, size, result['blocks_per_sec'], result['mb_per_sec']))
+
+	if args.profile:
+		size = max(sizes)
+		print()
+		print('Round function breakdown of author\'s implementation ({} bytes)'.format(size))
+		print('{:<16}{:>10}{:>12}{:>12}'.format('function', 'calls', 'own s', 'cumul s'))
+		for func, stat in sorted(profile_rounds(bytes(size)).items(), key=lambda item: -item[1]['tottime']):
+			print('{:<16}{:>10}{:>12.4f}{:>12.4f}'.format(func, stat['calls'], stat['tottime'], stat['cumtime']))
+
+	regressions = []
+	if args.baseline:
+		try:
+			with open(args.baseline) as freader:
+				baseline = json.load(freader)
+		except (OSError, ValueError) as err:
+			print(err)
+			print('Shutting down...')
+			return 1
+		regressions = compare_baseline(results, baseline, args.threshold)
+		print()
+		if regressions:
+			print('Throughput regressions past {}%:'.format(args.threshold))
+			for regression in regressions:
+				print(regression)
+		else:
+			print('No throughput regressions past {}%'.format(args.threshold))
+
+	# Saved only after the comparison, so the same file can be passed to --baseline and --save-baseline
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as fwriter:
+			json.dump(results, fwriter, indent=2)
+		print()
+		print('Baseline saved to \'{}\''.format(args.save_baseline))
+	return 1 if regressions else 0
+
+def hash_chunk(job):
+	"""Hashes one chunk of a file, used as the worker function of the chunk pool
+
+	:param job: tuple of file name, chunk index, chunk size and engine name
+	:return: tuple of chunk index and MD5 hex string of the chunk
+	"""
+	fname, index, chunk_size, engine = job
+	with open(fname, 'rb') as freader:
+		freader.seek(index * chunk_size)
+		data = bytearray(freader.read(chunk_size))
+	return index, get_engines()[engine](data)
+
+def merkle_root(leaves, engine):
+	"""Builds the Merkle tree of chunk hashes and returns its root
+
+	Each parent is the MD5 of its two children's digests appended together. A node without a sibling is carried up to
+	the next level unchanged.
+
+	:param leaves: list of MD5 hex strings, one per chunk
+	:param engine: name of the engine used to hash parent nodes
+	:return: MD5 hex string of the root
+	"""
+	if not leaves:
+		return get_engines()[engine](bytearray())
+	level = list(leaves)
+	while len(level) > 1:
+		parents = []
+		for i in range(0, len(level) - 1, 2):
+			parents.append(get_engines()[engine](bytearray(bytes.fromhex(level[i]) + bytes.fromhex(level[i + 1]))))
+		if len(level) % 2:
+			parents.append(level[-1])
+		level = parents
+	return level[0]
+
+def load_tree(fname):
+	"""Loads a saved Merkle tree
+
+	:param fname: String name of the tree file
+	:return: tree dictionary, or None when missing or unreadable
+	"""
+	try:
+		with open(fname) as freader:
+			return json.load(freader)
+	except (OSError, ValueError):
+		return None
+
+def save_tree(fname, tree):
+	"""Saves a Merkle tree, replacing the old file only once the new one is fully written
+
+	:param fname: String name of the tree file
+	:param tree: tree dictionary
+	"""
+	with open(fname + '.tmp', 'w') as fwriter:
+		json.dump(tree, fwriter)
+	os.replace(fname + '.tmp', fname)
+
+def new_tree(fname, chunk_size, engine):
+	"""Makes an empty Merkle tree for a file
+
+	:param fname: String name of the hashed file including path
+	:param chunk_size: chunk size in bytes
+	:param engine: name of the engine used for every hash
+	:return: tree dictionary with every leaf pending
+	"""
+	stat = os.stat(fname)
+	count = max(1, -(-stat.st_size // chunk_size))
+	return {'version': TREE_VERSION, 'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'chunk_size': chunk_size,
+		'engine': engine, 'leaves': [None] * count, 'root': None}
+
+def fill_tree(fname, tree_name, tree, indexes, workers):
+	"""Hashes the given chunks in parallel and stores them as leaves of the tree
+
+	The tree is saved every few chunks so an interrupted run resumes from the chunks already hashed.
+
+	:param fname: String name of the hashed file including path
+	:param tree_name: String name of the tree file to save progress to
+	:param tree: tree dictionary to fill
+	:param indexes: chunk indexes to hash
+	:param workers: number of worker processes
+	:return: the filled tree
+	"""
+	jobs = [(fname, i, tree['chunk_size'], tree['engine']) for i in indexes]
+	if jobs:
+		with multiprocessing.Pool(workers) as pool:
+			for done, (index, digest) in enumerate(pool.imap_unordered(hash_chunk, jobs), 1):
+				tree['leaves'][index] = digest
+				if done % SAVE_EVERY == 0:
+					save_tree(tree_name, tree)
+	tree['root'] = merkle_root(tree['leaves'], tree['engine'])
+	save_tree(tree_name, tree)
+	return tree
+
+def parse_chunks(text, count):
+	"""Parses a comma separated list of chunk indexes
+
+	:param text: comma separated chunk indexes, or None for every chunk
+	:param count: number of chunks in the file
+	:return: list of chunk indexes
+	"""
+	if not text:
+		return list(range(count))
+	indexes = [int(i) for i in text.split(',')]
+	for i in indexes:
+		if not 0 <= i < count:
+			raise ValueError('chunk {} is out of range 0-{}'.format(i, count - 1))
+	return indexes
+
+def build_tree(fname, chunk_size, workers, engine, rehash=None):
+	"""Builds or resumes the Merkle tree saved next to a file
+
+	A tree saved by an interrupted run, or a complete one, is reused when the tree version, the file's size and
+	modification time, the chunk size and the engine still match. Chunks listed in rehash are hashed again, for example
+	after re-transferring chunks that failed verification; the rest of the tree is then kept even though the file was
+	modified.
+
+	:param fname: String name of the file including path
+	:param chunk_size: chunk size in bytes
+	:param workers: number of worker processes
+	:param engine: name of the engine used for every hash
+	:param rehash: comma separated chunk indexes to hash again, or None
+	:return: the complete tree dictionary
+	"""
+	tree_name = fname + TREE_EXT
+	tree = load_tree(tree_name)
+	stat = os.stat(fname)
+	if (tree is None or tree.get('version') != TREE_VERSION or tree['file_size'] != stat.st_size
+			or tree['chunk_size'] != chunk_size or tree['engine'] != engine
+			or (not rehash and tree.get('mtime_ns') != stat.st_mtime_ns)):
+		tree = new_tree(fname, chunk_size, engine)
+	tree['mtime_ns'] = stat.st_mtime_ns
+	pending = [i for i, leaf in enumerate(tree['leaves']) if leaf is None]
+	if rehash:
+		pending = sorted(set(pending + parse_chunks(rehash, len(tree['leaves']))))
+	if pending and len(pending) < len(tree['leaves']):
+		print('Hashing {} of {} chunks, the rest are already saved'.format(len(pending), len(tree['leaves'])))
+	return fill_tree(fname, tree_name, tree, pending, workers)
+
+def verify_tree(fname, workers, chunks=None):
+	"""Verifies a file against the Merkle tree saved next to it
+
+	Fresh chunk hashes are saved to their own progress file so an interrupted verification resumes. When chunks is
+	given only those chunks are read and compared.
+
+	:param fname: String name of the file including path
+	:param workers: number of worker processes
+	:param chunks: comma separated chunk indexes to verify, or None for every chunk
+	:return: list of corrupted chunk indexes, including chunks missing from the file and chunks past the end of the tree,
+		or None when there is no usable tree
+	"""
+	tree = load_tree(fname + TREE_EXT)
+	if tree is None or tree.get('version') != TREE_VERSION or tree['root'] is None:
+		return None
+	progress_name = fname + VERIFY_EXT
+	progress = load_tree(progress_name)
+	if progress is None or any(progress[key] != tree[key] for key in ('chunk_size', 'engine', 'root')):
+		progress = dict(tree, leaves=[None] * len(tree['leaves']))
+	size = os.path.getsize(fname)
+	extra = []
+	if size != tree['file_size']:
+		print('File size changed from {} to {} bytes'.format(tree['file_size'], size))
+		extra = list(range(len(tree['leaves']), max(1, -(-size // tree['chunk_size']))))
+	indexes = parse_chunks(chunks, len(tree['leaves']))
+	if chunks:
+		pending = indexes
+	else:
+		pending = [i for i in indexes if progress['leaves'][i] is None]
+	jobs = [(fname, i, tree['chunk_size'], tree['engine']) for i in pending]
+	if jobs:
+		with multiprocessing.Pool(workers) as pool:
+			for done, (index, digest) in enumerate(pool.imap_unordered(hash_chunk, jobs), 1):
+				progress['leaves'][index] = digest
+				if done % SAVE_EVERY == 0:
+					save_tree(progress_name, progress)
+	if os.path.exists(progress_name):
+		os.remove(progress_name)
+	return [i for i in indexes if progress['leaves'][i] != tree['leaves'][i]] + extra
+
+def run_merkle(args):
+	"""Runs the chunked Merkle tree build (-M) or verification (-V) of a file
+
+	:param args: parsed command line arguments
+	:return: 0 on success, otherwise 1
+	"""
+	if not args.filename:
+		print('A file name is required for -M and -V')
+		return 1
+	engine = 'hashlib' if args.H else 'author'
+	try:
+		if args.V:
+			corrupted = verify_tree(args.filename, args.workers, args.chunks)
+			if corrupted is None:
+				print('No complete, current tree found at \'{}\', run -M first'.format(args.filename + TREE_EXT))
+				return 1
+			tree = load_tree(args.filename + TREE_EXT)
+			chunk_size = tree['chunk_size']
+			size = os.path.getsize(args.filename)
+			if not corrupted and size == tree['file_size']:
+				print('All checked chunks of \'{}\' match'.format(args.filename))
+				return 0
+			if corrupted:
+				print('Corrupted chunks (index: byte range):')
+			for i in corrupted:
+				if i >= len(tree['leaves']):
+					state = ' extra, past the end of the tree'
+				elif i * chunk_size >= size:
+					state = ' missing from the file'
+				else:
+					state = ''
+				print('{}: {}-{}{}'.format(i, i * chunk_size, (i + 1) * chunk_size - 1, state))
+			if size != tree['file_size']:
+				print('The file should be {} bytes, re-transfer it and run -V again'.format(tree['file_size']))
+			else:
+				print('Re-transfer them, then run -M --chunks {}'.format(','.join(str(i) for i in corrupted)))
+			return 1
+		tree = build_tree(args.filename, args.chunk_size, args.workers, engine, args.chunks)
+	except (OSError, ValueError) as err:
+		print(err)
+		print('Shutting down...')
+		return 1
+	print('Merkle root of \'{}\' ({} chunks of {} bytes)'.format(args.filename, len(tree['leaves']), tree['chunk_size']))
+	print(tree['root'])
+	return 0
+
+def parse_sizes(text):
+	"""Parses the comma separated message sizes given to --sizes
+
+	:param text: comma separated sizes in bytes
+	:return: list of sizes
+	"""
+	try:
+		sizes = [int(size) for size in text.split(',')]
+	except ValueError:
+		raise argparse.ArgumentTypeError('sizes must be comma separated whole numbers of bytes: \'{}\''.format(text))
+	if any(size < 0 for size in sizes):
+		raise argparse.ArgumentTypeError('sizes cannot be negative: \'{}\''.format(text))
+	return sizes
+
 def parser_setup():
 	"""Sets up parser for command line arguments
 
@@ -255,6 +653,21 @@ def parser_setup():
 	parser.add_argument('-H', action='store_true', help='Use hashlib.md5()')
 	parser.add_argument('-S', action='store_true', help='[DEFAULT] Use author\'s implementation')
 	parser.add_argument('-A', action='store_true', help='Use both implementations (hashlib and author)')
+	parser.add_argument('-B', action='store_true', help='Benchmark every implementation instead of hashing input')
+	parser.add_argument('--sizes', type=parse_sizes, default=BENCH_SIZES,
+		help='Comma separated message sizes in bytes for -B')
+	parser.add_argument('--min-time', type=float, default=BENCH_MIN_SECONDS,
+		help='Minimum seconds to spend on each engine and size for -B')
+	parser.add_argument('--profile', action='store_true', help='Show time spent in each round function for -B')
+	parser.add_argument('--save-baseline', type=str, metavar='JSON', help='Save -B results as a baseline file')
+	parser.add_argument('--baseline', type=str, metavar='JSON', help='Fail -B when slower than this baseline file')
+	parser.add_argument('--threshold', type=float, default=BENCH_THRESHOLD_PCT,
+		help='Allowed throughput drop in percent against --baseline')
+	parser.add_argument('-M', action='store_true', help='Build or resume a chunked Merkle tree saved next to the file')
+	parser.add_argument('-V', action='store_true', help='Verify the file against its saved Merkle tree')
+	parser.add_argument('--chunk-size', type=int, default=CHUNK_BYTES, help='Chunk size in bytes for -M')
+	parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes for -M and -V')
+	parser.add_argument('--chunks', type=str, help='Comma separated chunk indexes to rehash with -M or check with -V')
 	parser.add_argument('filename', nargs='?', type=str, help='Name of file to use')
 	return parser
 
@@ -266,6 +679,10 @@ def run_md5():
 	"""
 	parser = parser_setup()
 	args = parser.parse_args()
+	if args.B:
+		sys.exit(run_benchmark(args))
+	if args.M or args.V:
+		sys.exit(run_merkle(args))
 	if args.filename:
 		data = bytearray(read_file(args.filename))
 		print('Reading from file \'{}\' for MD5'.format(args.filename))
@@ -294,4 +711,5 @@ def run_md5():
 		print('MD5 processed by author\'s implementation')
 		print(process_data(data))
 
-run_md5()
+if __name__ == '__main__':
+	run_md5()
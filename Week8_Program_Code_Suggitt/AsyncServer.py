@@ -0,0 +1,411 @@
+"""
+Asyncio version of Server/ServerWorker. Every RTSP connection and every playing stream is a coroutine in one event loop
+instead of one or two threads per client, and all RTP packets go out through a single shared UDP socket. Each
+connection gets its own RtspSession object holding the state that ServerWorker keeps in clientInfo. The fragments of a
+frame are sent in one batch without copying the payload (see RtpSender). "live/<file>" sessions share a LiveChannel.
+Requests are read with RtspParser, so they may be pipelined, and a client may ask for RTP interleaved on its RTSP
+connection instead of UDP. A SessionManager ends connections that stay idle past the session timeout. Opening and
+closing a file and reading a frame missing from the read-ahead window run in the loop's default executor, so disk
+waits never hold up the other sessions.
+
+Usage: AsyncServer.py Server_port
+"""
+from random import randint
+import sys, os, asyncio, socket, time, logging
+
+from VideoStream import VideoStream, FRAME_PERIOD, parseRange
+from RtpPacket import HEADER_SIZE, packHeader
+from RtpJpeg import fragmentFrameViews, frameTimestamp
+from RtpSender import RtpSender
+from Rtcp import RtcpChannel, SenderStats, RTCP_INTERVAL
+from LiveChannel import isLive, openChannel, closeChannel
+from PacketStream import PacketStream, isPacketized
+from FrameThinner import FrameThinner
+from RtspParser import RtspParser, RtspError, Interleaved, formatReply, parseRangePair, interleavedHeader
+
+from Metrics import SessionMetrics, responseTime, startServer
+from SessionManager import SessionManager
+
+MAX_TCP_BACKLOG = 256 * 1024 # Bytes queued on an RTSP connection before interleaved frames are dropped
+
+log = logging.getLogger('AsyncServer')
+
+class RtspSession:
+	SETUP = 'SETUP'
+	PLAY = 'PLAY'
+	PAUSE = 'PAUSE'
+	TEARDOWN = 'TEARDOWN'
+	OPTIONS = 'OPTIONS'
+	GET_PARAMETER = 'GET_PARAMETER'
+	METHODS = (OPTIONS, SETUP, PLAY, PAUSE, TEARDOWN, GET_PARAMETER)
+
+	INIT = 0
+	READY = 1
+	PLAYING = 2
+
+	OK_200 = 0
+	FILE_NOT_FOUND_404 = 1
+	CON_ERR_500 = 2
+	BAD_REQUEST_400 = 3
+	UNSUPPORTED_TRANSPORT_461 = 4
+	NOT_IMPLEMENTED_501 = 5
+	METHOD_NOT_VALID_455 = 6
+
+	REPLIES = {
+		OK_200: (200, 'OK'),
+		FILE_NOT_FOUND_404: (404, 'Not Found'),
+		CON_ERR_500: (500, 'Internal Server Error'),
+		BAD_REQUEST_400: (400, 'Bad Request'),
+		UNSUPPORTED_TRANSPORT_461: (461, 'Unsupported Transport'),
+		NOT_IMPLEMENTED_501: (501, 'Not Implemented'),
+		METHOD_NOT_VALID_455: (455, 'Method Not Valid in This State'),
+	}
+
+	def __init__(self, server, writer):
+		self.server = server
+		self.writer = writer
+		self.clientAddr = writer.get_extra_info('peername')[0]
+		self.state = self.INIT
+		self.session = 0
+		self.rtpPort = 0
+		self.interleaved = None # RTP channel on the RTSP connection, None for UDP
+		self.rtpSeq = randint(0, 0xffff)
+		self.ssrc = randint(0, 0xffffffff)
+		self.rtcpStats = SenderStats(self.ssrc)
+		self.thinner = FrameThinner(self.rtcpStats)
+		self.videoStream = None
+		self.playTask = None
+		self.live = None
+		self.multicast = False
+		self.subscriber = None
+		self.paused = None # The live Subscriber before a PAUSE, so a later PLAY continues its sequence numbers
+		self.metrics = None
+		self.lastRequest = time.monotonic()
+
+	def lastActivity(self):
+		"""Return the time.monotonic() of the last request, or of the last RTCP receiver report if that is later."""
+		if self.rtcpStats.lastReport is None:
+			return self.lastRequest
+		return max(self.lastRequest, time.monotonic() - (time.time() - self.rtcpStats.lastReport))
+
+	def hasSession(self):
+		"""Return True once SETUP has succeeded."""
+		return self.state != self.INIT
+
+	def expire(self):
+		"""End an idle session, called by the session manager. handleClient then sees the connection close."""
+		self.close()
+		self.writer.close()
+
+	async def processRtspRequest(self, request):
+		"""Process an RTSP request (an RtspMessage) sent from the client."""
+		self.lastRequest = time.monotonic()
+		requestType = request.method
+		filename = request.uri
+		seq = request.cseq()
+
+		if requestType == self.SETUP:
+			if self.state == self.INIT:
+				transport = request.transport()
+				try:
+					if 'interleaved' in transport:
+						self.interleaved = parseRangePair(transport['interleaved'])[0]
+					else:
+						self.rtpPort = parseRangePair(transport.get('client_port', ''))[0]
+				except ValueError:
+					self.replyRtsp(self.BAD_REQUEST_400, seq)
+					return
+				self.multicast = 'multicast' in transport
+				if isLive(filename) and self.interleaved is not None:
+					self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+					return
+				if isLive(filename):
+					opener = openChannel
+				elif isPacketized(filename):
+					opener = PacketStream
+				else:
+					opener = VideoStream
+				try:
+					# Opening may scan the whole file for its frame index, so it runs off the event loop
+					stream = await asyncio.get_running_loop().run_in_executor(None, opener, filename)
+				except IOError:
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
+				if isLive(filename):
+					self.live = stream
+				else:
+					self.videoStream = stream
+				if self.writer.is_closing(): # Expired or disconnected while the file was opening
+					self.close()
+					return
+				self.state = self.READY
+				self.session = randint(100000, 999999)
+				self.metrics = SessionMetrics(self.session)
+				self.server.rtcpChannel.register(self.rtcpStats)
+				if self.interleaved is not None:
+					transportReply = 'RTP/AVP/TCP;interleaved=%d-%d' % (self.interleaved, self.interleaved + 1)
+					self.replyRtsp(self.OK_200, seq, [('Transport', transportReply)])
+				else:
+					self.replyRtsp(self.OK_200, seq)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
+
+		elif requestType == self.PLAY:
+			if self.state == self.READY:
+				self.state = self.PLAYING
+				if self.live:
+					self.playLive(seq)
+					return
+				start = self.getRangeStart(request)
+				if start is not None:
+					self.videoStream.seekTime(start)
+				playRange = 'npt=%.3f-%.3f' % (self.videoStream.position(), self.videoStream.duration())
+				self.replyRtsp(self.OK_200, seq, [('Range', playRange)])
+				self.playTask = asyncio.get_running_loop().create_task(self.sendRtp())
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
+
+		elif requestType == self.PAUSE:
+			if self.state == self.PLAYING:
+				self.state = self.READY
+				self.stopRtp()
+				self.replyRtsp(self.OK_200, seq)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
+
+		elif requestType == self.TEARDOWN:
+			self.replyRtsp(self.OK_200, seq)
+			self.close()
+			self.writer.close()
+
+		# Keep-alives, they only refresh the session's activity
+		elif requestType == self.OPTIONS:
+			self.replyRtsp(self.OK_200, seq, [('Public', ', '.join(self.METHODS))])
+		elif requestType == self.GET_PARAMETER:
+			self.replyRtsp(self.OK_200, seq)
+
+		else:
+			self.replyRtsp(self.NOT_IMPLEMENTED_501, seq)
+
+	async def sendRtp(self):
+		"""Send RTP packets over UDP, one frame every FRAME_PERIOD, and an RTCP sender report every RTCP_INTERVAL."""
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() - FRAME_PERIOD # The first frame, a JPEG keyframe like every frame, goes out at once
+		nextReport = deadline + FRAME_PERIOD
+		while True:
+			if deadline >= nextReport:
+				if self.interleaved is not None:
+					self.sendInterleaved([[self.rtcpStats.senderReport()]], self.interleaved + 1)
+				else:
+					self.server.rtcpChannel.send(self.rtcpStats.senderReport(), (self.clientAddr, self.rtpPort + 1))
+				nextReport += RTCP_INTERVAL
+			deadline += FRAME_PERIOD
+			await asyncio.sleep(deadline - loop.time())
+			frameNumber = self.videoStream.frameNbr() + 1
+			if frameNumber > self.videoStream.frameCount():
+				break
+			# Skip frames while the client is congested, waking up a period late is a send backlog
+			lateness = loop.time() - deadline
+			if lateness > FRAME_PERIOD:
+				self.thinner.onCongestion()
+			if not self.thinner.sendFrame(frameNumber):
+				self.videoStream.seek(frameNumber)
+				self.metrics.onThinned()
+				continue
+			packets, frameBytes, timestamp = await self.nextPackets()
+			sendStart = time.perf_counter()
+			if self.interleaved is not None:
+				sent = self.sendInterleaved(packets, self.interleaved)
+			else:
+				sent = self.server.sendRtp(packets, (self.clientAddr, self.rtpPort))
+			self.metrics.onFrame(sent, frameBytes, time.perf_counter() - sendStart, lateness)
+			self.thinner.onSent(sent, len(packets))
+			self.rtcpStats.onSend(len(packets), frameBytes, timestamp)
+
+	async def nextPackets(self):
+		"""Return (packets, frame bytes, timestamp) for the next frame, which must exist."""
+		if isinstance(self.videoStream, PacketStream):
+			# Ready-made packets, only the sequence numbers and SSRC are patched in
+			packets, frameBytes, timestamp = self.videoStream.nextPackets(self.rtpSeq, self.ssrc)
+			self.rtpSeq = (self.rtpSeq + len(packets)) & 0xffff
+			return packets, frameBytes, timestamp
+		data = self.videoStream.nextBufferedFrame()
+		if data is None:
+			# A read-ahead miss, or every frame with READ_AHEAD=0, is read off the event loop
+			data = await asyncio.get_running_loop().run_in_executor(None, self.videoStream.nextFrame)
+		timestamp = frameTimestamp(self.videoStream.frameNbr(), FRAME_PERIOD)
+		payloads = fragmentFrameViews(data)
+		headers = bytearray(HEADER_SIZE * len(payloads))
+		packets = []
+		for i, payload in enumerate(payloads):
+			marker = 1 if i == len(payloads) - 1 else 0
+			packets.append(self.makeRtp(headers, i, payload, self.rtpSeq, marker, timestamp))
+			self.rtpSeq = (self.rtpSeq + 1) & 0xffff
+		return packets, len(data), timestamp
+
+	def playLive(self, seq):
+		"""Subscribe to the live channel, by unicast or through its multicast group."""
+		if self.multicast:
+			self.subscriber, group = self.live.subscribeMulticast(self.rtpPort, self.paused)
+			self.replyRtsp(self.OK_200, seq, [('Transport', 'RTP/UDP; multicast; destination=%s; port=%d' % (group, self.rtpPort))])
+			return
+		self.subscriber = self.live.subscribe((self.clientAddr, self.rtpPort), self.ssrc, self.rtcpStats, self.metrics,
+			self.paused)
+		self.replyRtsp(self.OK_200, seq)
+		self.playTask = asyncio.get_running_loop().create_task(self.sendReports())
+
+	async def sendReports(self):
+		"""Send an RTCP sender report every RTCP_INTERVAL while subscribed to a live channel."""
+		while True:
+			await asyncio.sleep(FRAME_PERIOD)
+			self.server.rtcpChannel.send(self.rtcpStats.senderReport(), (self.clientAddr, self.rtpPort + 1))
+			await asyncio.sleep(RTCP_INTERVAL - FRAME_PERIOD)
+
+	def sendInterleaved(self, packets, channel):
+		"""Queue packets on the RTSP connection. Return how many were queued, none while the client is behind."""
+		transport = self.writer.transport
+		if transport.is_closing() or transport.get_write_buffer_size() > MAX_TCP_BACKLOG:
+			return 0
+		for buffers in packets:
+			self.writer.write(b''.join([interleavedHeader(channel, sum(len(buf) for buf in buffers))] + buffers))
+		return len(packets)
+
+	def getRangeStart(self, request):
+		"""Return the start in seconds of the request's Range header, or None."""
+		value = request.header('Range')
+		if value is None:
+			return None
+		try:
+			return parseRange(value)
+		except ValueError:
+			return None
+
+	def stopRtp(self):
+		"""Stop the playing stream, if any."""
+		if self.playTask:
+			self.playTask.cancel()
+			self.playTask = None
+		if self.subscriber:
+			self.live.unsubscribe(self.subscriber)
+			self.paused = self.subscriber
+			self.subscriber = None
+
+	def makeRtp(self, headers, index, payload, seqnum, marker, timestamp):
+		"""RTP-packetize the video data. Return the packet as a list of buffers.
+
+		The header is packed into slot index of headers, the one header buffer shared by a batch of packets.
+		"""
+		version = 2
+		padding = 0
+		extension = 0
+		cc = 0
+		pt = 26 # MJPEG type
+		ssrc = self.ssrc
+		offset = index * HEADER_SIZE
+
+		packHeader(headers, offset, version, padding, extension, cc, seqnum, marker, pt, timestamp, ssrc)
+
+		return [memoryview(headers)[offset:offset + HEADER_SIZE]] + payload
+
+	def replyRtsp(self, code, seq, headers=()):
+		"""Send RTSP reply to the client, with optional extra (name, value) headers."""
+		status, reason = self.REPLIES[code]
+		if code != self.OK_200:
+			log.warning('%d %s', status, reason.upper())
+		session = str(self.session)
+		if self.session:
+			session += ';timeout=%d' % self.server.manager.timeout
+		headers = [('Session', session)] + list(headers)
+		if self.writer.is_closing():
+			return
+		self.writer.write(formatReply(status, reason, seq, headers))
+
+	def close(self):
+		"""Release everything held by the session."""
+		self.stopRtp()
+		self.state = self.INIT
+		self.server.rtcpChannel.unregister(self.ssrc)
+		if self.metrics:
+			log.info('Session %d closed, RTCP stats: %s', self.session, self.rtcpStats.stats())
+			self.metrics.close()
+			self.metrics = None
+		# Closing waits for a read-ahead in progress, which must not hold up the event loop
+		loop = asyncio.get_running_loop()
+		if self.videoStream:
+			loop.run_in_executor(None, self.videoStream.close)
+			self.videoStream = None
+		if self.live:
+			loop.run_in_executor(None, closeChannel, self.live)
+			self.live = None
+
+class AsyncServer:
+
+	def __init__(self):
+		self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.rtpSocket.setblocking(False)
+		self.rtpSender = RtpSender(self.rtpSocket)
+		self.rtcpChannel = RtcpChannel()
+		self.manager = SessionManager()
+
+	def sendRtp(self, packets, addr):
+		"""Send a batch of RTP packets through the shared UDP socket. Return how many were sent, the rest are dropped."""
+		try:
+			return self.rtpSender.sendBatch(packets, addr)
+		except (BlockingIOError, ConnectionError):
+			return 0
+
+	async def handleClient(self, reader, writer):
+		"""Serve one RTSP connection until the client closes it."""
+		session = RtspSession(self, writer)
+		self.manager.add(session)
+		parser = RtspParser()
+		try:
+			while True:
+				data = await reader.read(4096)
+				if not data:
+					break
+				for item in parser.feed(data):
+					if isinstance(item, Interleaved):
+						# RTCP receiver reports from a client using interleaved transport
+						self.rtcpChannel.handle(item.data, time.time())
+					elif not writer.is_closing():
+						log.debug('Data received:\n%s', item)
+						start = time.perf_counter()
+						await session.processRtspRequest(item)
+						responseTime(item.method).observe(time.perf_counter() - start)
+				await writer.drain()
+		except RtspError:
+			session.replyRtsp(session.BAD_REQUEST_400, '0')
+		except ConnectionError:
+			pass
+		finally:
+			session.close()
+			self.manager.remove(session)
+			writer.close()
+
+	async def reapSessions(self):
+		"""Expire idle sessions every checkInterval seconds."""
+		while True:
+			await asyncio.sleep(self.manager.checkInterval())
+			self.manager.expireIdle()
+
+	async def serve(self, port):
+		"""Accept RTSP connections forever."""
+		asyncio.get_running_loop().add_reader(self.rtcpChannel.sock, self.rtcpChannel.readAvailable)
+		server = await asyncio.start_server(self.handleClient, '', port, backlog=1024)
+		self.reaper = asyncio.get_running_loop().create_task(self.reapSessions())
+		async with server:
+			await server.serve_forever()
+
+	def main(self):
+		try:
+			SERVER_PORT = int(sys.argv[1])
+		except:
+			print("[Usage: AsyncServer.py Server_port]\n")
+			return
+		logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+		startServer()
+		asyncio.run(self.serve(SERVER_PORT))
+
+if __name__ == "__main__":
+	(AsyncServer()).main()
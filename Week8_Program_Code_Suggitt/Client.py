@@ -8,13 +8,20 @@ sendRtspRequest, parseRtspReply, and openRtpPort. One import was also fixed by a
 """
 from tkinter import *
 import tkinter.messagebox as tkMessageBox
-from PIL import Image, ImageTk
-import socket, threading, sys, traceback, os
+from PIL import ImageTk
+import socket, threading, time
+from random import randint
 
 from RtpPacket import RtpPacket
+from RtpReceiver import RtpReceiver
+from RtpJpeg import FrameAssembler
+from JitterBuffer import JitterBuffer
+from FrameDecoder import FrameDecoder
+from Rtcp import ReceiverStats, packReceiverReport, parseRtcp, PT_SR, RTCP_INTERVAL
+from RtspParser import RtspParser, Interleaved, formatRequest, interleavedHeader
 
-CACHE_FILE_NAME = "cache-"
-CACHE_FILE_EXT = ".jpg"
+POLL_MS = 10 # How often the Tk main loop checks for a decoded frame
+KEEPALIVE_POLL_MS = 1000 # How often the Tk main loop checks whether a keep-alive is due
 
 class Client:
 	INIT = 0
@@ -26,9 +33,10 @@ class Client:
 	PLAY = 1
 	PAUSE = 2
 	TEARDOWN = 3
+	GET_PARAMETER = 4
 
 	# Initiation..
-	def __init__(self, master, serveraddr, serverport, rtpport, filename):
+	def __init__(self, master, serveraddr, serverport, rtpport, filename, interleaved=False, fastStart=False):
 		self.master = master
 		self.master.protocol("WM_DELETE_WINDOW", self.handler)
 		self.createWidgets()
@@ -36,12 +44,33 @@ class Client:
 		self.serverPort = int(serverport)
 		self.rtpPort = int(rtpport)
 		self.fileName = filename
+		self.interleaved = interleaved # Receive RTP on the RTSP connection, channels 0 and 1, instead of UDP
+		self.fastStart = fastStart # Start playing on launch with SETUP and PLAY pipelined
+		self.rtspLock = threading.Lock()
 		self.rtspSeq = 0
 		self.sessionId = 0
 		self.requestSent = -1
+		self.pending = {} # CSeq -> request code of the requests still waiting for a reply
+		self.startTime = None # When playback was asked for, until the first frame is shown
+		self.lastRequest = time.monotonic()
+		self.sessionTimeout = 60 # Replaced by the timeout in the SETUP reply's Session header
 		self.teardownAcked = 0
 		self.connectToServer()
 		self.frameNbr = 0
+		self.assembler = FrameAssembler()
+		self.jitterBuffer = JitterBuffer()
+		self.decoder = FrameDecoder()
+		self.ssrc = randint(0, 0xffffffff)
+		self.rtcpStats = ReceiverStats()
+		self.rtpPacket = RtpPacket() # Reused for interleaved packets, RtpReceiver has its own
+		self.receiver = None
+		self.replyThread = None
+		self.playEvent = None
+		self.lastReport = time.monotonic()
+		self.master.after(POLL_MS, self.pollFrames)
+		self.master.after(KEEPALIVE_POLL_MS, self.keepAlive)
+		if self.fastStart:
+			self.master.after(0, self.fastStartMovie)
 
 	def createWidgets(self):
 		"""Build GUI."""
@@ -75,14 +104,38 @@ class Client:
 
 	def setupMovie(self):
 		"""Setup button handler."""
-		if self.state == self.INIT:
+		if self.fastStart:
+			self.fastStartMovie()
+		elif self.state == self.INIT:
 			self.sendRtspRequest(self.SETUP)
 
+	def fastStartMovie(self):
+		"""Bind the RTP port, then send SETUP and PLAY in one write without waiting for the SETUP reply."""
+		if self.state != self.INIT or self.pending:
+			return
+		self.startTime = time.monotonic()
+		self.openRtpPort()
+		self.playEvent = threading.Event()
+		self.jitterBuffer.reset()
+		threading.Thread(target=self.playout, daemon=True).start()
+		self.startReplyThread()
+		setupSeq = self.rtspSeq + 1
+		self.rtspSeq += 2
+		# The PLAY has no Session header yet, the server applies it to the session the SETUP creates
+		request = (formatRequest('SETUP', self.fileName, setupSeq, [('Transport', self.transport())])
+			+ formatRequest('PLAY', self.fileName, self.rtspSeq))
+		self.pending = {setupSeq: self.SETUP, self.rtspSeq: self.PLAY}
+		self.requestSent = self.PLAY
+		self.lastRequest = time.monotonic()
+		self.sendRtsp(request)
+
+		print('\nData sent:\n' + request.decode('utf-8'))
+
 	def exitClient(self):
 		"""Teardown button handler."""
 		self.sendRtspRequest(self.TEARDOWN)
+		self.decoder.stop()
 		self.master.destroy() # Close the gui window
-		os.remove(CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT) # Delete the cache image from video
 
 	def pauseMovie(self):
 		"""Pause button handler."""
@@ -92,53 +145,103 @@ class Client:
 	def playMovie(self):
 		"""Play button handler."""
 		if self.state == self.READY:
-			# Create a new thread to listen for RTP packets
-			threading.Thread(target=self.listenRtp).start()
 			self.playEvent = threading.Event()
 			self.playEvent.clear()
+			# Timestamps restart from the resumed position, so forget the old clock mapping
+			self.jitterBuffer.reset()
+			# Create a new thread to play frames out of the jitter buffer, RtpReceiver has been listening since SETUP
+			threading.Thread(target=self.playout, daemon=True).start()
+			self.startTime = time.monotonic()
 			self.sendRtspRequest(self.PLAY)
 
 	def listenRtp(self):
-		"""Listen for RTP packets."""
-		while True:
+		"""Receive RTP packets until the Teardown is acknowledged, then close the RTP socket."""
+		self.receiver.run()
+		print("Receive stats: " + str(self.receiver.stats()))
+		self.rtpSocket.close()
+
+	def processRtp(self, data):
+		"""Take in one RTP packet interleaved on the RTSP connection."""
+		self.rtpPacket.decode(data)
+		self.handleRtp(self.rtpPacket, len(data), time.time())
+
+	def handleRtp(self, rtpPacket, length, arrival):
+		"""Take in one decoded RTP packet. Its buffers are reused afterwards, so the payload is copied by the assembler."""
+		currSeqNbr = rtpPacket.seqNum()
+		self.rtcpStats.update(currSeqNbr, rtpPacket.timestamp(), rtpPacket.ssrc(), length, arrival)
+
+		# Reassemble the fragments, a frame is complete once its last fragment arrives
+		frame = self.assembler.addPacket(rtpPacket.timestamp(), rtpPacket.marker(), rtpPacket.getPayload(), currSeqNbr)
+		if frame is not None:
+			# The jitter buffer reorders frames and drops late ones
+			self.jitterBuffer.put(self.assembler.frameSeq, rtpPacket.timestamp(), bytes(frame))
+
+	def processInterleavedRtcp(self, data):
+		"""Take in RTCP from the RTSP connection and answer with a receiver report every RTCP_INTERVAL."""
+		for report in parseRtcp(data):
+			if report['type'] == PT_SR:
+				self.rtcpStats.onSenderReport(report)
+		if self.rtcpStats.ssrc is not None and time.monotonic() - self.lastReport >= RTCP_INTERVAL:
+			self.lastReport = time.monotonic()
+			report = packReceiverReport(self.ssrc, [self.rtcpStats.reportBlock()])
+			self.sendRtsp(interleavedHeader(1, len(report)) + report)
+
+	def listenRtcp(self):
+		"""Take in RTCP sender reports and send receiver reports back every RTCP_INTERVAL."""
+		serverAddr = None
+		lastReport = time.monotonic()
+		while self.teardownAcked == 0:
 			try:
-				data = self.rtpSocket.recv(20480)
-				if data:
-					rtpPacket = RtpPacket()
-					rtpPacket.decode(data)
-
-					currFrameNbr = rtpPacket.seqNum()
-					print("Current Seq Num: " + str(currFrameNbr))
-
-					if currFrameNbr > self.frameNbr: # Discard the late packet
-						self.frameNbr = currFrameNbr
-						self.updateMovie(self.writeFrame(rtpPacket.getPayload()))
-			except:
-				# Stop listening upon requesting PAUSE or TEARDOWN
-				if self.playEvent.isSet():
-					break
-
-				# Upon receiving ACK for TEARDOWN request,
-				# close the RTP socket
-				if self.teardownAcked == 1:
-					self.rtpSocket.shutdown(socket.SHUT_RDWR)
-					self.rtpSocket.close()
-					break
-
-	def writeFrame(self, data):
-		"""Write the received frame to a temp image file. Return the image file."""
-		cachename = CACHE_FILE_NAME + str(self.sessionId) + CACHE_FILE_EXT
-		file = open(cachename, "wb")
-		file.write(data)
-		file.close()
-
-		return cachename
-
-	def updateMovie(self, imageFile):
-		"""Update the image file as video frame in the GUI."""
-		photo = ImageTk.PhotoImage(Image.open(imageFile))
+				data, addr = self.rtcpSocket.recvfrom(2048)
+				for report in parseRtcp(data):
+					if report['type'] == PT_SR:
+						self.rtcpStats.onSenderReport(report)
+						serverAddr = addr
+			except socket.timeout:
+				pass
+			except OSError:
+				break
+			if serverAddr and self.rtcpStats.ssrc is not None and time.monotonic() - lastReport >= RTCP_INTERVAL:
+				lastReport = time.monotonic()
+				try:
+					self.rtcpSocket.sendto(packReceiverReport(self.ssrc, [self.rtcpStats.reportBlock()]), serverAddr)
+				except OSError:
+					pass
+		print("RTCP stats: " + str(self.rtcpStats.stats()))
+		self.rtcpSocket.close()
+
+	def playout(self):
+		"""Display frames as the jitter buffer releases them on its playout clock."""
+		while True:
+			frame = self.jitterBuffer.pop(0.5)
+			if frame is not None:
+				self.frameNbr += 1
+				self.decoder.submit(frame)
+			elif self.playEvent.isSet() or self.teardownAcked == 1:
+				print("Playout stats: " + str(self.jitterBuffer.stats()))
+				break
+
+	def pollFrames(self):
+		"""Show the newest decoded frame, if any. Runs on the Tk main loop."""
+		image = self.decoder.get()
+		if image is not None:
+			self.updateMovie(image)
+		self.master.after(POLL_MS, self.pollFrames)
+
+	def keepAlive(self):
+		"""Send a GET_PARAMETER every half session timeout so a paused session is not expired. Runs on the Tk main loop."""
+		if self.state != self.INIT and not self.pending and time.monotonic() - self.lastRequest >= self.sessionTimeout / 2:
+			self.sendRtspRequest(self.GET_PARAMETER)
+		self.master.after(KEEPALIVE_POLL_MS, self.keepAlive)
+
+	def updateMovie(self, image):
+		"""Update the decoded image as video frame in the GUI."""
+		photo = ImageTk.PhotoImage(image)
 		self.label.configure(image = photo, height=288)
 		self.label.image = photo
+		if self.startTime is not None:
+			print("Time to first frame: %.1f ms" % ((time.monotonic() - self.startTime) * 1000))
+			self.startTime = None
 
 	def connectToServer(self):
 		"""Connect to the Server. Start a new RTSP/TCP session."""
@@ -156,13 +259,11 @@ class Client:
 
 		# Setup request
 		if requestCode == self.SETUP and self.state == self.INIT:
-			threading.Thread(target=self.recvRtspReply).start()
+			self.startReplyThread()
 			# Update RTSP sequence number.
-			self.rtspSeq = 1
+			self.rtspSeq += 1
 			# Write the RTSP request to be sent.
-			request = 'SETUP ' + self.fileName + ' RTSP/1.0\n'
-			request += 'CSeq: ' + str(self.rtspSeq) + '\n'
-			request += 'Transport: ' + 'RTP/UDP; client_port= ' + str(self.rtpPort)
+			request = formatRequest('SETUP', self.fileName, self.rtspSeq, [('Transport', self.transport())])
 			# Keep track of the sent request.
 			self.requestSent = self.SETUP
 
@@ -171,9 +272,7 @@ class Client:
 			# Update RTSP sequence number.
 			self.rtspSeq += 1
 			# Write the RTSP request to be sent.
-			request = 'PLAY ' + self.fileName + ' RTSP/1.0\n'
-			request += 'CSeq: ' + str(self.rtspSeq) + '\n'
-			request += 'Session: ' + str(self.sessionId)
+			request = formatRequest('PLAY', self.fileName, self.rtspSeq, [('Session', self.sessionId)])
 			# Keep track of the sent request.
 			self.requestSent = self.PLAY
 
@@ -182,9 +281,7 @@ class Client:
 			# Update RTSP sequence number.
 			self.rtspSeq += 1
 			# Write the RTSP request to be sent.
-			request = 'PAUSE ' + self.fileName + ' RTSP/1.0\n'
-			request += 'CSeq: ' + str(self.rtspSeq) + '\n'
-			request += 'Session: ' + str(self.sessionId)
+			request = formatRequest('PAUSE', self.fileName, self.rtspSeq, [('Session', self.sessionId)])
 			# Keep track of the sent request.
 			self.requestSent = self.PAUSE
 
@@ -193,85 +290,143 @@ class Client:
 			# Update RTSP sequence number.
 			self.rtspSeq += 1
 			# Write the RTSP request to be sent.
-			request = 'TEARDOWN ' + self.fileName + ' RTSP/1.0\n'
-			request += 'CSeq: ' + str(self.rtspSeq) + '\n'
-			request += 'Session: ' + str(self.sessionId)
+			request = formatRequest('TEARDOWN', self.fileName, self.rtspSeq, [('Session', self.sessionId)])
 			# Keep track of the sent request.
 			self.requestSent = self.TEARDOWN
 
+		# Keep-alive request, only sent while no other reply is awaited
+		elif requestCode == self.GET_PARAMETER and not self.state == self.INIT:
+			self.rtspSeq += 1
+			request = formatRequest('GET_PARAMETER', self.fileName, self.rtspSeq, [('Session', self.sessionId)])
+			self.requestSent = self.GET_PARAMETER
+
 		else:
 			return
 
 		# Send the RTSP request using rtspSocket.
-		self.rtspSocket.send(request.encode('utf-8'))
+		self.pending[self.rtspSeq] = self.requestSent
+		self.lastRequest = time.monotonic()
+		self.sendRtsp(request)
+
+		print('\nData sent:\n' + request.decode('utf-8'))
+
+	def transport(self):
+		"""Return the Transport header of the SETUP request."""
+		if self.interleaved:
+			return 'RTP/AVP/TCP;interleaved=0-1'
+		return 'RTP/UDP; client_port= ' + str(self.rtpPort)
 
-		print('\nData sent:\n' + request)
+	def sendRtsp(self, data):
+		"""Send on the RTSP connection. Requests and interleaved RTCP are sent whole, never mixed together."""
+		with self.rtspLock:
+			self.rtspSocket.sendall(data)
+
+	def startReplyThread(self):
+		"""Start receiving replies, once per connection however often SETUP is tried."""
+		if self.replyThread is None:
+			self.replyThread = threading.Thread(target=self.recvRtspReply, daemon=True)
+			self.replyThread.start()
 
 	def recvRtspReply(self):
-		"""Receive RTSP reply from the server."""
+		"""Receive RTSP replies, and interleaved RTP and RTCP, from the server."""
+		parser = RtspParser()
 		while True:
-			reply = self.rtspSocket.recv(1024)
+			reply = self.rtspSocket.recv(65536)
 
 			if reply:
-				self.parseRtspReply(reply.decode("utf-8"))
-
-			# Close the RTSP socket upon requesting Teardown
-			if self.requestSent == self.TEARDOWN:
-				self.rtspSocket.shutdown(socket.SHUT_RDWR)
+				for item in parser.feed(reply):
+					if not isinstance(item, Interleaved):
+						self.parseRtspReply(item)
+					elif item.channel == 0:
+						self.processRtp(item.data)
+					elif item.channel == 1:
+						self.processInterleavedRtcp(item.data)
+
+			# Close the RTSP socket once the Teardown is acknowledged, interleaved RTP may arrive before the reply, or once
+			# the server has closed the connection
+			if not reply or (self.requestSent == self.TEARDOWN and self.teardownAcked == 1):
+				try:
+					self.rtspSocket.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass
 				self.rtspSocket.close()
 				break
 
-	def parseRtspReply(self, data):
-		"""Parse the RTSP reply from the server."""
-		lines = data.split('\n')
-		seqNum = int(lines[1].split(' ')[1])
+	def parseRtspReply(self, reply):
+		"""Parse the RTSP reply (an RtspMessage) from the server."""
+		seqNum = int(reply.cseq())
 
-		# Process only if the server reply's sequence number is the same as the request's
-		if seqNum == self.rtspSeq:
-			session = int(lines[2].split(' ')[1])
+		# Process only if the server reply's sequence number is that of a request sent, pipelined ones are answered in order
+		requestCode = self.pending.pop(seqNum, None)
+		if requestCode is not None:
+			session = int(reply.session() or 0)
 			# New RTSP session ID
 			if self.sessionId == 0:
 				self.sessionId = session
 
 			# Process only if the session ID is the same
 			if self.sessionId == session:
-				if int(lines[0].split(' ')[1]) == 200:
-					if self.requestSent == self.SETUP:
+				if reply.code == 200:
+					if requestCode == self.SETUP:
 						#-------------
 						# TO COMPLETE
 						#-------------
 						# Update RTSP state.
 						self.state = self.READY
+						self.sessionTimeout = reply.sessionTimeout() or self.sessionTimeout
 						# Open RTP port.
 						self.openRtpPort()
 
-					elif self.requestSent == self.PLAY:
+					elif requestCode == self.PLAY:
 						self.state = self.PLAYING
 
-					elif self.requestSent == self.PAUSE:
+					elif requestCode == self.PAUSE:
 						self.state = self.READY
 						# The play thread exits. A new thread is created on resume.
 						self.playEvent.set()
+						self.jitterBuffer.stop()
 
-					elif self.requestSent == self.TEARDOWN:
+					elif requestCode == self.TEARDOWN:
 						self.state = self.INIT
 						# Flag the teardownAcked to close the socket.
 						self.teardownAcked = 1
+						self.jitterBuffer.stop()
+						if self.receiver:
+							self.receiver.stop()
+
+				elif requestCode == self.SETUP:
+					# End the playout thread a fast start began, Setup may then be tried again
+					print("SETUP failed: %d %s" % (reply.code, reply.reason))
+					if self.playEvent is not None:
+						self.playEvent.set()
+					self.jitterBuffer.stop()
 
 	def openRtpPort(self):
 		"""Open RTP socket binded to a specified port."""
 		#-------------
 		# TO COMPLETE
 		#-------------
+		if self.interleaved or self.receiver is not None:
+			return # RTP and RTCP arrive on the RTSP connection, or the port was bound before a fast-start SETUP
 		# Create a new datagram socket to receive RTP packets from the server
 		self.rtpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		# Set the timeout value of the socket to 0.5sec
-		self.rtpSocket.settimeout(0.5)
 		try:
 			# Bind the socket to the address using the RTP port given by the client user
 			self.rtpSocket.bind(('', self.rtpPort))
 		except:
 			tkMessageBox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' %self.rtpPort)
+		# Packets are read into preallocated buffers whenever the socket is readable, for the whole session
+		self.receiver = RtpReceiver(self.rtpSocket, self.handleRtp)
+		threading.Thread(target=self.listenRtp, name='RtpReceiver', daemon=True).start()
+
+		# RTCP reports go through the RTP port + 1
+		self.rtcpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.rtcpSocket.settimeout(0.5)
+		try:
+			self.rtcpSocket.bind(('', self.rtpPort + 1))
+		except:
+			tkMessageBox.showwarning('Unable to Bind', 'Unable to bind PORT=%d' %(self.rtpPort + 1))
+		threading.Thread(target=self.listenRtcp, daemon=True).start()
 
 	def handler(self):
 		"""Handler on explicitly closing the GUI window."""
@@ -8,13 +8,16 @@ if __name__ == "__main__":
 		serverPort = sys.argv[2]
 		rtpPort = sys.argv[3]
 		fileName = sys.argv[4]	
+		options = [arg.lower() for arg in sys.argv[5:]]
+		interleaved = 'tcp' in options
+		fastStart = 'fast' in options # SETUP and PLAY pipelined on launch
 	except:
-		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file]\n")	
+		print("[Usage: ClientLauncher.py Server_name Server_port RTP_port Video_file [tcp] [fast]]\n")	
 	
 	root = Tk()
 
 	# Create a new client
-	app = Client(root, serverAddr, serverPort, rtpPort, fileName)
+	app = Client(root, serverAddr, serverPort, rtpPort, fileName, interleaved, fastStart)
 	app.master.title("RTPClient")	
 	root.mainloop()
 	
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""
+Process-wide LRU cache of frame payloads shared by every session, so viewers of the same file read each frame from disk
+once instead of once per session. The memory limit defaults to 64 MB and can be set with the FRAME_CACHE_MB environment
+variable or frameCache.setLimit().
+"""
+from collections import OrderedDict
+import os, threading
+
+DEFAULT_LIMIT_MB = 64
+
+class FrameCache:
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.frames = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		"""Return the cached frame for key, or None on a miss."""
+		with self.lock:
+			data = self.frames.get(key)
+			if data is None:
+				self.misses += 1
+				return None
+			self.frames.move_to_end(key)
+			self.hits += 1
+			return data
+
+	def peek(self, key):
+		"""Return the cached frame for key, or None, without counting a hit or miss."""
+		with self.lock:
+			data = self.frames.get(key)
+			if data is not None:
+				self.frames.move_to_end(key)
+			return data
+
+	def record(self, hits, misses):
+		"""Count lookups made with peek()."""
+		with self.lock:
+			self.hits += hits
+			self.misses += misses
+
+	def put(self, key, data):
+		"""Cache a frame, evicting the least recently used frames to stay under the limit."""
+		if len(data) > self.maxBytes:
+			return
+		with self.lock:
+			old = self.frames.pop(key, None)
+			if old is not None:
+				self.size -= len(old)
+			self.frames[key] = data
+			self.size += len(data)
+			self.evict()
+
+	def evict(self):
+		"""Drop least recently used frames until under the limit. Called with the lock held."""
+		while self.size > self.maxBytes:
+			_, data = self.frames.popitem(last=False)
+			self.size -= len(data)
+			self.evictions += 1
+
+	def setLimit(self, maxBytes):
+		"""Change the memory limit in bytes."""
+		with self.lock:
+			self.maxBytes = maxBytes
+			self.evict()
+
+	def clear(self):
+		"""Drop every cached frame."""
+		with self.lock:
+			self.frames.clear()
+			self.size = 0
+
+	def stats(self):
+		"""Return the hit/miss counters and memory use."""
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'hitRatio': self.hits / lookups if lookups else 0.0,
+				'evictions': self.evictions,
+				'frames': len(self.frames),
+				'bytes': self.size,
+				'maxBytes': self.maxBytes,
+			}
+
+frameCache = FrameCache(int(float(os.environ.get('FRAME_CACHE_MB', DEFAULT_LIMIT_MB)) * 1024 * 1024))
@@ -0,0 +1,66 @@
+"""
+Off-thread JPEG decoding for the client. Frames are decoded from memory on a worker thread, only the newest one is
+kept, and the Tk main loop picks decoded images up by polling get() from an after() callback, since Tk widgets must
+only be touched from the main thread.
+"""
+from io import BytesIO
+import queue, threading
+
+from PIL import Image
+
+class FrameDecoder:
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.pending = None # Newest undecoded frame
+		self.decoded = queue.Queue(maxsize=1)
+		self.stopped = False
+		self.decodedCount = 0
+		self.skipped = 0 # Frames replaced by a newer one before they were decoded or displayed
+		self.errors = 0
+		self.thread = threading.Thread(target=self.run, name='FrameDecoder', daemon=True)
+		self.thread.start()
+
+	def submit(self, data):
+		"""Queue a JPEG frame for decoding, replacing any frame still waiting."""
+		with self.cond:
+			if self.pending is not None:
+				self.skipped += 1
+			self.pending = data
+			self.cond.notify()
+
+	def get(self):
+		"""Return the newest decoded image, or None if there is nothing new. Never blocks."""
+		try:
+			return self.decoded.get_nowait()
+		except queue.Empty:
+			return None
+
+	def stop(self):
+		"""End the worker thread."""
+		with self.cond:
+			self.stopped = True
+			self.cond.notify()
+
+	def run(self):
+		"""Decode frames as they are submitted."""
+		while True:
+			with self.cond:
+				while self.pending is None and not self.stopped:
+					self.cond.wait()
+				if self.stopped:
+					return
+				data = self.pending
+				self.pending = None
+			try:
+				image = Image.open(BytesIO(data))
+				image.load()
+			except (OSError, ValueError, SyntaxError):
+				self.errors += 1
+				continue
+			try:
+				self.decoded.get_nowait() # Drop the undisplayed older image
+				self.skipped += 1
+			except queue.Empty:
+				pass
+			self.decoded.put(image)
+			self.decodedCount += 1
@@ -0,0 +1,75 @@
+"""
+Server-side temporal thinning. A session whose receiver is falling behind sends fewer frames instead of pushing every
+frame into a path that will drop it: at level n only one frame in 2**n goes out (every 2nd, every 4th...). The level
+steps up on congestion, meaning RTCP receiver reports with loss above LOSS_HIGH or a send backlog (packets dropped
+because the socket buffer is full, or a stream running late), at most once per HOLD_SECONDS. It steps back down after
+RECOVER_SECONDS without any congestion. Sequence numbers stay continuous, so receiver reports keep measuring real loss.
+
+Set THINNING=0 in the environment to always send every frame.
+"""
+import os, time
+
+ENABLED = os.environ.get('THINNING', '1') != '0'
+LOSS_HIGH = 0.05 # Fraction of packets lost in a report interval that counts as congestion
+MAX_LEVEL = 3 # Send at least one frame in 8
+HOLD_SECONDS = 1.0 # Give a level change time to take effect before the next one
+RECOVER_SECONDS = 10.0 # Two RTCP intervals without congestion before stepping back down
+
+class FrameThinner:
+	def __init__(self, stats=None, maxLevel=MAX_LEVEL, enabled=ENABLED):
+		self.senderStats = stats # SenderStats whose receiver reports are watched, if any
+		self.maxLevel = maxLevel
+		self.enabled = enabled
+		self.level = 0
+		self.reports = 0
+		self.congested = False
+		self.lastChange = float('-inf')
+		self.lastCongestion = float('-inf')
+		self.thinned = 0 # Frames skipped so far
+
+	def onCongestion(self, now=None):
+		"""Record a congestion signal, such as a send backlog."""
+		self.congested = True
+		self.lastCongestion = time.monotonic() if now is None else now
+
+	def onSent(self, sent, total, now=None):
+		"""Record the result of sending a frame. Packets the socket could not take mean a send backlog."""
+		if sent < total:
+			self.onCongestion(now)
+
+	def checkReports(self, now):
+		"""Treat a new receiver report with high loss as congestion."""
+		if self.senderStats is not None and self.senderStats.reports != self.reports:
+			self.reports = self.senderStats.reports
+			if self.senderStats.fractionLost > LOSS_HIGH:
+				self.onCongestion(now)
+
+	def update(self, now=None):
+		"""Step the level up on congestion, or down once the session has been clean for RECOVER_SECONDS."""
+		if now is None:
+			now = time.monotonic()
+		self.checkReports(now)
+		if now - self.lastChange < HOLD_SECONDS:
+			return
+		if self.congested:
+			self.congested = False
+			if self.level < self.maxLevel:
+				self.level += 1
+				self.lastChange = now
+		elif self.level > 0 and now - max(self.lastCongestion, self.lastChange) >= RECOVER_SECONDS:
+			self.level -= 1
+			self.lastChange = now
+
+	def sendFrame(self, frameNbr, now=None):
+		"""Return True if frame number frameNbr should be sent at the current level."""
+		if not self.enabled:
+			return True
+		self.update(now)
+		if frameNbr % (1 << self.level) == 0:
+			return True
+		self.thinned += 1
+		return False
+
+	def stats(self):
+		"""Return the thinning level and the number of frames skipped."""
+		return {'level': self.level, 'thinned': self.thinned}
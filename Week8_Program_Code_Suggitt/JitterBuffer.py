@@ -0,0 +1,143 @@
+"""
+Client jitter buffer. Complete frames are held in sequence number order and released on a steady clock derived from
+their RTP timestamps, plus a playout delay that adapts to the RFC 3550 interarrival jitter. Frames that arrive after
+their slot has been played are dropped as late, and empty slots are counted as concealed (the previous frame stays on
+screen) or, when the frame never shows up, as lost.
+"""
+import heapq, threading, time
+
+from RtpPacket import CLOCK_RATE, seqDiff
+
+MIN_DELAY = 0.05 # Seconds of buffering even on a perfect network
+MAX_DELAY = 1.0
+JITTER_MULT = 4 # Playout delay target in multiples of the measured jitter
+DELAY_GAIN = 1 / 8 # How quickly the delay follows its target
+
+class JitterBuffer:
+	def __init__(self, capacity=64, minDelay=MIN_DELAY, maxDelay=MAX_DELAY, clockRate=CLOCK_RATE):
+		self.capacity = capacity
+		self.minDelay = minDelay
+		self.maxDelay = maxDelay
+		self.clockRate = clockRate
+		self.cond = threading.Condition()
+		self.stopped = False
+		self.played = 0
+		self.late = 0
+		self.concealed = 0
+		self.overflow = 0
+		self.jitter = 0.0 # RFC 3550 interarrival jitter, in timestamp units
+		self.reset()
+
+	def reset(self):
+		"""Drop buffered frames and the clock mapping, for example when playback resumes or seeks. Stats are kept."""
+		with self.cond:
+			self.heap = []
+			self.highSeq = None # Highest extended sequence number seen
+			self.highTs = None # Extended timestamp of the last arrival
+			self.offset = None # Minimum of arrival time - media time, maps timestamps to the local clock
+			self.transit = None
+			self.framePeriodTs = None # Smallest timestamp step between frames
+			self.lastSeq = None # Extended sequence number of the last played frame
+			self.lastTs = None
+			self.delay = self.minDelay
+			self.stopped = False
+			self.cond.notify_all()
+
+	def stop(self):
+		"""Wake up and end any pop() in progress."""
+		with self.cond:
+			self.stopped = True
+			self.cond.notify_all()
+
+	def extend(self, value, high, bits):
+		"""Extend a wrapping sequence number or timestamp relative to the highest one seen."""
+		if high is None:
+			return value
+		half = 1 << (bits - 1)
+		mask = (1 << bits) - 1
+		return high + (((value - high + half) & mask) - half)
+
+	def put(self, seqnum, timestamp, frame, arrival=None):
+		"""Add a complete frame, keyed by the sequence number of its first packet. Return False if it was dropped."""
+		if arrival is None:
+			arrival = time.monotonic()
+		with self.cond:
+			extSeq = self.extend(seqnum, self.highSeq, 16)
+			extTs = self.extend(timestamp, self.highTs, 32)
+			if self.lastSeq is not None and extSeq <= self.lastSeq:
+				self.late += 1
+				return False
+
+			# RFC 3550 A.8 interarrival jitter and the clock mapping
+			transit = arrival * self.clockRate - extTs
+			if self.transit is not None:
+				self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+			self.transit = transit
+			if self.offset is None or transit / self.clockRate < self.offset:
+				self.offset = transit / self.clockRate
+			if self.highTs is not None and extTs > self.highTs:
+				step = extTs - self.highTs
+				if self.framePeriodTs is None or step < self.framePeriodTs:
+					self.framePeriodTs = step
+			if self.highSeq is None or seqDiff(seqnum, self.highSeq & 0xffff) > 0:
+				self.highSeq = extSeq
+				self.highTs = extTs
+			target = min(self.maxDelay, max(self.minDelay, JITTER_MULT * self.jitter / self.clockRate))
+			self.delay += (target - self.delay) * DELAY_GAIN
+
+			if len(self.heap) >= self.capacity:
+				heapq.heappop(self.heap) # Full, give up on the oldest frame
+				self.overflow += 1
+			heapq.heappush(self.heap, (extSeq, extTs, frame))
+			self.cond.notify()
+			return True
+
+	def playoutTime(self, extTs):
+		"""Return the local monotonic time a frame with this extended timestamp is due."""
+		return extTs / self.clockRate + self.offset + self.delay
+
+	def pop(self, timeout=None):
+		"""Wait for the next frame's playout time and return it, or None on timeout or stop()."""
+		end = None if timeout is None else time.monotonic() + timeout
+		with self.cond:
+			while not self.stopped:
+				now = time.monotonic()
+				wait = None
+				if self.heap:
+					extSeq, extTs, frame = self.heap[0]
+					due = self.playoutTime(extTs)
+					if due <= now:
+						heapq.heappop(self.heap)
+						self.record(extSeq, extTs)
+						return frame
+					wait = due - now
+				if end is not None:
+					if now >= end:
+						return None
+					wait = end - now if wait is None else min(wait, end - now)
+				self.cond.wait(wait)
+			return None
+
+	def record(self, extSeq, extTs):
+		"""Update the playout stats for a released frame."""
+		if self.lastTs is not None and self.framePeriodTs:
+			missing = round((extTs - self.lastTs) / self.framePeriodTs) - 1
+			if missing > 0:
+				self.concealed += missing
+		self.lastSeq = extSeq
+		self.lastTs = extTs
+		self.played += 1
+
+	def stats(self):
+		"""Return playout counters, the jitter and the playout delay in seconds."""
+		with self.cond:
+			return {
+				'played': self.played,
+				'late': self.late,
+				'concealed': self.concealed,
+				'lost': max(0, self.concealed - self.late),
+				'overflow': self.overflow,
+				'buffered': len(self.heap),
+				'jitter': self.jitter / self.clockRate,
+				'delay': self.delay,
+			}
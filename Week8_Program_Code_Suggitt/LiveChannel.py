@@ -0,0 +1,165 @@
+"""
+Live fan-out. A SETUP for "live/<file>" subscribes the session to a shared LiveChannel instead of opening its own
+VideoStream. One producer, driven by the pacing scheduler, reads and fragments each frame once and sends it to every
+subscriber. The payload buffers are shared; only the 12 byte RTP headers are rewritten in place with each subscriber's
+SSRC and sequence number, so per-frame work grows by one header write and one sendmmsg per viewer.
+
+Multicast subscribers share one destination (LIVE_MULTICAST_GROUP, default 239.255.0.1, on the client's port), which
+receives a single copy of every packet however many viewers have joined it.
+"""
+import os, socket, threading, time
+from random import randint
+
+from VideoStream import VideoStream, FRAME_PERIOD
+from RtpPacket import HEADER_SIZE, packHeader
+from RtpJpeg import fragmentFrameViews, frameTimestamp
+from RtpSender import RtpSender
+from Scheduler import pacer
+from FrameThinner import FrameThinner
+
+LIVE_PREFIX = 'live/'
+MULTICAST_GROUP = os.environ.get('LIVE_MULTICAST_GROUP', '239.255.0.1')
+MULTICAST_TTL = int(os.environ.get('LIVE_MULTICAST_TTL', 1))
+MAX_FRAGMENTS = 256 # Headers allocated up front, grown for a frame with more fragments
+PT_MJPEG = 26
+
+class Subscriber:
+	__slots__ = ('addr', 'ssrc', 'seq', 'stats', 'viewers', 'thinner', 'metrics')
+
+	def __init__(self, addr, ssrc, stats=None, metrics=None):
+		self.addr = addr
+		self.ssrc = ssrc
+		self.seq = randint(0, 0xffff)
+		self.stats = stats
+		self.viewers = 1
+		self.thinner = FrameThinner(stats) if stats is not None else None # Multicast viewers share every frame
+		self.metrics = metrics
+
+class LiveChannel:
+	def __init__(self, fileName):
+		self.fileName = fileName
+		self.videoStream = VideoStream(fileName)
+		self.subscribers = {} # Destination address -> Subscriber
+		self.sessions = 0
+		self.lock = threading.Lock()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+		self.sender = RtpSender(self.sock)
+		self.headers = bytearray(HEADER_SIZE * MAX_FRAGMENTS) # Rewritten in place for every subscriber
+		self.ssrc = randint(0, 0xffffffff) # Used for multicast, where every viewer shares the packets
+		self.streamId = None
+		self.frames = 0
+
+	def subscribe(self, addr, ssrc, stats=None, metrics=None, resume=None):
+		"""Start sending to addr. Return the Subscriber to pass to unsubscribe.
+
+		resume is the Subscriber a paused session had, so its sequence numbers carry on from where they stopped.
+		"""
+		with self.lock:
+			subscriber = self.subscribers.get(addr)
+			if subscriber is not None:
+				subscriber.viewers += 1 # Another viewer of a multicast group
+			else:
+				if resume is not None and resume.addr == addr:
+					subscriber = resume
+					subscriber.viewers = 1
+				else:
+					subscriber = Subscriber(addr, ssrc, stats, metrics)
+				self.subscribers[addr] = subscriber
+			if self.streamId is None:
+				self.streamId = pacer.add(self.sendFrame, FRAME_PERIOD)
+			return subscriber
+
+	def subscribeMulticast(self, port, resume=None):
+		"""Start sending to the multicast group on port. Return the Subscriber and the group address."""
+		return self.subscribe((MULTICAST_GROUP, port), self.ssrc, resume=resume), MULTICAST_GROUP
+
+	def unsubscribe(self, subscriber):
+		"""Stop sending to a subscriber. The producer stops with the last one."""
+		with self.lock:
+			subscriber.viewers -= 1
+			if subscriber.viewers <= 0 and self.subscribers.get(subscriber.addr) is subscriber:
+				del self.subscribers[subscriber.addr]
+			if not self.subscribers and self.streamId is not None:
+				pacer.remove(self.streamId)
+				self.streamId = None
+
+	def sendFrame(self):
+		"""Read and fragment the next frame once, then send it to every subscriber. Loops at the end of the file."""
+		try:
+			data = self.videoStream.nextFrame()
+			if not data:
+				self.videoStream.seek(0)
+				data = self.videoStream.nextFrame()
+		except ValueError: # Closed by the last session leaving
+			return False
+		if not data:
+			return False
+		self.frames += 1
+		timestamp = frameTimestamp(self.frames, FRAME_PERIOD)
+		payloads = fragmentFrameViews(data)
+		if len(payloads) * HEADER_SIZE > len(self.headers):
+			self.headers = bytearray(HEADER_SIZE * len(payloads))
+		headers = memoryview(self.headers)
+		packets = [[headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE]] + payload for i, payload in enumerate(payloads)]
+		last = len(payloads) - 1
+		with self.lock:
+			subscribers = list(self.subscribers.values())
+		for subscriber in subscribers:
+			thinner = subscriber.thinner
+			if thinner is not None and not thinner.sendFrame(self.frames):
+				if subscriber.metrics is not None:
+					subscriber.metrics.onThinned()
+				continue
+			for i in range(len(payloads)):
+				packHeader(self.headers, i * HEADER_SIZE, 2, 0, 0, 0, subscriber.seq + i, 1 if i == last else 0,
+					PT_MJPEG, timestamp, subscriber.ssrc)
+			sendStart = time.perf_counter()
+			try:
+				sent = self.sender.sendBatch(packets, subscriber.addr)
+			except OSError:
+				sent = 0
+			if subscriber.metrics is not None:
+				subscriber.metrics.onFrame(sent, len(data), time.perf_counter() - sendStart, 0.0)
+			if thinner is not None:
+				thinner.onSent(sent, len(packets))
+			subscriber.seq = (subscriber.seq + len(payloads)) & 0xffff
+			if subscriber.stats is not None:
+				subscriber.stats.onSend(len(payloads), len(data), timestamp)
+		return True
+
+	def close(self):
+		"""Stop producing and release the file and socket."""
+		with self.lock:
+			if self.streamId is not None:
+				pacer.remove(self.streamId)
+				self.streamId = None
+			self.subscribers.clear()
+		self.videoStream.close()
+		self.sock.close()
+
+channels = {}
+channelsLock = threading.Lock()
+
+def isLive(fileName):
+	"""Return True if a SETUP file name asks for the live feed."""
+	return fileName.startswith(LIVE_PREFIX)
+
+def openChannel(fileName):
+	"""Return the live channel for a "live/<file>" name, creating it for its first session. Raises IOError."""
+	name = fileName[len(LIVE_PREFIX):]
+	with channelsLock:
+		channel = channels.get(name)
+		if channel is None:
+			channel = LiveChannel(name)
+			channels[name] = channel
+		channel.sessions += 1
+		return channel
+
+def closeChannel(channel):
+	"""Release a session's hold on a channel, closing it with the last session."""
+	with channelsLock:
+		channel.sessions -= 1
+		if channel.sessions <= 0:
+			channels.pop(channel.fileName, None)
+			channel.close()
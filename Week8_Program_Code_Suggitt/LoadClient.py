@@ -0,0 +1,226 @@
+"""
+Headless load generator for Server.py and AsyncServer.py. Opens N concurrent RTSP sessions from one event loop, runs
+SETUP, PLAY, PAUSE, PLAY, TEARDOWN on each and counts the RTP packets received without decoding them. Reports per
+session throughput, packet loss, startup latency (PLAY sent to first RTP packet) and RTSP response times.
+
+With "fast" the sessions fast-start instead: SETUP and PLAY are sent in one write, and the startup latency is the
+time-to-first-frame from the SETUP.
+
+Usage: LoadClient.py Server_name Server_port Base_RTP_port Video_file Sessions [Duration_seconds] [fast]
+Session i receives RTP on Base_RTP_port + 2*i, leaving the odd port for RTCP.
+"""
+from collections import deque
+import sys, asyncio, time
+
+from RtpPacket import RTP_HEADER
+from Rtcp import ReceiverStats
+from RtspParser import RtspParser, RtspMessage, formatRequest
+
+RAMP_SECONDS = 0.005 # Delay between session starts so the listen backlog is not flooded
+PAUSE_SECONDS = 0.5
+REPLY_TIMEOUT = 10.0
+
+class RtpCounter(asyncio.DatagramProtocol):
+	"""Counts RTP packets from their headers only."""
+
+	def __init__(self, session):
+		self.session = session
+
+	def datagram_received(self, data, addr):
+		if len(data) < RTP_HEADER.size:
+			return
+		arrival = time.time()
+		session = self.session
+		if session.firstPacket is None:
+			session.firstPacket = time.monotonic()
+		first, second, seq, timestamp, ssrc = RTP_HEADER.unpack_from(data)
+		session.stats.update(seq, timestamp, ssrc, len(data), arrival)
+
+class LoadSession:
+	def __init__(self, serverAddr, serverPort, rtpPort, fileName, fastStart=False):
+		self.serverAddr = serverAddr
+		self.serverPort = serverPort
+		self.rtpPort = rtpPort
+		self.fileName = fileName
+		self.fastStart = fastStart
+		self.rtspSeq = 0
+		self.parser = RtspParser()
+		self.replies = deque() # Replies read but not yet waited for, pipelined requests get several at once
+		self.sessionId = 0
+		self.stats = ReceiverStats()
+		self.responseTimes = []
+		self.playStart = None
+		self.firstPacket = None
+		self.playingTime = 0.0
+		self.error = None
+		self.timeout = None # Session timeout announced by the server
+
+	async def request(self, reader, writer, method):
+		"""Send an RTSP request and wait for its reply. Return the status code."""
+		self.rtspSeq += 1
+		if method == 'SETUP':
+			headers = [('Transport', 'RTP/UDP; client_port= ' + str(self.rtpPort))]
+		else:
+			headers = [('Session', self.sessionId)]
+		sent = time.monotonic()
+		writer.write(formatRequest(method, self.fileName, self.rtspSeq, headers))
+		reply = await asyncio.wait_for(self.readReply(reader), REPLY_TIMEOUT)
+		self.responseTimes.append(time.monotonic() - sent)
+		if method == 'SETUP' and reply.code == 200:
+			self.sessionId = int(reply.session())
+			self.timeout = reply.sessionTimeout()
+		return reply.code
+
+	async def readReply(self, reader):
+		"""Read until the parser has a complete reply."""
+		while not self.replies:
+			data = await reader.read(4096)
+			if not data:
+				raise ConnectionError('Connection closed by the server')
+			self.replies.extend(item for item in self.parser.feed(data) if isinstance(item, RtspMessage))
+		return self.replies.popleft()
+
+	async def setupAndPlay(self, reader, writer):
+		"""Send SETUP and PLAY in one write, the PLAY without a Session header. Return the PLAY status code."""
+		self.rtspSeq += 2
+		sent = time.monotonic()
+		self.playStart = sent
+		writer.write(formatRequest('SETUP', self.fileName, self.rtspSeq - 1, [('Transport', 'RTP/UDP; client_port= ' + str(self.rtpPort))])
+			+ formatRequest('PLAY', self.fileName, self.rtspSeq))
+		setup = await asyncio.wait_for(self.readReply(reader), REPLY_TIMEOUT)
+		self.responseTimes.append(time.monotonic() - sent)
+		play = await asyncio.wait_for(self.readReply(reader), REPLY_TIMEOUT)
+		self.responseTimes.append(time.monotonic() - sent)
+		if setup.code != 200:
+			return setup.code
+		self.sessionId = int(setup.session())
+		self.timeout = setup.sessionTimeout()
+		return play.code
+
+	async def play(self, reader, writer, seconds):
+		"""PLAY for a number of seconds."""
+		start = time.monotonic()
+		if self.playStart is None:
+			self.playStart = start
+		await self.request(reader, writer, 'PLAY')
+		await self.hold(reader, writer, seconds)
+		self.playingTime += time.monotonic() - start
+
+	async def hold(self, reader, writer, seconds):
+		"""Wait a number of seconds, sending a GET_PARAMETER keep-alive every half session timeout."""
+		end = time.monotonic() + seconds
+		while True:
+			remaining = end - time.monotonic()
+			if not self.timeout or remaining <= self.timeout / 2:
+				await asyncio.sleep(max(0.0, remaining))
+				return
+			await asyncio.sleep(self.timeout / 2)
+			await self.request(reader, writer, 'GET_PARAMETER')
+
+	async def run(self, duration):
+		"""Run one full session."""
+		loop = asyncio.get_running_loop()
+		transport = None
+		writer = None
+		try:
+			transport, _ = await loop.create_datagram_endpoint(lambda: RtpCounter(self), local_addr=('0.0.0.0', self.rtpPort))
+			reader, writer = await asyncio.open_connection(self.serverAddr, self.serverPort)
+			if self.fastStart:
+				start = time.monotonic()
+				code = await self.setupAndPlay(reader, writer)
+				if code != 200:
+					raise ConnectionError('Fast start failed with ' + str(code))
+				await self.hold(reader, writer, duration / 2)
+				self.playingTime += time.monotonic() - start
+			else:
+				code = await self.request(reader, writer, 'SETUP')
+				if code != 200:
+					raise ConnectionError('SETUP failed with ' + str(code))
+				await self.play(reader, writer, duration / 2)
+			await self.request(reader, writer, 'PAUSE')
+			await self.hold(reader, writer, PAUSE_SECONDS)
+			await self.play(reader, writer, duration / 2)
+			await self.request(reader, writer, 'TEARDOWN')
+		except (OSError, asyncio.TimeoutError, ValueError, IndexError) as err:
+			self.error = repr(err)
+		finally:
+			if writer:
+				writer.close()
+			if transport:
+				transport.close()
+
+	def startupLatency(self):
+		"""Return the seconds from the first PLAY (the SETUP when fast-starting) to the first RTP packet, or None."""
+		if self.playStart is None or self.firstPacket is None:
+			return None
+		return self.firstPacket - self.playStart
+
+	def summary(self):
+		"""Return the per session results."""
+		stats = self.stats.stats()
+		return {
+			'rtpPort': self.rtpPort,
+			'packets': stats['received'],
+			'lost': max(0, stats['lost']),
+			'lossRate': max(0, stats['lost']) / stats['expected'] if stats['expected'] else 0.0,
+			'mbps': stats['octets'] * 8 / self.playingTime / 1e6 if self.playingTime else 0.0,
+			'jitter': stats['jitter'],
+			'startup': self.startupLatency(),
+			'response': sum(self.responseTimes) / len(self.responseTimes) if self.responseTimes else None,
+			'error': self.error,
+		}
+
+def percentile(values, pct):
+	"""Return the pct percentile of a list of numbers, or None if it is empty."""
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def ms(value):
+	"""Format seconds as milliseconds."""
+	return '-' if value is None else '%.1f' % (value * 1000)
+
+async def runLoad(serverAddr, serverPort, basePort, fileName, count, duration, fastStart=False):
+	"""Run count sessions concurrently and return them."""
+	sessions = [LoadSession(serverAddr, serverPort, basePort + 2 * i, fileName, fastStart) for i in range(count)]
+	tasks = []
+	for session in sessions:
+		tasks.append(asyncio.create_task(session.run(duration)))
+		await asyncio.sleep(RAMP_SECONDS)
+	await asyncio.gather(*tasks)
+	return sessions
+
+def report(sessions):
+	"""Print per session results and the totals."""
+	print('%-8s %8s %6s %7s %8s %10s %10s %s' % ('rtpPort', 'packets', 'lost', 'loss%', 'Mbit/s', 'startupMs', 'rtspMs', 'error'))
+	results = [session.summary() for session in sessions]
+	for r in results:
+		print('%-8d %8d %6d %7.2f %8.2f %10s %10s %s' % (r['rtpPort'], r['packets'], r['lost'], r['lossRate'] * 100,
+			r['mbps'], ms(r['startup']), ms(r['response']), r['error'] or ''))
+	startups = [r['startup'] for r in results if r['startup'] is not None]
+	responses = [t for session in sessions for t in session.responseTimes]
+	packets = sum(r['packets'] for r in results)
+	lost = sum(r['lost'] for r in results)
+	print()
+	print('sessions: %d, failed: %d' % (len(results), sum(1 for r in results if r['error'])))
+	print('packets: %d, lost: %d (%.2f%%)' % (packets, lost, lost * 100 / (packets + lost) if packets + lost else 0))
+	print('throughput: %.2f Mbit/s total' % sum(r['mbps'] for r in results))
+	print('startup ms: median %s, p95 %s, max %s' % (ms(percentile(startups, 50)), ms(percentile(startups, 95)),
+		ms(max(startups) if startups else None)))
+	print('RTSP response ms: median %s, p95 %s, max %s' % (ms(percentile(responses, 50)), ms(percentile(responses, 95)),
+		ms(max(responses) if responses else None)))
+
+if __name__ == "__main__":
+	try:
+		serverAddr = sys.argv[1]
+		serverPort = int(sys.argv[2])
+		basePort = int(sys.argv[3])
+		fileName = sys.argv[4]
+		count = int(sys.argv[5])
+		duration = float(sys.argv[6]) if len(sys.argv) > 6 else 10.0
+		fastStart = len(sys.argv) > 7 and sys.argv[7].lower() == 'fast'
+	except:
+		print("[Usage: LoadClient.py Server_name Server_port Base_RTP_port Video_file Sessions [Duration_seconds] [fast]]\n")
+		sys.exit(1)
+	report(asyncio.run(runLoad(serverAddr, serverPort, basePort, fileName, count, duration, fastStart)))
@@ -0,0 +1,229 @@
+"""
+Server metrics. Counters, gauges and histograms are attribute updates under a lock of their own, cheap enough for the
+per-frame send path and safe from the several sending threads, and are kept both per session (labelled session="id",
+dropped when the session ends) and for the whole server. The registry renders them in the Prometheus text exposition
+format, served over HTTP on 127.0.0.1:METRICS_PORT/metrics (default 9450, 0 turns it off).
+"""
+import bisect, os, threading, logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Scheduler import pacer
+from FrameCache import frameCache
+from ReadAhead import reader
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9450))
+METHODS = ('OPTIONS', 'SETUP', 'PLAY', 'PAUSE', 'TEARDOWN', 'GET_PARAMETER')
+log = logging.getLogger('Metrics')
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Counter:
+	__slots__ = ('value', 'lock')
+
+	def __init__(self):
+		self.value = 0
+		self.lock = threading.Lock()
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+
+class Gauge:
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0
+
+	def set(self, value):
+		self.value = value
+
+class Histogram:
+	__slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[index] += 1
+			self.sum += value
+			self.count += 1
+
+	def snapshot(self):
+		"""Return (counts, sum, count) as of one moment."""
+		with self.lock:
+			return list(self.counts), self.sum, self.count
+
+class Registry:
+	def __init__(self):
+		self.families = {} # Name -> [type, help, {label tuple: metric}]
+		self.callbacks = [] # (name, type, help, function returning the value)
+		self.lock = threading.Lock()
+
+	def metric(self, kind, factory, name, help, labels):
+		"""Return the metric for a name and labels, creating it on first use."""
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.families.setdefault(name, [kind, help, {}])
+			metric = family[2].get(key)
+			if metric is None:
+				metric = family[2][key] = factory()
+			return metric
+
+	def counter(self, name, help, **labels):
+		return self.metric('counter', Counter, name, help, labels)
+
+	def gauge(self, name, help, **labels):
+		return self.metric('gauge', Gauge, name, help, labels)
+
+	def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+		return self.metric('histogram', lambda: Histogram(buckets), name, help, labels)
+
+	def callback(self, name, kind, help, function):
+		"""Report the value of function() under name, for values that are already kept elsewhere."""
+		with self.lock:
+			self.callbacks.append((name, kind, help, function))
+
+	def remove(self, **labels):
+		"""Drop every metric carrying these labels, such as a finished session's."""
+		wanted = set(labels.items())
+		with self.lock:
+			for family in self.families.values():
+				for key in [key for key in family[2] if wanted <= set(key)]:
+					del family[2][key]
+
+	def render(self):
+		"""Return every metric in the Prometheus text format."""
+		lines = []
+		with self.lock:
+			families = [(name, kind, help, list(metrics.items()))
+				for name, (kind, help, metrics) in sorted(self.families.items())]
+			callbacks = list(self.callbacks)
+		for name, kind, help, metrics in families:
+			lines.append('# HELP %s %s' % (name, help))
+			lines.append('# TYPE %s %s' % (name, kind))
+			for key, metric in metrics:
+				if kind == 'histogram':
+					counts, total, observed = metric.snapshot()
+					cumulative = 0
+					for bound, count in zip(metric.buckets + ('+Inf',), counts):
+						cumulative += count
+						lines.append('%s_bucket%s %d' % (name, formatLabels(key + (('le', str(bound)),)), cumulative))
+					lines.append('%s_sum%s %r' % (name, formatLabels(key), total))
+					lines.append('%s_count%s %d' % (name, formatLabels(key), observed))
+				else:
+					lines.append('%s%s %r' % (name, formatLabels(key), metric.value))
+		for name, kind, help, function in callbacks:
+			lines.append('# HELP %s %s' % (name, help))
+			lines.append('# TYPE %s %s' % (name, kind))
+			lines.append('%s %r' % (name, function()))
+		return '\n'.join(lines) + '\n'
+
+def formatLabels(key):
+	"""Return {name="value",...} for a label tuple, or nothing without labels."""
+	if not key:
+		return ''
+	return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+		for name, value in key) + '}'
+
+registry = Registry()
+
+# Server-wide metrics
+sessionsTotal = registry.counter('rtsp_sessions_total', 'RTSP sessions set up')
+framesSent = registry.counter('rtp_frames_sent_total', 'Video frames sent')
+packetsSent = registry.counter('rtp_packets_sent_total', 'RTP packets sent')
+bytesSent = registry.counter('rtp_payload_bytes_sent_total', 'Frame bytes sent')
+framesThinned = registry.counter('rtp_frames_thinned_total', 'Frames skipped by congestion thinning')
+sendLatency = registry.histogram('rtp_send_seconds', 'Time spent in the send call for one frame')
+pacingLateness = registry.histogram('rtp_pacing_lateness_seconds', 'Delay between a frame deadline and its send')
+registry.callback('pacer_streams_active', 'gauge', 'Streams on the pacing scheduler', pacer.activeCount)
+registry.callback('pacer_wakeups_total', 'counter', 'Pacing scheduler wakeups', lambda: pacer.wakeups)
+registry.callback('pacer_batches_total', 'counter', 'Pacing scheduler wakeups that sent at least one stream',
+	lambda: pacer.batches)
+registry.callback('pacer_periods_skipped_total', 'counter', 'Frame periods skipped by streams that fell behind',
+	lambda: pacer.skipped)
+registry.callback('frame_cache_hits_total', 'counter', 'Frame cache hits', lambda: frameCache.hits)
+registry.callback('frame_cache_misses_total', 'counter', 'Frame cache misses', lambda: frameCache.misses)
+registry.callback('frame_cache_bytes', 'gauge', 'Bytes held by the frame cache', lambda: frameCache.size)
+registry.callback('read_ahead_hits_total', 'counter', 'Frames sent from a read-ahead window', lambda: reader.hits)
+registry.callback('read_ahead_misses_total', 'counter', 'Frames read on the sending thread', lambda: reader.misses)
+registry.callback('read_ahead_fills_total', 'counter', 'Read-ahead window refills', lambda: reader.fills)
+registry.callback('read_ahead_queued', 'gauge', 'Streams waiting for a refill', lambda: len(reader.queue))
+
+def responseTime(method):
+	"""Return the RTSP response time histogram of a request method."""
+	if method not in METHODS:
+		method = 'OTHER' # Keep unknown methods from creating a series each
+	return registry.histogram('rtsp_response_seconds', 'Time from receiving an RTSP request to sending its reply',
+		method=method)
+
+class SessionMetrics:
+	"""The metrics of one streaming session. Everything is also added to the server-wide totals."""
+	__slots__ = ('session', 'frames', 'packets', 'bytes', 'thinned', 'lateness')
+
+	def __init__(self, session):
+		self.session = str(session)
+		self.frames = registry.counter('rtp_session_frames_sent_total', 'Video frames sent per session',
+			session=self.session)
+		self.packets = registry.counter('rtp_session_packets_sent_total', 'RTP packets sent per session',
+			session=self.session)
+		self.bytes = registry.counter('rtp_session_payload_bytes_sent_total', 'Frame bytes sent per session',
+			session=self.session)
+		self.thinned = registry.counter('rtp_session_frames_thinned_total', 'Frames skipped by thinning per session',
+			session=self.session)
+		self.lateness = registry.gauge('rtp_session_pacing_lateness_seconds',
+			'Pacing lateness of the last frame per session', session=self.session)
+		sessionsTotal.inc()
+
+	def onFrame(self, packets, octets, sendSeconds, lateness):
+		"""Record one frame sent."""
+		self.frames.inc()
+		self.packets.inc(packets)
+		self.bytes.inc(octets)
+		self.lateness.set(lateness)
+		framesSent.inc()
+		packetsSent.inc(packets)
+		bytesSent.inc(octets)
+		sendLatency.observe(sendSeconds)
+		pacingLateness.observe(max(0.0, lateness))
+
+	def onThinned(self):
+		"""Record one frame skipped by thinning."""
+		self.thinned.inc()
+		framesThinned.inc()
+
+	def close(self):
+		"""Drop the session's own metrics, the server totals keep what it sent."""
+		registry.remove(session=self.session)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		body = registry.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass # Scrapes are not worth a log line each
+
+def startServer(port=METRICS_PORT):
+	"""Serve /metrics on 127.0.0.1:port from a background thread. Return the server, or None if port is 0."""
+	if not port:
+		return None
+	try:
+		server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+	except OSError as err:
+		log.warning('Metrics endpoint not started on port %d: %s', port, err)
+		return None
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+	return server
@@ -0,0 +1,108 @@
+"""
+Serving of pre-packetized streams. Packetize.py converts a .Mjpeg file into a container of ready-to-send RTP packets
+(RTP header, RFC 2435 header and payload) behind fixed-width frame and packet indexes:
+
+	file header   magic, version, MTU, frame period in microseconds, frame count, packet count, most packets per frame
+	frame index   frame count entries of (first packet, packet count, frame bytes)
+	packet index  packet count entries of (file offset, packet length)
+	packets
+
+PacketStream memory-maps the container and has the VideoStream interface for seeking and timing. Instead of frame
+bytes it returns a frame's packets as [RTP header, payload] buffer pairs for RtpSender: the headers are written into one
+buffer owned by the stream with the session's sequence numbers and SSRC, and the payloads are views of the mapping, so
+no frame is parsed, fragmented or copied.
+"""
+import mmap, struct
+
+from RtpPacket import RTP_HEADER, HEADER_SIZE
+
+CONTAINER_EXT = '.rtpk'
+MAGIC = b'RTPK'
+VERSION = 1
+FILE_HEADER = struct.Struct('!4sHHIIII')
+FRAME_ENTRY = struct.Struct('!III')
+PACKET_ENTRY = struct.Struct('!QI')
+
+def isPacketized(filename):
+	"""Return True if a file name is a packetized container."""
+	return filename.endswith(CONTAINER_EXT)
+
+class PacketStream:
+	def __init__(self, filename):
+		self.filename = filename
+		try:
+			self.file = open(filename, 'rb')
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError): # ValueError for an empty file
+			raise IOError
+		self.view = memoryview(self.map)
+		try:
+			magic, version, self.mtu, periodUs, frames, packets, self.maxPackets = FILE_HEADER.unpack_from(self.view)
+		except struct.error:
+			magic = version = None
+		if magic != MAGIC or version != VERSION:
+			self.close()
+			raise IOError
+		self.framePeriod = periodUs / 1e6
+		self.frames = frames
+		self.frameIndex = FILE_HEADER.size
+		self.packetIndex = self.frameIndex + frames * FRAME_ENTRY.size
+		self.headers = bytearray(HEADER_SIZE * max(self.maxPackets, 1))
+		self.headerView = memoryview(self.headers)
+		self.frameNum = 0
+
+	def framePackets(self, frameNbr, seqnum, ssrc):
+		"""Return (packets, frame bytes, timestamp) for a 0-based frame, numbered from seqnum for stream ssrc.
+
+		The packets use this stream's header buffer, so they must be sent before the next call.
+		"""
+		first, count, frameBytes = FRAME_ENTRY.unpack_from(self.view, self.frameIndex + frameNbr * FRAME_ENTRY.size)
+		packets = []
+		timestamp = 0
+		for i in range(count):
+			offset, length = PACKET_ENTRY.unpack_from(self.view, self.packetIndex + (first + i) * PACKET_ENTRY.size)
+			flags, markerPt, _, timestamp, _ = RTP_HEADER.unpack_from(self.view, offset)
+			RTP_HEADER.pack_into(self.headers, i * HEADER_SIZE, flags, markerPt, (seqnum + i) & 0xffff, timestamp, ssrc)
+			packets.append([self.headerView[i * HEADER_SIZE:(i + 1) * HEADER_SIZE], self.view[offset + HEADER_SIZE:offset + length]])
+		return packets, frameBytes, timestamp
+
+	def nextPackets(self, seqnum, ssrc):
+		"""Return the packets of the next frame like framePackets, or None at the end."""
+		if self.frameNum >= self.frames:
+			return None
+		self.frameNum += 1
+		return self.framePackets(self.frameNum - 1, seqnum, ssrc)
+
+	def seek(self, frameNbr):
+		"""Make frameNbr (0-based) the next frame returned by nextPackets."""
+		self.frameNum = max(0, min(frameNbr, self.frames))
+
+	def seekTime(self, seconds):
+		"""Make the frame playing at a time in seconds the next frame returned by nextPackets."""
+		self.seek(int(seconds / self.framePeriod))
+
+	def frameNbr(self):
+		"""Get frame number."""
+		return self.frameNum
+
+	def frameCount(self):
+		"""Get the total number of frames."""
+		return self.frames
+
+	def duration(self):
+		"""Get the total duration in seconds."""
+		return self.frames * self.framePeriod
+
+	def position(self):
+		"""Get the time in seconds of the next frame."""
+		return self.frameNum * self.framePeriod
+
+	def close(self):
+		"""Unmap and close the file. Views still held elsewhere keep the mapping alive until they are released."""
+		self.headerView.release()
+		self.view.release()
+		try:
+			self.map.close()
+		except BufferError:
+			pass
+		self.file.close()
@@ -0,0 +1,74 @@
+"""
+Offline packetizer. Converts a .Mjpeg file into the pre-packetized container served by PacketStream (see its docstring
+for the layout), so the servers send frames without reading, fragmenting or copying them. The stored RTP headers have
+sequence number and SSRC 0; the server patches in its own for each session.
+
+Packets are written out one frame at a time. The frame and packet counts follow from the frame lengths in the
+VideoStream index, so space for both indexes is reserved up front and the packet index is filled in at the end.
+
+Usage: Packetize.py Video_file [Output_file] [MTU]
+The output defaults to Video_file + .rtpk, which is the name a client then asks for.
+"""
+import sys
+
+from VideoStream import VideoStream, FRAME_PERIOD
+from RtpPacket import RTP_HEADER
+from RtpJpeg import fragmentFrameViews, fragmentCount, frameTimestamp, DEFAULT_MTU
+from PacketStream import CONTAINER_EXT, MAGIC, VERSION, FILE_HEADER, FRAME_ENTRY, PACKET_ENTRY
+
+PT_MJPEG = 26
+
+def packetize(source, target=None, mtu=DEFAULT_MTU, framePeriod=FRAME_PERIOD):
+	"""Write the container for a .Mjpeg file. Return (output file, frames, packets)."""
+	if target is None:
+		target = source + CONTAINER_EXT
+	videoStream = VideoStream(source, cache=None, readAhead=0)
+	try:
+		frameCount = videoStream.frameCount()
+		counts = [fragmentCount(videoStream.index[2 * frameNbr + 1], mtu) for frameNbr in range(frameCount)]
+		packetCount = sum(counts)
+		packetIndex = bytearray(packetCount * PACKET_ENTRY.size) # Filled in as the packets are written
+		offset = FILE_HEADER.size + frameCount * FRAME_ENTRY.size + len(packetIndex)
+		with open(target, 'wb') as f:
+			f.write(FILE_HEADER.pack(MAGIC, VERSION, mtu, int(round(framePeriod * 1e6)), frameCount, packetCount,
+				max(counts or [0])))
+			first = 0
+			for frameNbr, count in enumerate(counts):
+				f.write(FRAME_ENTRY.pack(first, count, videoStream.index[2 * frameNbr + 1]))
+				first += count
+			f.write(packetIndex)
+
+			packetNbr = 0
+			for frameNbr in range(frameCount):
+				data = videoStream.getFrame(frameNbr)
+				timestamp = frameTimestamp(frameNbr + 1, framePeriod) # The servers count frames from 1
+				payloads = fragmentFrameViews(data, mtu)
+				for i, payload in enumerate(payloads):
+					marker = 1 if i == len(payloads) - 1 else 0
+					buffers = [RTP_HEADER.pack(2 << 6, marker << 7 | PT_MJPEG, 0, timestamp, 0)] + payload
+					length = sum(len(buf) for buf in buffers)
+					f.writelines(buffers)
+					PACKET_ENTRY.pack_into(packetIndex, packetNbr * PACKET_ENTRY.size, offset, length)
+					offset += length
+					packetNbr += 1
+
+			f.seek(FILE_HEADER.size + frameCount * FRAME_ENTRY.size)
+			f.write(packetIndex)
+	finally:
+		videoStream.close()
+	return target, frameCount, packetCount
+
+if __name__ == "__main__":
+	try:
+		source = sys.argv[1]
+		target = sys.argv[2] if len(sys.argv) > 2 else None
+		mtu = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_MTU
+	except:
+		print("[Usage: Packetize.py Video_file [Output_file] [MTU]]\n")
+		sys.exit(1)
+	try:
+		target, frames, packets = packetize(source, target, mtu)
+	except IOError:
+		print("Cannot read " + source)
+		sys.exit(1)
+	print("%s: %d frames, %d packets" % (target, frames, packets))
@@ -0,0 +1,48 @@
+"""
+One background reader thread that keeps every VideoStream's upcoming frames in memory, so the threads sending RTP never
+wait on the disk. A stream asks for a refill whenever it hands out a frame or seeks; the reader then calls its fill()
+method, which reads the frames missing from its window in large sequential preads. The window is READ_AHEAD frames
+(default 16, 0.8 s of video; 0 reads on the sending thread as before).
+"""
+from collections import deque
+import logging, os, threading
+
+READ_AHEAD = int(os.environ.get('READ_AHEAD', 16))
+log = logging.getLogger('ReadAhead')
+
+class ReadAhead:
+	def __init__(self):
+		self.queue = deque()
+		self.queued = set()
+		self.cond = threading.Condition()
+		self.thread = None
+		self.hits = 0 # Frames handed out from a window
+		self.misses = 0 # Frames the sending thread had to read itself
+		self.fills = 0
+
+	def request(self, stream):
+		"""Schedule stream.fill() on the reader thread, unless it is already waiting for one."""
+		with self.cond:
+			if stream in self.queued:
+				return
+			self.queued.add(stream)
+			self.queue.append(stream)
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, name='ReadAhead', daemon=True)
+				self.thread.start()
+			self.cond.notify()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.queue:
+					self.cond.wait()
+				stream = self.queue.popleft()
+				self.queued.discard(stream)
+			try:
+				stream.fill()
+				self.fills += 1
+			except Exception:
+				log.exception('Read-ahead fill failed')
+
+reader = ReadAhead()
@@ -0,0 +1,335 @@
+"""
+RTCP sender and receiver reports (RFC 3550 section 6.4) sent on the RTP port + 1.
+
+The client keeps a ReceiverStats per stream, updated for every RTP packet, and sends receiver reports carrying its
+cumulative loss, fraction lost and interarrival jitter. The server keeps a SenderStats per session, sends sender
+reports, and works out the round-trip time from the LSR/DLSR fields of the receiver reports it gets back. Every server
+session shares one RtcpChannel socket; reports are matched to sessions by SSRC.
+"""
+import selectors, socket, struct, threading, time
+
+from RtpPacket import CLOCK_RATE, seqDiff
+
+RTCP_INTERVAL = 5.0 # Seconds between reports, the RFC 3550 minimum
+RTCP_VERSION = 2
+PT_SR = 200
+PT_RR = 201
+NTP_OFFSET = 2208988800 # Seconds from 1900 (NTP epoch) to 1970 (Unix epoch)
+
+COMMON_HEADER = struct.Struct('!BBH') # V/P/RC, packet type, length in 32-bit words - 1
+SR_INFO = struct.Struct('!IIIIII') # SSRC, NTP seconds, NTP fraction, RTP timestamp, packet count, octet count
+RR_INFO = struct.Struct('!I') # SSRC of the reporter
+REPORT_BLOCK = struct.Struct('!IIIIII') # SSRC, fraction lost/cumulative lost, highest seq, jitter, LSR, DLSR
+
+def ntpTime(now=None):
+	"""Return the 64-bit NTP timestamp of a time.time() value."""
+	if now is None:
+		now = time.time()
+	return int((now + NTP_OFFSET) * (1 << 32)) & 0xffffffffffffffff
+
+def ntpMiddle(ntp):
+	"""Return the middle 32 bits of an NTP timestamp, the unit of LSR and DLSR (1/65536 s)."""
+	return (ntp >> 16) & 0xffffffff
+
+class ReportBlock:
+	__slots__ = ('ssrc', 'fractionLost', 'cumulativeLost', 'highestSeq', 'jitter', 'lsr', 'dlsr')
+
+	def __init__(self, ssrc, fractionLost, cumulativeLost, highestSeq, jitter, lsr, dlsr):
+		self.ssrc = ssrc
+		self.fractionLost = fractionLost # 8-bit fixed point fraction, lost / expected * 256
+		self.cumulativeLost = cumulativeLost
+		self.highestSeq = highestSeq # Extended highest sequence number received
+		self.jitter = jitter # In timestamp units
+		self.lsr = lsr
+		self.dlsr = dlsr
+
+	def pack(self):
+		"""Return the 24 byte report block."""
+		lost = max(-0x800000, min(self.cumulativeLost, 0x7fffff)) & 0xffffff
+		return REPORT_BLOCK.pack(self.ssrc, self.fractionLost << 24 | lost, self.highestSeq & 0xffffffff,
+			int(self.jitter) & 0xffffffff, self.lsr, self.dlsr)
+
+	@classmethod
+	def unpack(cls, data, offset):
+		"""Read a report block from data at offset."""
+		ssrc, lost, highestSeq, jitter, lsr, dlsr = REPORT_BLOCK.unpack_from(data, offset)
+		cumulativeLost = lost & 0xffffff
+		if cumulativeLost & 0x800000:
+			cumulativeLost -= 0x1000000
+		return cls(ssrc, lost >> 24, cumulativeLost, highestSeq, jitter, lsr, dlsr)
+
+def packSenderReport(ssrc, ntp, rtpTimestamp, packets, octets, blocks=()):
+	"""Return an RTCP SR packet."""
+	length = (COMMON_HEADER.size + SR_INFO.size + REPORT_BLOCK.size * len(blocks)) // 4 - 1
+	return (COMMON_HEADER.pack(RTCP_VERSION << 6 | len(blocks), PT_SR, length)
+		+ SR_INFO.pack(ssrc, ntp >> 32, ntp & 0xffffffff, rtpTimestamp & 0xffffffff, packets & 0xffffffff,
+			octets & 0xffffffff)
+		+ b''.join(block.pack() for block in blocks))
+
+def packReceiverReport(ssrc, blocks):
+	"""Return an RTCP RR packet."""
+	length = (COMMON_HEADER.size + RR_INFO.size + REPORT_BLOCK.size * len(blocks)) // 4 - 1
+	return (COMMON_HEADER.pack(RTCP_VERSION << 6 | len(blocks), PT_RR, length) + RR_INFO.pack(ssrc)
+		+ b''.join(block.pack() for block in blocks))
+
+def parseRtcp(data):
+	"""Parse a (compound) RTCP packet into a list of dicts. SR and RR are decoded, other types are skipped."""
+	packets = []
+	offset = 0
+	while offset + COMMON_HEADER.size <= len(data):
+		first, pt, length = COMMON_HEADER.unpack_from(data, offset)
+		end = offset + (length + 1) * 4
+		if first >> 6 != RTCP_VERSION or end > len(data):
+			break
+		count = first & 0x1f
+		body = offset + COMMON_HEADER.size
+		if pt == PT_SR and end - body >= SR_INFO.size:
+			ssrc, ntpSec, ntpFrac, rtpTimestamp, packetCount, octetCount = SR_INFO.unpack_from(data, body)
+			blocks = body + SR_INFO.size
+			packets.append({'type': PT_SR, 'ssrc': ssrc, 'ntp': ntpSec << 32 | ntpFrac, 'rtpTimestamp': rtpTimestamp,
+				'packets': packetCount, 'octets': octetCount, 'blocks': readBlocks(data, blocks, end, count)})
+		elif pt == PT_RR and end - body >= RR_INFO.size:
+			ssrc = RR_INFO.unpack_from(data, body)[0]
+			blocks = body + RR_INFO.size
+			packets.append({'type': PT_RR, 'ssrc': ssrc, 'blocks': readBlocks(data, blocks, end, count)})
+		offset = end
+	return packets
+
+def readBlocks(data, offset, end, count):
+	"""Read up to count report blocks that fit before end."""
+	blocks = []
+	for i in range(count):
+		if offset + REPORT_BLOCK.size > end:
+			break
+		blocks.append(ReportBlock.unpack(data, offset))
+		offset += REPORT_BLOCK.size
+	return blocks
+
+class ReceiverStats:
+	"""Reception statistics of one RTP source, kept as in RFC 3550 appendix A.1, A.3 and A.8."""
+
+	def __init__(self, clockRate=CLOCK_RATE):
+		self.clockRate = clockRate
+		self.ssrc = None
+		self.baseSeq = 0
+		self.maxSeq = 0
+		self.cycles = 0
+		self.received = 0
+		self.octets = 0
+		self.expectedPrior = 0
+		self.receivedPrior = 0
+		self.fractionLost = 0
+		self.transit = None
+		self.jitter = 0.0 # In timestamp units
+		self.lastSr = 0 # Middle 32 bits of the NTP time of the last SR
+		self.lastSrArrival = None
+		self.senderPackets = 0
+		self.senderOctets = 0
+
+	def update(self, seq, timestamp, ssrc, length, arrival=None):
+		"""Account for one received RTP packet."""
+		if arrival is None:
+			arrival = time.time()
+		if ssrc != self.ssrc:
+			self.ssrc = ssrc
+			self.baseSeq = seq
+			self.maxSeq = seq
+			self.cycles = 0
+			self.received = 0
+			self.expectedPrior = 0
+			self.receivedPrior = 0
+			self.transit = None
+			self.jitter = 0.0
+		elif seqDiff(seq, self.maxSeq) > 0:
+			if seq < self.maxSeq:
+				self.cycles += 1 << 16 # Sequence number wrapped around
+			self.maxSeq = seq
+		self.received += 1
+		self.octets += length
+
+		transit = (int(arrival * self.clockRate) - timestamp) & 0xffffffff
+		if self.transit is not None:
+			d = ((transit - self.transit + 0x80000000) & 0xffffffff) - 0x80000000
+			self.jitter += (abs(d) - self.jitter) / 16
+		self.transit = transit
+
+	def extendedMax(self):
+		"""Return the extended highest sequence number received."""
+		return self.cycles + self.maxSeq
+
+	def expected(self):
+		"""Return the number of packets expected from the first to the highest sequence number."""
+		return self.extendedMax() - self.baseSeq + 1 if self.ssrc is not None else 0
+
+	def lost(self):
+		"""Return the cumulative number of packets lost (negative with duplicates)."""
+		return self.expected() - self.received
+
+	def onSenderReport(self, report, arrival=None):
+		"""Remember a sender report for the LSR/DLSR fields of the next receiver report."""
+		self.lastSr = ntpMiddle(report['ntp'])
+		self.lastSrArrival = time.time() if arrival is None else arrival
+		self.senderPackets = report['packets']
+		self.senderOctets = report['octets']
+
+	def reportBlock(self, now=None):
+		"""Return the report block for the next receiver report, starting a new loss interval."""
+		if now is None:
+			now = time.time()
+		expected = self.expected()
+		expectedInterval = expected - self.expectedPrior
+		lostInterval = expectedInterval - (self.received - self.receivedPrior)
+		self.expectedPrior = expected
+		self.receivedPrior = self.received
+		if expectedInterval <= 0 or lostInterval <= 0:
+			self.fractionLost = 0
+		else:
+			self.fractionLost = min(255, (lostInterval << 8) // expectedInterval)
+		dlsr = 0
+		if self.lastSrArrival is not None:
+			dlsr = int((now - self.lastSrArrival) * 65536) & 0xffffffff
+		return ReportBlock(self.ssrc or 0, self.fractionLost, self.lost(), self.extendedMax(), self.jitter, self.lastSr,
+			dlsr)
+
+	def stats(self):
+		"""Return the reception stats, with jitter in seconds."""
+		return {
+			'received': self.received,
+			'expected': self.expected(),
+			'lost': self.lost(),
+			'fractionLost': self.fractionLost / 256,
+			'jitter': self.jitter / self.clockRate,
+			'octets': self.octets,
+			'senderPackets': self.senderPackets,
+		}
+
+class SenderStats:
+	"""Sending statistics of one RTP session and the feedback from its receiver reports."""
+
+	def __init__(self, ssrc, clockRate=CLOCK_RATE):
+		self.ssrc = ssrc
+		self.clockRate = clockRate
+		self.packets = 0
+		self.octets = 0
+		self.lastTimestamp = 0
+		self.lastSendTime = None
+		self.reports = 0
+		self.fractionLost = 0.0
+		self.cumulativeLost = 0
+		self.jitter = 0.0 # Seconds
+		self.rtt = None # Seconds
+		self.lastReport = None
+
+	def onSend(self, packets, octets, timestamp):
+		"""Account for RTP packets just sent, carrying octets payload bytes."""
+		self.packets += packets
+		self.octets += octets
+		self.lastTimestamp = timestamp
+		self.lastSendTime = time.time()
+
+	def senderReport(self, now=None):
+		"""Return an SR packet for the current time."""
+		if now is None:
+			now = time.time()
+		timestamp = self.lastTimestamp
+		if self.lastSendTime is not None:
+			timestamp += int((now - self.lastSendTime) * self.clockRate) # Media time now, not at the last frame
+		return packSenderReport(self.ssrc, ntpTime(now), timestamp, self.packets, self.octets)
+
+	def onReceiverReport(self, block, arrival=None):
+		"""Take in the report block a receiver sent about this session."""
+		if arrival is None:
+			arrival = time.time()
+		self.reports += 1
+		self.lastReport = arrival
+		self.fractionLost = block.fractionLost / 256
+		self.cumulativeLost = block.cumulativeLost
+		self.jitter = block.jitter / self.clockRate
+		if block.lsr:
+			rtt = (ntpMiddle(ntpTime(arrival)) - block.lsr - block.dlsr) & 0xffffffff
+			if rtt < 0x80000000:
+				self.rtt = rtt / 65536
+
+	def stats(self):
+		"""Return the sending stats and the latest receiver feedback."""
+		return {
+			'packets': self.packets,
+			'octets': self.octets,
+			'reports': self.reports,
+			'fractionLost': self.fractionLost,
+			'cumulativeLost': self.cumulativeLost,
+			'jitter': self.jitter,
+			'rtt': self.rtt,
+		}
+
+class RtcpChannel:
+	"""One server-side RTCP socket shared by every session. Receiver reports are routed to sessions by SSRC."""
+
+	def __init__(self, port=0):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(('', port))
+		self.sock.setblocking(False)
+		self.senders = {}
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def register(self, stats):
+		"""Route receiver reports about stats.ssrc to stats."""
+		with self.lock:
+			self.senders[stats.ssrc] = stats
+
+	def unregister(self, ssrc):
+		"""Stop routing reports about a session."""
+		with self.lock:
+			self.senders.pop(ssrc, None)
+
+	def send(self, packet, addr):
+		"""Send an RTCP packet. A full socket buffer just drops it."""
+		try:
+			self.sock.sendto(packet, addr)
+		except OSError:
+			pass
+
+	def readAvailable(self):
+		"""Read and handle every RTCP packet waiting on the socket."""
+		while True:
+			try:
+				data = self.sock.recv(2048)
+			except OSError: # Includes BlockingIOError once the socket is drained
+				return
+			self.handle(data, time.time())
+
+	def handle(self, data, arrival):
+		"""Hand the report blocks of a received RTCP packet to their sessions."""
+		for report in parseRtcp(data):
+			for block in report['blocks']:
+				with self.lock:
+					stats = self.senders.get(block.ssrc)
+				if stats is not None:
+					stats.onReceiverReport(block, arrival)
+
+	def start(self):
+		"""Receive reports on a background thread."""
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run, name='RtcpChannel', daemon=True)
+			self.thread.start()
+
+	def run(self):
+		"""Wait for reports and handle them."""
+		selector = selectors.DefaultSelector()
+		selector.register(self.sock, selectors.EVENT_READ)
+		while True:
+			selector.select()
+			self.readAvailable()
+
+channelLock = threading.Lock()
+channel = None
+
+def getChannel():
+	"""Return the process-wide RtcpChannel, started on first use."""
+	global channel
+	with channelLock:
+		if channel is None:
+			channel = RtcpChannel()
+			channel.start()
+		return channel
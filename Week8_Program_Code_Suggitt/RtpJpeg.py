@@ -0,0 +1,124 @@
+"""
+MJPEG over RTP fragmentation (RFC 2435) and frame reassembly.
+
+Frames are split into MTU-sized RTP payloads that each start with the 8 byte RFC 2435 main JPEG header carrying the
+fragment offset. Every fragment of a frame shares the RTP timestamp and the last one has the marker bit set. The payload
+carries the complete JPEG file rather than only the scan data, so the receiver can display frames without rebuilding
+the quantization and Huffman tables; only the main header fields are used. Q is below 128, so no Quantization Table
+header follows the main header and a receiver that does rebuild the frame falls back to the standard tables.
+"""
+from collections import OrderedDict, deque
+import struct
+
+from RtpPacket import HEADER_SIZE as RTP_HEADER_SIZE, mediaTimestamp
+
+DEFAULT_MTU = 1400 # Leaves room for IP/UDP headers on a 1500 byte Ethernet link
+JPEG_HEADER = struct.Struct('!IBBBB') # type-specific + fragment offset, type, Q, width/8, height/8
+JPEG_HEADER_SIZE = JPEG_HEADER.size
+JPEG_TYPE = 1
+JPEG_Q = 50 # Standard RFC 2435 tables; 128-255 would require an in-band Quantization Table header
+MAX_FRAME_BYTES = 256 * 1024
+
+def frameTimestamp(frameNbr, framePeriod):
+	"""Return the 32-bit 90 kHz RTP timestamp of a frame number."""
+	return mediaTimestamp(frameNbr * framePeriod)
+
+def frameSize(frame):
+	"""Return (width, height) from the JPEG start of frame marker, or (0, 0) if there is none."""
+	pos = 2
+	while pos + 9 <= len(frame) and frame[pos] == 0xff:
+		marker = frame[pos + 1]
+		if marker in (0xc0, 0xc1, 0xc2):
+			height, width = struct.unpack_from('!HH', frame, pos + 5)
+			return width, height
+		if marker == 0xda: # Start of scan, no frame header before the image data
+			break
+		pos += 2 + struct.unpack_from('!H', frame, pos + 2)[0]
+	return 0, 0
+
+def fragmentFrame(frame, mtu=DEFAULT_MTU):
+	"""Split a JPEG frame into RTP payloads of at most mtu - 12 bytes, each with an RFC 2435 main header."""
+	return [b''.join(buffers) for buffers in fragmentFrameViews(frame, mtu)]
+
+def fragmentCount(frameBytes, mtu=DEFAULT_MTU):
+	"""Return how many payloads fragmentFrame makes of a frame of frameBytes bytes."""
+	chunkSize = mtu - RTP_HEADER_SIZE - JPEG_HEADER_SIZE
+	return -(-max(frameBytes, 1) // chunkSize)
+
+def fragmentFrameViews(frame, mtu=DEFAULT_MTU):
+	"""Like fragmentFrame, but return each payload as [main header, memoryview of the frame] without copying."""
+	width, height = frameSize(frame)
+	chunkSize = mtu - RTP_HEADER_SIZE - JPEG_HEADER_SIZE
+	view = memoryview(frame)
+	payloads = []
+	for offset in range(0, max(len(frame), 1), chunkSize):
+		header = JPEG_HEADER.pack(offset & 0xffffff, JPEG_TYPE, JPEG_Q, min(width // 8, 255), min(height // 8, 255))
+		payloads.append([header, view[offset:offset + chunkSize]])
+	return payloads
+
+class PartialFrame:
+	__slots__ = ('buf', 'offsets', 'received', 'length', 'firstSeq')
+
+	def __init__(self, buf):
+		self.buf = buf
+		self.offsets = set()
+		self.received = 0
+		self.length = None
+		self.firstSeq = None
+
+class FrameAssembler:
+	"""Reassembles fragmented frames into a pool of preallocated buffers.
+
+	Up to maxPartial frames are collected at once, so fragments reordered across a frame boundary still complete both
+	frames. A returned frame is a memoryview into a pool buffer; buffers are reused oldest first, so the view stays
+	valid until buffers - maxPartial more frames have been started. Copy it if it has to be kept longer.
+	"""
+
+	def __init__(self, buffers=8, maxPartial=3, maxFrameBytes=MAX_FRAME_BYTES):
+		self.free = deque(bytearray(maxFrameBytes) for _ in range(buffers))
+		self.maxPartial = maxPartial
+		self.partial = OrderedDict() # Timestamp -> PartialFrame, oldest first
+		self.completed = deque(maxlen=16) # Timestamps of recently completed frames, to drop late duplicates
+		self.frameSeq = None # Sequence number of the first fragment of the last completed frame
+		self.framesCompleted = 0
+		self.framesDropped = 0
+
+	def addPacket(self, timestamp, marker, payload, seqnum=None):
+		"""Add one RTP payload. Return the completed frame as a memoryview, or None while it is still incomplete."""
+		if len(payload) < JPEG_HEADER_SIZE:
+			return None
+		offset = JPEG_HEADER.unpack_from(payload)[0] & 0xffffff
+		data = memoryview(payload)[JPEG_HEADER_SIZE:]
+
+		if timestamp in self.completed:
+			return None # Late duplicate of a frame already delivered
+		frame = self.partial.get(timestamp)
+		if frame is None:
+			if len(self.partial) >= self.maxPartial:
+				_, oldest = self.partial.popitem(last=False)
+				self.free.append(oldest.buf)
+				self.framesDropped += 1 # Never completed, a fragment was lost
+			frame = PartialFrame(self.free.popleft())
+			self.partial[timestamp] = frame
+		if offset in frame.offsets:
+			return None # Duplicate fragment
+
+		end = offset + len(data)
+		if end > len(frame.buf):
+			frame.buf.extend(bytes(end - len(frame.buf)))
+		frame.buf[offset:end] = data
+		frame.offsets.add(offset)
+		frame.received += len(data)
+		if offset == 0:
+			frame.firstSeq = seqnum
+		if marker:
+			frame.length = end
+
+		if frame.length is not None and frame.received == frame.length:
+			del self.partial[timestamp]
+			self.free.append(frame.buf)
+			self.completed.append(timestamp)
+			self.frameSeq = frame.firstSeq
+			self.framesCompleted += 1
+			return memoryview(frame.buf)[:frame.length]
+		return None
@@ -1,72 +1,100 @@
 """
-Most of this code was provided through a course textbook named "Computer Networking" for a course named "CS450 Data
-Networks" at Regis University. Aside from this docstring, the student modified sections are found in the encode
-funciton.
+RTP packets (RFC 3550). Started from the skeleton provided through a course textbook named "Computer Networking" for a
+course named "CS450 Data Networks" at Regis University. The 12 byte fixed header is packed and unpacked with one
+precompiled struct, either into an RtpPacket's own buffer or into a caller's buffer with packHeader(), and timestamps
+use the 90 kHz video media clock. decode() parses in place over memoryviews, and RtpPacket uses __slots__, so one
+packet object can be reused for every packet sent or received.
 
 @Author Travis Suggitt
 @Date 3/7/2021
 """
-import sys
+import struct
 from time import time
-HEADER_SIZE = 12
+
+RTP_HEADER = struct.Struct('!BBHII') # V/P/X/CC, M/PT, sequence number, timestamp, SSRC
+HEADER_SIZE = RTP_HEADER.size
+CLOCK_RATE = 90000 # RFC 3550 media clock for video, in timestamp units per second
+
+def packHeader(buffer, offset, version, padding, extension, cc, seqnum, marker, pt, timestamp, ssrc):
+	"""Write a 12 byte RTP header into buffer at offset."""
+	RTP_HEADER.pack_into(buffer, offset,
+		(version << 6 | padding << 5 | extension << 4 | cc) & 0xff,
+		(marker << 7 | pt & 0x7f) & 0xff,
+		seqnum & 0xffff,
+		timestamp & 0xffffffff,
+		ssrc & 0xffffffff)
+
+def mediaTimestamp(seconds):
+	"""Return the 32-bit 90 kHz RTP timestamp of a time in seconds."""
+	return int(round(seconds * CLOCK_RATE)) & 0xffffffff
+
+def seqDiff(a, b):
+	"""Return a - b for 16-bit sequence numbers, in the range -32768..32767 so wraparound is handled."""
+	return ((a - b + 0x8000) & 0xffff) - 0x8000
 
 class RtpPacket:
-	header = bytearray(HEADER_SIZE)
+	__slots__ = ('header', 'payload', 'first', 'second', 'seq', 'ts', 'ssrcId')
 
 	def __init__(self):
-		pass
-
-	def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload):
-		"""Encode the RTP packet with header fields and payload."""
-		timestamp = int(time())
-		header = bytearray(HEADER_SIZE)
-		#--------------
-		# TO COMPLETE
-		#--------------
-		# Fill the header bytearray with RTP header fields
-
-		header[0] = version << 6 & 0xc0 | padding << 5 | extension << 4 | cc & 0x0f
-		header[1] = marker << 7 | pt & 0x7f
-		header[2] = seqnum & 0xff00 >> 8
-		header[3] = seqnum & 0xff
-		header[4] = timestamp >> 24
-		header[5] = timestamp >> 16 & 0xff
-		header[6] = timestamp >> 8 & 0xff
-		header[7] = timestamp & 0xff
-		header[8] = ssrc >> 24
-		header[9] = ssrc >> 16 & 0xff
-		header[10] = ssrc >> 8 & 0xff
-		header[11] = ssrc & 0xff
+		self.header = bytearray(HEADER_SIZE)
+		self.payload = b''
+		self.first = 0
+		self.second = 0
+		self.seq = 0
+		self.ts = 0
+		self.ssrcId = 0
 
-		# Get the payload from the argument
-		self.header = header
-		self.payload = payload
+	def encode(self, version, padding, extension, cc, seqnum, marker, pt, ssrc, payload, timestamp=None):
+		"""Encode the RTP packet with header fields and payload.
 
+		The header fields are set directly and packed into this packet's own buffer, so an RtpPacket can be reused for
+		every packet once the previous one has been sent. Without a timestamp the 90 kHz media clock is taken from the
+		current time.
+		"""
+		if timestamp is None:
+			timestamp = mediaTimestamp(time())
+		if not isinstance(self.header, bytearray):
+			self.header = bytearray(HEADER_SIZE) # Decoded packets hold a read-only view
+		self.first = (version << 6 | padding << 5 | extension << 4 | cc) & 0xff
+		self.second = (marker << 7 | pt & 0x7f) & 0xff
+		self.seq = seqnum & 0xffff
+		self.ts = timestamp & 0xffffffff
+		self.ssrcId = ssrc & 0xffffffff
+		RTP_HEADER.pack_into(self.header, 0, self.first, self.second, self.seq, self.ts, self.ssrcId)
 
+		# Get the payload from the argument
+		self.payload = payload
 
 	def decode(self, byteStream):
-		"""Decode the RTP packet."""
-		self.header = bytearray(byteStream[:HEADER_SIZE])
-		self.payload = byteStream[HEADER_SIZE:]
+		"""Decode the RTP packet. The header and payload are memoryviews of byteStream, nothing is copied."""
+		view = memoryview(byteStream)
+		self.first, self.second, self.seq, self.ts, self.ssrcId = RTP_HEADER.unpack_from(view)
+		self.header = view[:HEADER_SIZE]
+		self.payload = view[HEADER_SIZE:]
 
 	def version(self):
 		"""Return RTP version."""
-		return int(self.header[0] >> 6)
+		return self.first >> 6
 
 	def seqNum(self):
 		"""Return sequence (frame) number."""
-		seqNum = self.header[2] << 8 | self.header[3]
-		return int(seqNum)
+		return self.seq
 
 	def timestamp(self):
 		"""Return timestamp."""
-		timestamp = self.header[4] << 24 | self.header[5] << 16 | self.header[6] << 8 | self.header[7]
-		return int(timestamp)
+		return self.ts
+
+	def ssrc(self):
+		"""Return the synchronization source identifier."""
+		return self.ssrcId
+
+	def marker(self):
+		"""Return the marker bit, set on the last fragment of a frame."""
+		return self.second >> 7
 
 	def payloadType(self):
 		"""Return payload type."""
-		pt = self.header[1] & 127
-		return int(pt)
+		return self.second & 127
 
 	def getPayload(self):
 		"""Return payload."""
@@ -74,4 +102,13 @@ class RtpPacket:
 
 	def getPacket(self):
 		"""Return RTP packet."""
-		return self.header + self.payload
\ No newline at end of file
+		return b''.join(self.getBuffers())
+
+	def getBuffers(self):
+		"""Return the header and payload as a list of separate buffers for socket.sendmsg, without copying.
+
+		The payload may itself be a list of buffers, such as a payload header and a slice of the frame.
+		"""
+		if isinstance(self.payload, list):
+			return [self.header] + self.payload
+		return [self.header, self.payload]
@@ -0,0 +1,97 @@
+"""
+RTP reception for the client without a per-packet allocation. Datagrams are read into a pool of preallocated bytearrays
+with recvmsg_into (recv_into where the platform lacks it), every datagram that is ready is drained on each selector
+wakeup, and the headers are parsed in place by one reused RtpPacket over memoryviews of the pool. The handler must copy
+anything it keeps, as the buffers are refilled on the next wakeup. A datagram larger than a buffer is dropped.
+"""
+import selectors, socket, time
+
+from RtpPacket import RtpPacket, HEADER_SIZE
+
+MAX_DATAGRAM = 65536
+POOL_SIZE = 32 # Datagrams read per pass before they are handled
+
+class RtpReceiver:
+	def __init__(self, sock, onPacket, buffers=POOL_SIZE, bufferSize=MAX_DATAGRAM):
+		"""Call onPacket(rtpPacket, length, arrival) for every RTP packet received on sock."""
+		self.sock = sock
+		self.sock.setblocking(False)
+		self.onPacket = onPacket
+		self.views = [memoryview(bytearray(bufferSize)) for _ in range(buffers)]
+		self.lengths = [0] * buffers
+		self.packet = RtpPacket()
+		self.useRecvmsg = hasattr(sock, 'recvmsg_into')
+		# Writing to the wakeup pair ends run() without waiting for a timeout
+		self.wakeRead, self.wakeWrite = socket.socketpair()
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.sock, selectors.EVENT_READ)
+		self.selector.register(self.wakeRead, selectors.EVENT_READ)
+		self.running = True
+		self.wakeups = 0
+		self.packets = 0
+		self.dropped = 0 # Truncated or too short to be RTP
+
+	def run(self):
+		"""Receive until stop() is called."""
+		while self.running:
+			for key, _ in self.selector.select():
+				if key.fileobj is self.sock:
+					self.wakeups += 1
+					self.drain()
+		self.selector.close()
+		self.wakeRead.close()
+		self.wakeWrite.close()
+
+	def drain(self):
+		"""Handle every datagram waiting on the socket, a pool at a time."""
+		while True:
+			count = self.readBatch()
+			arrival = time.time()
+			for i in range(count):
+				length = self.lengths[i]
+				if length < HEADER_SIZE:
+					self.dropped += 1
+					continue
+				self.packet.decode(self.views[i][:length])
+				self.packets += 1
+				self.onPacket(self.packet, length, arrival)
+			if count < len(self.views):
+				return
+
+	def readBatch(self):
+		"""Fill the pool with waiting datagrams. Return how many were read."""
+		count = 0
+		while count < len(self.views):
+			try:
+				if self.useRecvmsg:
+					length, _, flags, _ = self.sock.recvmsg_into([self.views[count]])
+					if flags & socket.MSG_TRUNC:
+						self.dropped += 1
+						continue # Read the next datagram into the same buffer
+				else:
+					length = self.sock.recv_into(self.views[count])
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError:
+				self.running = False # The socket was closed under us
+				break
+			self.lengths[count] = length
+			count += 1
+		return count
+
+	def stop(self):
+		"""End run() from another thread."""
+		self.running = False
+		try:
+			self.wakeWrite.send(b'\0')
+		except OSError:
+			pass
+
+	def stats(self):
+		"""Return the wakeup and packet counters."""
+		return {
+			'wakeups': self.wakeups,
+			'packets': self.packets,
+			'packetsPerWakeup': self.packets / self.wakeups if self.wakeups else 0.0,
+			'dropped': self.dropped,
+		}
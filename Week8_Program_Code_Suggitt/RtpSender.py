@@ -0,0 +1,213 @@
+"""
+Scatter-gather RTP transmission. A packet is a list of buffers (RTP header, payload header, payload slice) handed to
+the kernel as an iovec with socket.sendmsg, so the payload is never copied to put a header in front of it. The packets
+of a batch go out in one sendmmsg(2) call where libc provides it, otherwise in a sendmsg loop.
+
+InterleavedSender sends the same packets over the RTSP TCP connection instead, framed as in RFC 2326 10.12.
+"""
+import ctypes, ctypes.util, errno, select, socket, sys, threading, time
+
+from RtspParser import interleavedHeader
+
+MAX_BATCH = 64 # Packets per sendmmsg call
+
+class iovec(ctypes.Structure):
+	_fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [
+		('msg_name', ctypes.c_void_p),
+		('msg_namelen', ctypes.c_uint32),
+		('msg_iov', ctypes.POINTER(iovec)),
+		('msg_iovlen', ctypes.c_size_t),
+		('msg_control', ctypes.c_void_p),
+		('msg_controllen', ctypes.c_size_t),
+		('msg_flags', ctypes.c_int),
+	]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+	_fields_ = [
+		('sin_family', ctypes.c_ushort),
+		('sin_port', ctypes.c_uint16),
+		('sin_addr', ctypes.c_uint8 * 4),
+		('sin_zero', ctypes.c_uint8 * 8),
+	]
+
+class Py_buffer(ctypes.Structure):
+	_fields_ = [
+		('buf', ctypes.c_void_p),
+		('obj', ctypes.c_void_p),
+		('len', ctypes.c_ssize_t),
+		('itemsize', ctypes.c_ssize_t),
+		('readonly', ctypes.c_int),
+		('ndim', ctypes.c_int),
+		('format', ctypes.c_char_p),
+		('shape', ctypes.c_void_p),
+		('strides', ctypes.c_void_p),
+		('suboffsets', ctypes.c_void_p),
+		('internal', ctypes.c_void_p),
+	]
+
+def loadSendmmsg():
+	"""Return libc's sendmmsg, or None where it is not available."""
+	if not sys.platform.startswith('linux'):
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		sendmmsg = libc.sendmmsg
+	except (OSError, AttributeError, TypeError):
+		return None
+	sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+	sendmmsg.restype = ctypes.c_int
+	return sendmmsg
+
+sendmmsg = loadSendmmsg()
+PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(Py_buffer), ctypes.c_int]
+PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+PyBuffer_Release.argtypes = [ctypes.POINTER(Py_buffer)]
+PyBUF_SIMPLE = 0
+
+class RtpSender:
+	def __init__(self, sock, useSendmmsg=True):
+		self.sock = sock
+		self.useSendmmsg = useSendmmsg and sendmmsg is not None
+		self.packets = 0
+		self.calls = 0
+
+	def send(self, buffers, addr):
+		"""Send one packet given as a list of buffers."""
+		self.calls += 1
+		self.packets += 1
+		return self.sock.sendmsg(buffers, (), 0, addr)
+
+	def sendBatch(self, packets, addr):
+		"""Send a list of packets, each a list of buffers, to one address. Return the number of packets sent."""
+		if not packets:
+			return 0
+		if self.useSendmmsg:
+			try:
+				name = self.sockaddr(addr)
+			except OSError:
+				name = None # Not an IPv4 address, fall back to sendmsg
+			if name is not None:
+				sent = 0
+				for i in range(0, len(packets), MAX_BATCH):
+					count = self.sendmmsg(packets[i:i + MAX_BATCH], name)
+					sent += count
+					if count < len(packets[i:i + MAX_BATCH]):
+						break
+				return sent
+		for buffers in packets:
+			self.send(buffers, addr)
+		return len(packets)
+
+	def sockaddr(self, addr):
+		"""Return a sockaddr_in for an (IPv4 address, port) pair."""
+		name = sockaddr_in()
+		name.sin_family = socket.AF_INET
+		name.sin_port = socket.htons(addr[1])
+		name.sin_addr[:] = socket.inet_pton(socket.AF_INET, addr[0])
+		return name
+
+	def sendmmsg(self, packets, name):
+		"""Send up to MAX_BATCH packets in one sendmmsg call. Return the number sent."""
+		views = []
+		msgs = (mmsghdr * len(packets))()
+		iovecs = []
+		try:
+			for msg, buffers in zip(msgs, packets):
+				iov = (iovec * len(buffers))()
+				for entry, buf in zip(iov, buffers):
+					view = Py_buffer()
+					if PyObject_GetBuffer(buf, ctypes.byref(view), PyBUF_SIMPLE) != 0:
+						raise TypeError('RTP buffers must support the buffer protocol')
+					views.append(view)
+					entry.iov_base = view.buf
+					entry.iov_len = view.len
+				iovecs.append(iov)
+				msg.msg_hdr.msg_name = ctypes.cast(ctypes.pointer(name), ctypes.c_void_p)
+				msg.msg_hdr.msg_namelen = ctypes.sizeof(name)
+				msg.msg_hdr.msg_iov = iov
+				msg.msg_hdr.msg_iovlen = len(buffers)
+			self.calls += 1
+			sent = sendmmsg(self.sock.fileno(), msgs, len(packets), 0)
+		finally:
+			for view in views:
+				PyBuffer_Release(ctypes.byref(view))
+		if sent < 0:
+			err = ctypes.get_errno()
+			if err in (errno.EAGAIN, errno.ENOBUFS): # The socket buffer is full, drop the packets as UDP would
+				return 0
+			raise OSError(err, 'sendmmsg failed')
+		self.packets += sent
+		return sent
+
+class InterleavedSender:
+	"""Sends RTP and RTCP over an RTSP TCP connection, and the RTSP replies that share it.
+
+	The pacing thread must never block on a slow client, so packets are sent without waiting and whatever the socket
+	does not take is kept and sent first next time. While part of a frame is still waiting, new frames are dropped and
+	reported as not sent, as a full UDP socket buffer would be. RTSP replies go through write(), which queues them at a
+	packet boundary, and drain() waits for them to go out without holding the lock the pacing thread needs.
+	"""
+
+	def __init__(self, sock, channel=0):
+		self.sock = sock
+		self.channel = channel
+		self.pending = bytearray()
+		self.lock = threading.Lock()
+		self.packets = 0
+
+	def sendBatch(self, packets, addr=None, channel=None):
+		"""Send a list of packets, each a list of buffers, on an interleaved channel. Return the number accepted."""
+		if channel is None:
+			channel = self.channel
+		with self.lock:
+			self.flush()
+			if self.pending:
+				return 0
+			for buffers in packets:
+				self.pending += interleavedHeader(channel, sum(len(buf) for buf in buffers))
+				for buf in buffers:
+					self.pending += buf
+			self.flush()
+		self.packets += len(packets)
+		return len(packets)
+
+	def write(self, data):
+		"""Queue RTSP text after the rest of any packet already started and send what the socket takes now."""
+		with self.lock:
+			self.pending += data
+			self.flush()
+
+	def drain(self, timeout=None):
+		"""Wait until everything queued has been sent, or timeout seconds. The lock is only held to send, never to wait.
+
+		Return True if nothing is left queued.
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			with self.lock:
+				self.flush()
+				if not self.pending:
+					return True
+			if deadline is not None and time.monotonic() >= deadline:
+				return False
+			try:
+				select.select([], [self.sock], [], 1.0)
+			except ValueError: # Closed by another thread
+				raise OSError('Connection closed')
+
+	def flush(self):
+		"""Send as much of the pending data as the socket takes without waiting. Called with the lock held."""
+		flags = getattr(socket, 'MSG_DONTWAIT', 0)
+		while self.pending:
+			try:
+				sent = self.sock.send(self.pending, flags)
+			except BlockingIOError:
+				return
+			del self.pending[:sent]
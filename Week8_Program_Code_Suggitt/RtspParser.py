@@ -0,0 +1,205 @@
+"""
+Incremental RTSP/1.0 parser. Bytes are fed in as they arrive on the TCP connection and complete messages come out in
+order, however the stream was cut into segments: one message may span several reads and one read may hold several
+pipelined messages. Lines may end in CRLF or a bare LF, headers are looked up by name without regard to case and a
+Content-Length body is read in full before its message is released.
+
+RFC 2326 10.12 interleaved binary data ('$', a channel byte, a 16-bit length and the data) may be mixed in with the
+messages, which lets RTP and RTCP share the RTSP connection on networks where UDP is lossy or blocked.
+"""
+import struct
+
+INTERLEAVED_HEADER = struct.Struct('!cBH') # '$', channel, length
+MAX_HEADER_SIZE = 8192
+
+class RtspError(ValueError):
+	"""Raised for data that is not a valid RTSP message."""
+
+class RtspMessage:
+	"""A request (method, uri) or a reply (code, reason), with its headers and body."""
+	__slots__ = ('method', 'uri', 'version', 'code', 'reason', 'headers', 'body')
+
+	def __init__(self, method=None, uri=None, version='RTSP/1.0', code=None, reason=None):
+		self.method = method
+		self.uri = uri
+		self.version = version
+		self.code = code
+		self.reason = reason
+		self.headers = {} # Lower case name -> value
+		self.body = b''
+
+	def isRequest(self):
+		"""Return True for a request, False for a reply."""
+		return self.method is not None
+
+	def header(self, name, default=None):
+		"""Return the value of a header, looked up without regard to case."""
+		return self.headers.get(name.lower(), default)
+
+	def cseq(self):
+		"""Return the CSeq header, '0' if there is none."""
+		return self.header('CSeq', '0')
+
+	def session(self):
+		"""Return the session id of the Session header without its parameters, or None."""
+		value = self.header('Session')
+		return value.split(';')[0].strip() if value else None
+
+	def sessionTimeout(self):
+		"""Return the timeout parameter of the Session header in seconds, or None."""
+		for param in (self.header('Session') or '').split(';')[1:]:
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'timeout':
+				try:
+					return int(value)
+				except ValueError:
+					return None
+		return None
+
+	def transport(self):
+		"""Return the parameters of the Transport header, see parseTransport."""
+		return parseTransport(self.header('Transport', ''))
+
+	def __str__(self):
+		first = ' '.join((self.method, self.uri, self.version)) if self.isRequest() else '%s %d %s' % (self.version, self.code, self.reason)
+		return '\n'.join([first] + [name + ': ' + value for name, value in self.headers.items()])
+
+class Interleaved:
+	"""A packet that arrived on an interleaved channel of the RTSP connection."""
+	__slots__ = ('channel', 'data')
+
+	def __init__(self, channel, data):
+		self.channel = channel
+		self.data = data
+
+class RtspParser:
+	def __init__(self, maxHeaderSize=MAX_HEADER_SIZE):
+		self.maxHeaderSize = maxHeaderSize
+		self.buffer = bytearray()
+		self.pending = None # Message waiting for the rest of its body
+		self.bodyLength = 0
+
+	def feed(self, data):
+		"""Add received bytes. Return the RtspMessage and Interleaved items they completed, in order."""
+		self.buffer += data
+		items = []
+		while True:
+			item = self.next()
+			if item is None:
+				return items
+			items.append(item)
+
+	def next(self):
+		"""Take the next complete item off the buffer, or return None if more data is needed."""
+		buf = self.buffer
+		if self.pending is not None:
+			if len(buf) < self.bodyLength:
+				return None
+			message = self.pending
+			message.body = bytes(buf[:self.bodyLength])
+			del buf[:self.bodyLength]
+			self.pending = None
+			return message
+
+		# Skip stray line ends between messages
+		start = 0
+		while start < len(buf) and buf[start] in b'\r\n':
+			start += 1
+		if start:
+			del buf[:start]
+		if not buf:
+			return None
+
+		if buf[0] == 0x24: # '$'
+			if len(buf) < INTERLEAVED_HEADER.size:
+				return None
+			_, channel, length = INTERLEAVED_HEADER.unpack_from(buf)
+			end = INTERLEAVED_HEADER.size + length
+			if len(buf) < end:
+				return None
+			data = bytes(buf[INTERLEAVED_HEADER.size:end])
+			del buf[:end]
+			return Interleaved(channel, data)
+
+		# The header ends at the first empty line
+		crlf = buf.find(b'\n\r\n')
+		lf = buf.find(b'\n\n')
+		if crlf < 0 and lf < 0:
+			if len(buf) > self.maxHeaderSize:
+				raise RtspError('Header too long')
+			return None
+		if lf < 0 or 0 <= crlf < lf:
+			end, skip = crlf, 3
+		else:
+			end, skip = lf, 2
+		message = parseHeader(bytes(buf[:end]).decode('utf-8', 'replace'))
+		del buf[:end + skip]
+
+		try:
+			length = int(message.header('Content-Length', 0))
+		except ValueError:
+			raise RtspError('Bad Content-Length')
+		if length > 0:
+			self.pending = message
+			self.bodyLength = length
+			return self.next()
+		return message
+
+def parseHeader(text):
+	"""Parse the start line and headers of a message."""
+	lines = [line.rstrip('\r') for line in text.split('\n')]
+	parts = lines[0].split(' ', 2)
+	if len(parts) < 2:
+		raise RtspError('Bad start line: ' + lines[0])
+	if parts[0].startswith('RTSP/'):
+		try:
+			message = RtspMessage(version=parts[0], code=int(parts[1]), reason=parts[2] if len(parts) > 2 else '')
+		except ValueError:
+			raise RtspError('Bad status line: ' + lines[0])
+	else:
+		message = RtspMessage(parts[0], parts[1], parts[2] if len(parts) > 2 else 'RTSP/1.0')
+	for line in lines[1:]:
+		name, sep, value = line.partition(':')
+		if not sep:
+			raise RtspError('Bad header line: ' + line)
+		message.headers[name.strip().lower()] = value.strip()
+	return message
+
+def parseTransport(value):
+	"""Return the parameters of a Transport header as a dict, such as {'protocol': 'RTP/AVP', 'client_port': '26000'}.
+
+	Parameters without a value, such as unicast or multicast, map to True.
+	"""
+	params = {}
+	for i, part in enumerate(value.split(';')):
+		name, sep, paramValue = part.partition('=')
+		name = name.strip()
+		if i == 0 and not sep:
+			params['protocol'] = name
+		elif name:
+			params[name.lower()] = paramValue.strip() if sep else True
+	return params
+
+def parseRangePair(value):
+	"""Return the first and second numbers of a Transport range such as '26000-26001'. The second may be None."""
+	first, _, second = value.partition('-')
+	return int(first), int(second) if second else None
+
+def formatMessage(first, headers, body=b''):
+	"""Return a message as bytes. headers is a sequence of (name, value) pairs."""
+	lines = [first] + ['%s: %s' % (name, value) for name, value in headers]
+	if body:
+		lines.append('Content-Length: %d' % len(body))
+	return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body
+
+def formatRequest(method, uri, cseq, headers=(), body=b''):
+	"""Return an RTSP request as bytes."""
+	return formatMessage('%s %s RTSP/1.0' % (method, uri), [('CSeq', cseq)] + list(headers), body)
+
+def formatReply(code, reason, cseq, headers=(), body=b''):
+	"""Return an RTSP reply as bytes."""
+	return formatMessage('RTSP/1.0 %d %s' % (code, reason), [('CSeq', cseq)] + list(headers), body)
+
+def interleavedHeader(channel, length):
+	"""Return the 4 byte header that frames length bytes of data on an interleaved channel."""
+	return INTERLEAVED_HEADER.pack(b'$', channel, length)
@@ -0,0 +1,100 @@
+"""
+One pacing thread for the RTP sends of every session. Streams are kept in a heap ordered by their next absolute deadline,
+so read and send time never accumulates as drift, and every stream that is due in the same tick is sent in one batch
+after a single wakeup.
+"""
+import heapq, itertools, logging, threading, time
+
+MAX_BEHIND = 5 # A stream that falls more than this many periods behind skips ahead instead of bursting to catch up
+log = logging.getLogger('Scheduler')
+
+class PacedStream:
+	def __init__(self, streamId, callback, period, deadline):
+		self.streamId = streamId
+		self.callback = callback
+		self.period = period
+		self.deadline = deadline
+		self.active = True
+		self.lateness = 0.0 # Seconds between the deadline and the send of the last frame
+
+class PacingScheduler:
+	def __init__(self):
+		self.heap = []
+		self.streams = {}
+		self.ids = itertools.count(1)
+		self.cond = threading.Condition()
+		self.thread = None
+		self.wakeups = 0
+		self.batches = 0 # Wakeups that found a stream due
+		self.skipped = 0 # Frame periods dropped by streams that fell more than MAX_BEHIND behind
+
+	def add(self, callback, period, delay=0.0):
+		"""Call callback() every period seconds, first after delay, until it returns False. Return the stream id."""
+		with self.cond:
+			stream = PacedStream(next(self.ids), callback, period, time.monotonic() + delay)
+			self.streams[stream.streamId] = stream
+			heapq.heappush(self.heap, (stream.deadline, stream.streamId))
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, name='PacingScheduler', daemon=True)
+				self.thread.start()
+			self.cond.notify()
+			return stream.streamId
+
+	def remove(self, streamId):
+		"""Stop a stream. Its heap entry is dropped lazily when it comes due."""
+		with self.cond:
+			stream = self.streams.pop(streamId, None)
+			if stream:
+				stream.active = False
+
+	def get(self, streamId):
+		"""Return the PacedStream for an id, or None once it has stopped."""
+		return self.streams.get(streamId)
+
+	def activeCount(self):
+		"""Return the number of scheduled streams."""
+		return len(self.streams)
+
+	def run(self):
+		"""Sleep until the earliest deadline, then send every stream that is due."""
+		while True:
+			with self.cond:
+				while not self.heap or self.heap[0][0] > time.monotonic():
+					self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+				self.wakeups += 1
+				now = time.monotonic()
+				due = []
+				while self.heap and self.heap[0][0] <= now:
+					_, streamId = heapq.heappop(self.heap)
+					stream = self.streams.get(streamId)
+					if stream:
+						due.append(stream)
+			if due:
+				self.batches += 1
+			for stream in due:
+				self.fire(stream)
+
+	def fire(self, stream):
+		"""Send one frame of a stream and schedule its next absolute deadline."""
+		stream.lateness = time.monotonic() - stream.deadline
+		try:
+			keepGoing = stream.callback() is not False
+		except Exception:
+			log.exception('Stream %s failed', stream.streamId)
+			keepGoing = False
+		with self.cond:
+			if not stream.active:
+				return
+			if not keepGoing:
+				self.streams.pop(stream.streamId, None)
+				stream.active = False
+				return
+			stream.deadline += stream.period
+			behind = time.monotonic() - stream.deadline
+			if behind > MAX_BEHIND * stream.period:
+				skip = int(behind / stream.period)
+				stream.deadline += skip * stream.period
+				self.skipped += skip
+			heapq.heappush(self.heap, (stream.deadline, stream.streamId))
+
+pacer = PacingScheduler()
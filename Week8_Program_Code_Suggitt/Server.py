@@ -1,6 +1,8 @@
-import sys, socket
+import sys, os, socket, logging
 
 from ServerWorker import ServerWorker
+from Metrics import startServer
+from SessionManager import SessionManager
 
 class Server:	
 	
@@ -9,6 +11,12 @@ class Server:
 			SERVER_PORT = int(sys.argv[1])
 		except:
 			print("[Usage: Server.py Server_port]\n")
+		# LOG_LEVEL=DEBUG shows every request, WARNING leaves only errors
+		logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+		startServer()
+		# Expires sessions whose clients stopped sending requests or RTCP reports
+		manager = SessionManager()
+		manager.start()
 		rtspSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		rtspSocket.bind(('', SERVER_PORT))
 		rtspSocket.listen(5)        
@@ -17,7 +25,7 @@ class Server:
 		while True:
 			clientInfo = {}
 			clientInfo['rtspSocket'] = rtspSocket.accept()
-			ServerWorker(clientInfo).run()		
+			ServerWorker(clientInfo, manager).run()		
 
 if __name__ == "__main__":
 	(Server()).main()
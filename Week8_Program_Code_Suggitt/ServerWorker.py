@@ -1,14 +1,30 @@
 from random import randint
-import sys, traceback, threading, socket
+import threading, socket, time, logging
 
-from VideoStream import VideoStream
-from RtpPacket import RtpPacket
+from VideoStream import VideoStream, FRAME_PERIOD, parseRange
+from RtpPacket import HEADER_SIZE, packHeader
+from RtpJpeg import fragmentFrameViews, frameTimestamp
+from RtpSender import RtpSender, InterleavedSender
+from Scheduler import pacer
+from Rtcp import SenderStats, getChannel, RTCP_INTERVAL
+from LiveChannel import isLive, openChannel, closeChannel
+from PacketStream import PacketStream, isPacketized
+from FrameThinner import FrameThinner
+from RtspParser import RtspParser, RtspError, Interleaved, formatReply, parseRangePair
+from Metrics import SessionMetrics, responseTime
+
+log = logging.getLogger('ServerWorker')
+
+CLOSE_DRAIN_SECONDS = 1.0 # How long a closing connection waits for its last replies to be taken by a slow client
 
 class ServerWorker:
 	SETUP = 'SETUP'
 	PLAY = 'PLAY'
 	PAUSE = 'PAUSE'
 	TEARDOWN = 'TEARDOWN'
+	OPTIONS = 'OPTIONS'
+	GET_PARAMETER = 'GET_PARAMETER'
+	METHODS = (OPTIONS, SETUP, PLAY, PAUSE, TEARDOWN, GET_PARAMETER)
 	
 	INIT = 0
 	READY = 1
@@ -18,144 +34,429 @@ class ServerWorker:
 	OK_200 = 0
 	FILE_NOT_FOUND_404 = 1
 	CON_ERR_500 = 2
+	BAD_REQUEST_400 = 3
+	UNSUPPORTED_TRANSPORT_461 = 4
+	NOT_IMPLEMENTED_501 = 5
+	METHOD_NOT_VALID_455 = 6
+	
+	REPLIES = {
+		OK_200: (200, 'OK'),
+		FILE_NOT_FOUND_404: (404, 'Not Found'),
+		CON_ERR_500: (500, 'Internal Server Error'),
+		BAD_REQUEST_400: (400, 'Bad Request'),
+		UNSUPPORTED_TRANSPORT_461: (461, 'Unsupported Transport'),
+		NOT_IMPLEMENTED_501: (501, 'Not Implemented'),
+		METHOD_NOT_VALID_455: (455, 'Method Not Valid in This State'),
+	}
 	
 	clientInfo = {}
 	
-	def __init__(self, clientInfo):
+	def __init__(self, clientInfo, manager=None):
 		self.clientInfo = clientInfo
+		self.state = self.INIT
+		self.manager = manager
+		# Held while a request is processed, a frame is sent or the session is closed, whichever thread does it
+		self.lock = threading.RLock()
+		self.closed = False
+		self.lastRequest = time.monotonic()
+		# Replies, and RTP when the client asks for interleaved transport, share the RTSP connection
+		self.clientInfo['rtspSender'] = InterleavedSender(clientInfo['rtspSocket'][0])
 		
 	def run(self):
+		if self.manager:
+			self.manager.add(self)
 		threading.Thread(target=self.recvRtspRequest).start()
 	
 	def recvRtspRequest(self):
-		"""Receive RTSP request from the client."""
+		"""Receive RTSP requests from the client until it disconnects. Pipelined requests are processed in order."""
+		connSocket = self.clientInfo['rtspSocket'][0]
+		parser = RtspParser()
+		try:
+			while not self.closed:
+				try:
+					data = connSocket.recv(4096)
+				except OSError:
+					break
+				if not data:
+					break # The client closed the connection
+				try:
+					items = parser.feed(data)
+				except RtspError:
+					self.replyRtsp(self.BAD_REQUEST_400, '0')
+					break
+				for item in items:
+					if isinstance(item, Interleaved):
+						# RTCP receiver reports from a client using interleaved transport
+						getChannel().handle(item.data, time.time())
+					elif not self.closed:
+						log.debug("Data received:\n%s", item)
+						start = time.perf_counter()
+						self.processRtspRequest(item)
+						responseTime(item.method).observe(time.perf_counter() - start)
+						if item.method == self.TEARDOWN:
+							return # The connection ends with the session
+				# Wait for the replies without holding any lock, a client that stops reading only holds up this thread
+				try:
+					self.clientInfo['rtspSender'].drain()
+				except OSError:
+					break
+		finally:
+			self.close()
+	
+	def lastActivity(self):
+		"""Return the time.monotonic() of the last request, or of the last RTCP receiver report if that is later."""
+		activity = self.lastRequest
+		rtcp = self.clientInfo.get('rtcp')
+		if rtcp is not None and rtcp.lastReport is not None:
+			activity = max(activity, time.monotonic() - (time.time() - rtcp.lastReport))
+		return activity
+	
+	def hasSession(self):
+		"""Return True once SETUP has succeeded."""
+		return self.state != self.INIT
+	
+	def expire(self):
+		"""End an idle session, called by the session manager."""
+		self.close()
+	
+	def close(self):
+		"""Release the session, its RTP socket and media file, and the RTSP connection. Safe to call again."""
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+			self.stopRtp()
+			self.state = self.INIT
+			if 'rtcp' in self.clientInfo:
+				getChannel().unregister(self.clientInfo['ssrc'])
+				log.info("RTCP stats: %s", self.clientInfo['rtcp'].stats())
+				log.info("Thinning: %s", self.clientInfo['thinner'].stats())
+			if 'metrics' in self.clientInfo:
+				self.clientInfo.pop('metrics').close()
+			if 'rtpSocket' in self.clientInfo:
+				self.clientInfo.pop('rtpSocket').close()
+			if 'videoStream' in self.clientInfo:
+				self.clientInfo.pop('videoStream').close()
+			if 'live' in self.clientInfo:
+				closeChannel(self.clientInfo.pop('live'))
+		if self.manager:
+			self.manager.remove(self)
+		try:
+			self.clientInfo['rtspSender'].drain(CLOSE_DRAIN_SECONDS)
+		except OSError:
+			pass
+		# Shutting down first wakes up the receiving thread if another thread is closing
 		connSocket = self.clientInfo['rtspSocket'][0]
-		while True:            
-			data = connSocket.recv(256)
-			if data:
-				print("Data received:\n" + data.decode("utf-8"))
-				self.processRtspRequest(data.decode("utf-8"))
+		try:
+			connSocket.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		connSocket.close()
 	
-	def processRtspRequest(self, data):
-		"""Process RTSP request sent from the client."""
+	def processRtspRequest(self, request):
+		"""Process an RTSP request (an RtspMessage) sent from the client."""
+		with self.lock:
+			self.lastRequest = time.monotonic()
+			self.handleRequest(request)
+	
+	def handleRequest(self, request):
+		"""Process one request. Called with the lock held."""
 		# Get the request type
-		request = data.split('\n')
-		line1 = request[0].split(' ')
-		requestType = line1[0]
+		requestType = request.method
 		
 		# Get the media file name
-		filename = line1[1]
+		filename = request.uri
 		
 		# Get the RTSP sequence number 
-		seq = request[1].split(' ')
+		seq = request.cseq()
 		
 		# Process SETUP request
 		if requestType == self.SETUP:
 			if self.state == self.INIT:
 				# Update state
-				print("processing SETUP\n")
+				log.info("processing SETUP")
+				
+				# Get the RTP/UDP port, or the channel for RTP interleaved on this connection
+				transport = request.transport()
+				try:
+					if 'interleaved' in transport:
+						self.clientInfo['interleaved'] = parseRangePair(transport['interleaved'])[0]
+						self.clientInfo['rtspSender'].channel = self.clientInfo['interleaved']
+						self.clientInfo['rtpPort'] = 0
+					else:
+						self.clientInfo['rtpPort'] = parseRangePair(transport.get('client_port', ''))[0]
+				except ValueError:
+					self.replyRtsp(self.BAD_REQUEST_400, seq)
+					return
+				self.clientInfo['multicast'] = 'multicast' in transport
+				if isLive(filename) and 'interleaved' in transport:
+					self.replyRtsp(self.UNSUPPORTED_TRANSPORT_461, seq)
+					return
 				
 				try:
-					self.clientInfo['videoStream'] = VideoStream(filename)
+					if isLive(filename):
+						# Subscribe to the shared live feed instead of reading the file for this session alone
+						self.clientInfo['live'] = openChannel(filename)
+					elif isPacketized(filename):
+						# Ready-made RTP packets, only the header fields of the session are patched in
+						self.clientInfo['videoStream'] = PacketStream(filename)
+					else:
+						self.clientInfo['videoStream'] = VideoStream(filename)
 					self.state = self.READY
 				except IOError:
-					self.replyRtsp(self.FILE_NOT_FOUND_404, seq[1])
+					self.replyRtsp(self.FILE_NOT_FOUND_404, seq)
+					return
 				
 				# Generate a randomized RTSP session ID
 				self.clientInfo['session'] = randint(100000, 999999)
 				
-				# Send RTSP reply
-				self.replyRtsp(self.OK_200, seq[1])
+				# RTP sequence numbers count packets, starting from a random value
+				self.clientInfo['rtpSeq'] = randint(0, 0xffff)
+				
+				# Random SSRC identifying the stream in RTP and RTCP
+				self.clientInfo['ssrc'] = randint(0, 0xffffffff)
+				self.clientInfo['rtcp'] = SenderStats(self.clientInfo['ssrc'])
+				self.clientInfo['thinner'] = FrameThinner(self.clientInfo['rtcp'])
+				self.clientInfo['metrics'] = SessionMetrics(self.clientInfo['session'])
 				
-				# Get the RTP/UDP port from the last line
-				self.clientInfo['rtpPort'] = request[2].split(' ')[3]
+				# Send RTSP reply
+				if 'interleaved' in self.clientInfo:
+					channel = self.clientInfo['interleaved']
+					transportReply = 'RTP/AVP/TCP;interleaved=%d-%d' % (channel, channel + 1)
+					self.replyRtsp(self.OK_200, seq, [('Transport', transportReply)])
+				else:
+					self.replyRtsp(self.OK_200, seq)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
 		# Process PLAY request 		
 		elif requestType == self.PLAY:
 			if self.state == self.READY:
-				print("processing PLAY\n")
+				log.info("processing PLAY")
 				self.state = self.PLAYING
 				
-				# Create a new socket for RTP/UDP
-				self.clientInfo["rtpSocket"] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+				if 'live' in self.clientInfo:
+					self.playLive(seq)
+					return
+				
+				# A PLAY pipelined right behind its SETUP carries no Session header, it applies to this connection's
+				# session
+				# Seek to the start of the requested Range, if any
+				videoStream = self.clientInfo['videoStream']
+				start = self.getRangeStart(request)
+				if start is not None:
+					videoStream.seekTime(start)
+				
+				if 'interleaved' in self.clientInfo:
+					# Send RTP over the RTSP connection
+					self.clientInfo['rtpSender'] = self.clientInfo['rtspSender']
+				elif 'rtpSocket' not in self.clientInfo:
+					# Create a new socket for RTP/UDP
+					self.clientInfo["rtpSocket"] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+					self.clientInfo['rtpSender'] = RtpSender(self.clientInfo['rtpSocket'])
 				
-				self.replyRtsp(self.OK_200, seq[1])
+				playRange = 'npt=%.3f-%.3f' % (videoStream.position(), videoStream.duration())
+				self.replyRtsp(self.OK_200, seq, [('Range', playRange)])
 				
-				# Create a new thread and start sending RTP packets
-				self.clientInfo['event'] = threading.Event()
-				self.clientInfo['worker']= threading.Thread(target=self.sendRtp) 
-				self.clientInfo['worker'].start()
+				# Let the shared pacing scheduler send the frames, faster or slower when a Speed is requested. The first
+				# frame goes out at once, every frame being a JPEG keyframe, rather than a period after the reply
+				period = FRAME_PERIOD / self.getSpeed(request)
+				self.clientInfo['stream'] = pacer.add(self.sendRtp, period)
+				
+				# Send RTCP sender reports and take in receiver reports about this session
+				getChannel().register(self.clientInfo['rtcp'])
+				self.clientInfo['rtcpStream'] = pacer.add(self.sendRtcp, RTCP_INTERVAL, period)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
 		# Process PAUSE request
 		elif requestType == self.PAUSE:
 			if self.state == self.PLAYING:
-				print("processing PAUSE\n")
+				log.info("processing PAUSE")
 				self.state = self.READY
 				
-				self.clientInfo['event'].set()
+				self.stopRtp()
 			
-				self.replyRtsp(self.OK_200, seq[1])
+				self.replyRtsp(self.OK_200, seq)
+			else:
+				self.replyRtsp(self.METHOD_NOT_VALID_455, seq)
 		
 		# Process TEARDOWN request
 		elif requestType == self.TEARDOWN:
-			print("processing TEARDOWN\n")
+			log.info("processing TEARDOWN")
 
-			self.clientInfo['event'].set()
+			self.stopRtp()
 			
-			self.replyRtsp(self.OK_200, seq[1])
+			self.replyRtsp(self.OK_200, seq)
 			
-			# Close the RTP socket
-			self.clientInfo['rtpSocket'].close()
+			# recvRtspRequest then releases everything and ends the connection
+		
+		# Keep-alives, they only refresh the session's activity
+		elif requestType == self.OPTIONS:
+			self.replyRtsp(self.OK_200, seq, [('Public', ', '.join(self.METHODS))])
+		elif requestType == self.GET_PARAMETER:
+			self.replyRtsp(self.OK_200, seq)
+		
+		else:
+			self.replyRtsp(self.NOT_IMPLEMENTED_501, seq)
 			
+	def playLive(self, seq):
+		"""Subscribe to the live channel, by unicast or through its multicast group."""
+		channel = self.clientInfo['live']
+		address = self.clientInfo['rtspSocket'][1][0]
+		port = int(self.clientInfo['rtpPort'])
+		if self.clientInfo['multicast']:
+			self.clientInfo['subscriber'], group = channel.subscribeMulticast(port, self.clientInfo.get('paused'))
+			transportReply = 'RTP/UDP; multicast; destination=%s; port=%d' % (group, port)
+			self.replyRtsp(self.OK_200, seq, [('Transport', transportReply)])
+			return
+		self.clientInfo['subscriber'] = channel.subscribe((address, port), self.clientInfo['ssrc'],
+			self.clientInfo['rtcp'], self.clientInfo['metrics'], self.clientInfo.get('paused'))
+		self.replyRtsp(self.OK_200, seq)
+		getChannel().register(self.clientInfo['rtcp'])
+		self.clientInfo['rtcpStream'] = pacer.add(self.sendRtcp, RTCP_INTERVAL, FRAME_PERIOD)
+
+	def stopRtp(self):
+		"""Stop sending RTP packets upon PAUSE or TEARDOWN."""
+		if 'subscriber' in self.clientInfo:
+			# Kept so a later PLAY continues the same sequence numbers
+			self.clientInfo['paused'] = self.clientInfo.pop('subscriber')
+			self.clientInfo['live'].unsubscribe(self.clientInfo['paused'])
+		if 'stream' in self.clientInfo:
+			pacer.remove(self.clientInfo.pop('stream'))
+		if 'rtcpStream' in self.clientInfo:
+			pacer.remove(self.clientInfo.pop('rtcpStream'))
+
 	def sendRtp(self):
-		"""Send RTP packets over UDP."""
-		while True:
-			self.clientInfo['event'].wait(0.05) 
-			
-			# Stop sending if request is PAUSE or TEARDOWN
-			if self.clientInfo['event'].isSet(): 
-				break 
-				
-			data = self.clientInfo['videoStream'].nextFrame()
-			if data: 
-				frameNumber = self.clientInfo['videoStream'].frameNbr()
-				try:
-					address = self.clientInfo['rtspSocket'][1][0]
-					port = int(self.clientInfo['rtpPort'])
-					self.clientInfo['rtpSocket'].sendto(self.makeRtp(data, frameNumber),(address,port))
-				except:
-					print("Connection Error")
-					#print('-'*60)
-					#traceback.print_exc(file=sys.stdout)
-					#print('-'*60)
-
-	def makeRtp(self, payload, frameNbr):
-		"""RTP-packetize the video data."""
+		"""Send the next frame as RTP packets over UDP. Called by the pacing scheduler, returns False at the end."""
+		with self.lock:
+			if self.closed:
+				return False
+			return self.sendFrame()
+
+	def sendFrame(self):
+		"""Send the next frame of the session's stream. Called with the lock held."""
+		videoStream = self.clientInfo['videoStream']
+		if isinstance(videoStream, PacketStream):
+			return self.sendPackets(videoStream)
+		data = videoStream.nextFrame()
+		if not data:
+			return False
+		frameNumber = videoStream.frameNbr()
+		if self.thinFrame(frameNumber):
+			return True
+		timestamp = frameTimestamp(frameNumber, FRAME_PERIOD)
+		# Send the frame as MTU-sized fragments in one batch, the marker bit flags the last one
+		payloads = fragmentFrameViews(data)
+		headers = bytearray(HEADER_SIZE * len(payloads))
+		packets = []
+		for i, payload in enumerate(payloads):
+			marker = 1 if i == len(payloads) - 1 else 0
+			packets.append(self.makeRtp(headers, i, payload, self.clientInfo['rtpSeq'], marker, timestamp))
+			self.clientInfo['rtpSeq'] = (self.clientInfo['rtpSeq'] + 1) & 0xffff
+		self.transmit(packets, len(data), timestamp)
+		return True
+
+	def sendPackets(self, packetStream):
+		"""Send the next frame of a packetized stream. Called through sendRtp, returns False at the end."""
+		frameNumber = packetStream.frameNbr() + 1
+		if frameNumber > packetStream.frameCount():
+			return False
+		if self.thinFrame(frameNumber):
+			packetStream.seek(frameNumber)
+			return True
+		packets, frameBytes, timestamp = packetStream.nextPackets(self.clientInfo['rtpSeq'], self.clientInfo['ssrc'])
+		self.clientInfo['rtpSeq'] = (self.clientInfo['rtpSeq'] + len(packets)) & 0xffff
+		self.transmit(packets, frameBytes, timestamp)
+		return True
+
+	def thinFrame(self, frameNumber):
+		"""Return True if frameNumber should be skipped because the client is congested."""
+		# A stream running a period late is a send backlog
+		thinner = self.clientInfo['thinner']
+		stream = pacer.get(self.clientInfo.get('stream'))
+		if stream and stream.lateness > stream.period:
+			thinner.onCongestion()
+		if thinner.sendFrame(frameNumber):
+			return False
+		self.clientInfo['metrics'].onThinned()
+		return True
+
+	def transmit(self, packets, frameBytes, timestamp):
+		"""Send the packets of one frame in a batch and account for them."""
+		stream = pacer.get(self.clientInfo.get('stream'))
+		try:
+			address = self.clientInfo['rtspSocket'][1][0]
+			port = int(self.clientInfo['rtpPort'])
+			sendStart = time.perf_counter()
+			sent = self.clientInfo['rtpSender'].sendBatch(packets, (address, port))
+			lateness = stream.lateness if stream else 0.0
+			self.clientInfo['metrics'].onFrame(sent, frameBytes, time.perf_counter() - sendStart, lateness)
+			self.clientInfo['thinner'].onSent(sent, len(packets))
+			self.clientInfo['rtcp'].onSend(len(packets), frameBytes, timestamp)
+		except:
+			log.warning("Connection Error", exc_info=log.isEnabledFor(logging.DEBUG))
+
+	def sendRtcp(self):
+		"""Send an RTCP sender report to the client's RTP port + 1. Called by the pacing scheduler."""
+		with self.lock:
+			if self.closed:
+				return False
+			report = self.clientInfo['rtcp'].senderReport()
+			if 'interleaved' in self.clientInfo:
+				self.clientInfo['rtpSender'].sendBatch([[report]], None, self.clientInfo['interleaved'] + 1)
+				return True
+			address = self.clientInfo['rtspSocket'][1][0]
+			port = int(self.clientInfo['rtpPort']) + 1
+			getChannel().send(report, (address, port))
+			return True
+
+	def getSpeed(self, request):
+		"""Return the playback speed of the request's Speed header, 1.0 by default."""
+		try:
+			speed = float(request.header('Speed', 1.0))
+		except ValueError:
+			return 1.0
+		return speed if speed > 0 else 1.0
+
+	def getRangeStart(self, request):
+		"""Return the start in seconds of the request's Range header, or None."""
+		value = request.header('Range')
+		if value is None:
+			return None
+		try:
+			return parseRange(value)
+		except ValueError:
+			return None
+
+	def makeRtp(self, headers, index, payload, seqnum, marker, timestamp):
+		"""RTP-packetize the video data. Return the packet as a list of buffers.
+
+		The header is packed into slot index of headers, the one header buffer shared by a batch of packets.
+		"""
 		version = 2
 		padding = 0
 		extension = 0
 		cc = 0
-		marker = 0
 		pt = 26 # MJPEG type
-		seqnum = frameNbr
-		ssrc = 0 
-		
-		rtpPacket = RtpPacket()
-		
-		rtpPacket.encode(version, padding, extension, cc, seqnum, marker, pt, ssrc, payload)
-		
-		return rtpPacket.getPacket()
-		
-	def replyRtsp(self, code, seq):
-		"""Send RTSP reply to the client."""
-		if code == self.OK_200:
-			#print("200 OK")
-			reply = 'RTSP/1.0 200 OK\nCSeq: ' + seq + '\nSession: ' + str(self.clientInfo['session'])
-			connSocket = self.clientInfo['rtspSocket'][0]
-			connSocket.send(reply.encode())
+		ssrc = self.clientInfo['ssrc']
+		offset = index * HEADER_SIZE
+
+		packHeader(headers, offset, version, padding, extension, cc, seqnum, marker, pt, timestamp, ssrc)
+
+		return [memoryview(headers)[offset:offset + HEADER_SIZE]] + payload
 		
-		# Error messages
-		elif code == self.FILE_NOT_FOUND_404:
-			print("404 NOT FOUND")
-		elif code == self.CON_ERR_500:
-			print("500 CONNECTION ERROR")
+	def replyRtsp(self, code, seq, headers=()):
+		"""Send RTSP reply to the client, with optional extra (name, value) headers."""
+		status, reason = self.REPLIES[code]
+		if code != self.OK_200:
+			log.warning("%d %s", status, reason.upper())
+		if 'session' in self.clientInfo:
+			session = str(self.clientInfo['session'])
+			if self.manager:
+				session += ';timeout=%d' % self.manager.timeout
+			headers = [('Session', session)] + list(headers)
+		try:
+			self.clientInfo['rtspSender'].write(formatReply(status, reason, seq, headers))
+		except OSError:
+			log.warning("Connection Error")
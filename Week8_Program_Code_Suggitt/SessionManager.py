@@ -0,0 +1,83 @@
+"""
+Session lifecycle for both servers. Every RTSP connection is registered here until it is closed, and one whose client
+has gone quiet for longer than the session timeout is expired: its expire() method releases the session, the media
+file and the sockets and ends the connection. Activity is any RTSP request, including the GET_PARAMETER and OPTIONS
+keep-alives, and for a playing session every RTCP receiver report. The timeout is SESSION_TIMEOUT seconds (60 by
+default) and is announced to clients in the Session header, as in "Session: 123456;timeout=60".
+
+A connection object provides lastActivity() (a time.monotonic() value), hasSession() and expire().
+"""
+import logging, os, threading, time
+
+from Metrics import registry
+
+SESSION_TIMEOUT = int(os.environ.get('SESSION_TIMEOUT', 60))
+
+log = logging.getLogger('SessionManager')
+
+class SessionManager:
+	def __init__(self, timeout=SESSION_TIMEOUT):
+		self.timeout = timeout
+		self.connections = set()
+		self.lock = threading.Lock()
+		self.opened = 0
+		self.closed = 0
+		self.expired = 0
+		self.thread = None
+		registry.callback('rtsp_connections_active', 'gauge', 'Open RTSP connections', self.connectionCount)
+		registry.callback('rtsp_sessions_live', 'gauge', 'Connections with a session set up', self.sessionCount)
+		registry.callback('rtsp_sessions_expired_total', 'counter', 'Sessions closed by the idle timeout',
+			lambda: self.expired)
+		registry.callback('rtsp_connections_opened_total', 'counter', 'RTSP connections accepted', lambda: self.opened)
+		registry.callback('rtsp_connections_closed_total', 'counter', 'RTSP connections closed', lambda: self.closed)
+
+	def add(self, connection):
+		"""Start tracking a new connection."""
+		with self.lock:
+			self.connections.add(connection)
+			self.opened += 1
+
+	def remove(self, connection):
+		"""Stop tracking a closed connection. Removing it twice is harmless."""
+		with self.lock:
+			if connection in self.connections:
+				self.connections.remove(connection)
+				self.closed += 1
+
+	def connectionCount(self):
+		"""Return the number of open connections."""
+		return len(self.connections)
+
+	def sessionCount(self):
+		"""Return the number of open connections with a session set up."""
+		with self.lock:
+			connections = list(self.connections)
+		return sum(1 for connection in connections if connection.hasSession())
+
+	def expireIdle(self, now=None):
+		"""Expire every connection idle for longer than the timeout. Return how many were expired."""
+		if now is None:
+			now = time.monotonic()
+		with self.lock:
+			idle = [connection for connection in self.connections if now - connection.lastActivity() > self.timeout]
+		for connection in idle:
+			log.info("Session timed out after %d s idle", self.timeout)
+			self.expired += 1
+			connection.expire()
+			self.remove(connection)
+		return len(idle)
+
+	def checkInterval(self):
+		"""Return how often idle connections are looked for, in seconds."""
+		return max(1.0, self.timeout / 4)
+
+	def start(self):
+		"""Expire idle connections from a background thread, for the threaded server."""
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run, name='SessionManager', daemon=True)
+			self.thread.start()
+
+	def run(self):
+		while True:
+			time.sleep(self.checkInterval())
+			self.expireIdle()
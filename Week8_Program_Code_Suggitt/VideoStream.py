@@ -1,25 +1,237 @@
+from array import array
+import os, threading
+
+from FrameCache import frameCache
+from ReadAhead import reader, READ_AHEAD
+
+FRAME_PERIOD = 0.05 # Seconds per frame, the rate the server sends at
+INDEX_EXT = ".idx"
+INDEX_HEADER = 3 # File size, file mtime and frame count ahead of the (offset, length) pairs
+READ_CHUNK = 1024 * 1024 # Most bytes the read-ahead asks for in one pread, unless a single frame is larger
+
 class VideoStream:
-	def __init__(self, filename):
+	def __init__(self, filename, cache=frameCache, readAhead=READ_AHEAD):
 		self.filename = filename
 		try:
 			self.file = open(filename, 'rb')
 		except:
 			raise IOError
 		self.frameNum = 0
-		
+		self.index = self.loadIndex()
+		# Frames are shared between sessions by file identity, so an edited file never serves stale frames
+		stat = os.fstat(self.file.fileno())
+		self.cache = cache
+		self.cacheKey = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+		# Up to readAhead upcoming frames, read by the ReadAhead thread: 0-based frame number -> data
+		self.depth = readAhead
+		self.window = {}
+		self.windowLock = threading.Lock()
+		self.ioLock = threading.Lock() # Held while the reader thread uses the file, so close() cannot pull it away
+		self.closed = False
+		if self.depth:
+			advise(self.file.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+			reader.request(self)
+
+	def loadIndex(self):
+		"""Load the frame offset index cached next to the file, building it if missing or stale."""
+		stat = os.fstat(self.file.fileno())
+		index = array('Q')
+		try:
+			with open(self.filename + INDEX_EXT, 'rb') as f:
+				index.fromfile(f, INDEX_HEADER)
+				if index[0] == stat.st_size and index[1] == stat.st_mtime_ns:
+					index.fromfile(f, 2 * index[2])
+					return index[INDEX_HEADER:]
+		except (OSError, EOFError):
+			pass
+		index = self.buildIndex()
+		try:
+			with open(self.filename + INDEX_EXT, 'wb') as f:
+				array('Q', [stat.st_size, stat.st_mtime_ns, len(index) // 2]).tofile(f)
+				index.tofile(f)
+		except OSError:
+			pass # The index is only a cache, a read-only media directory just means rebuilding it next time
+		return index
+
+	def buildIndex(self):
+		"""Scan the 5-byte length prefixes and return the (offset, length) pair of every frame."""
+		index = array('Q')
+		size = os.fstat(self.file.fileno()).st_size
+		offset = 0
+		while offset + 5 <= size:
+			self.file.seek(offset)
+			try:
+				framelength = int(self.file.read(5))
+			except ValueError:
+				break
+			if offset + 5 + framelength > size:
+				break
+			index.append(offset + 5)
+			index.append(framelength)
+			offset += 5 + framelength
+		return index
+
 	def nextFrame(self):
-		"""Get next frame."""
-		data = self.file.read(5) # Get the framelength from the first 5 bits
-		if data: 
-			framelength = int(data)
-							
-			# Read the current frame
-			data = self.file.read(framelength)
+		"""Get next frame, from the read-ahead window when it is there."""
+		data = self.nextBufferedFrame()
+		if data is not None:
+			return data
+		data = self.getFrame(self.frameNum)
+		if data:
+			self.frameNum += 1
+			if self.depth:
+				reader.misses += 1
+				reader.request(self)
+		return data
+
+	def nextBufferedFrame(self):
+		"""Get next frame if it is in the read-ahead window, otherwise return None without touching the file."""
+		with self.windowLock:
+			data = self.window.pop(self.frameNum, None)
+		if data is None:
+			return None
+		reader.hits += 1
+		if data:
 			self.frameNum += 1
+			reader.request(self)
 		return data
-		
+
+	def fill(self):
+		"""Read the frames missing from the window ahead of frameNum. Called on the ReadAhead thread."""
+		with self.windowLock:
+			start = self.frameNum
+			end = min(start + self.depth, self.frameCount())
+			for frameNbr in [n for n in self.window if not start <= n < end]:
+				del self.window[frameNbr]
+			missing = [n for n in range(start, end) if n not in self.window]
+		frames = {}
+		toRead = []
+		for frameNbr in missing:
+			data = self.cache.peek((self.cacheKey, frameNbr)) if self.cache is not None else None
+			if data is None:
+				toRead.append(frameNbr)
+			else:
+				frames[frameNbr] = data
+		if self.cache is not None:
+			self.cache.record(len(frames), len(toRead)) # Each frame once, however often it is looked up
+		with self.ioLock:
+			if self.closed:
+				return
+			for first, last in self.readRuns(toRead):
+				frames.update(self.readFrames(first, last))
+			# Let the kernel fetch the window after this one while the frames above are sent
+			if end < self.frameCount():
+				nextStart = self.index[2 * end]
+				nextEnd = min(end + self.depth, self.frameCount()) - 1
+				advise(self.file.fileno(), nextStart, self.index[2 * nextEnd] + self.index[2 * nextEnd + 1] - nextStart,
+					'POSIX_FADV_WILLNEED')
+		if self.cache is not None:
+			for frameNbr in toRead:
+				if frameNbr in frames:
+					self.cache.put((self.cacheKey, frameNbr), frames[frameNbr])
+		with self.windowLock:
+			# Frames the sender passed while they were being read are not kept
+			for frameNbr, data in frames.items():
+				if self.frameNum <= frameNbr < self.frameNum + self.depth:
+					self.window[frameNbr] = data
+
+	def readRuns(self, frameNbrs):
+		"""Group ascending frame numbers into (first, last) runs stored back to back, each at most READ_CHUNK bytes."""
+		runs = []
+		for frameNbr in frameNbrs:
+			if runs:
+				first, last = runs[-1]
+				contiguous = frameNbr == last + 1 and self.index[2 * frameNbr] == self.index[2 * last] + self.index[2 * last + 1] + 5
+				if contiguous and self.index[2 * frameNbr] + self.index[2 * frameNbr + 1] - self.index[2 * first] <= READ_CHUNK:
+					runs[-1] = (first, frameNbr)
+					continue
+			runs.append((frameNbr, frameNbr))
+		return runs
+
+	def readFrames(self, first, last):
+		"""Read frames first to last with one pread, which leaves the file position alone. Return {frame number: data}."""
+		offset = self.index[2 * first]
+		length = self.index[2 * last] + self.index[2 * last + 1] - offset
+		try:
+			buf = os.pread(self.file.fileno(), length, offset)
+		except OSError:
+			return {}
+		frames = {}
+		for frameNbr in range(first, last + 1):
+			start = self.index[2 * frameNbr] - offset
+			end = start + self.index[2 * frameNbr + 1]
+			if end > len(buf):
+				break # The file was cut short, the sending thread reads what is left
+			frames[frameNbr] = buf[start:end]
+		return frames
+
+	def getFrame(self, frameNbr):
+		"""Get the frame at a 0-based frame number, or empty bytes past the end."""
+		if not 0 <= frameNbr < self.frameCount():
+			return b''
+		if self.cache is not None:
+			data = self.cache.get((self.cacheKey, frameNbr))
+			if data is not None:
+				return data
+		self.file.seek(self.index[2 * frameNbr])
+		data = self.file.read(self.index[2 * frameNbr + 1])
+		if self.cache is not None:
+			self.cache.put((self.cacheKey, frameNbr), data)
+		return data
+
+	def seek(self, frameNbr):
+		"""Make frameNbr (0-based) the next frame returned by nextFrame."""
+		self.frameNum = max(0, min(frameNbr, self.frameCount()))
+		if self.depth:
+			reader.request(self)
+
+	def seekTime(self, seconds):
+		"""Make the frame playing at a time in seconds the next frame returned by nextFrame."""
+		self.seek(int(seconds / FRAME_PERIOD))
+
 	def frameNbr(self):
 		"""Get frame number."""
 		return self.frameNum
-	
-	
\ No newline at end of file
+
+	def frameCount(self):
+		"""Get the total number of frames."""
+		return len(self.index) // 2
+
+	def duration(self):
+		"""Get the total duration in seconds."""
+		return self.frameCount() * FRAME_PERIOD
+
+	def position(self):
+		"""Get the time in seconds of the next frame."""
+		return self.frameNum * FRAME_PERIOD
+
+	def close(self):
+		"""Close the file, waiting for a read-ahead in progress."""
+		with self.ioLock:
+			self.closed = True
+			self.file.close()
+		with self.windowLock:
+			self.window.clear()
+
+def advise(fd, offset, length, advice):
+	"""Pass an os.posix_fadvise hint such as 'POSIX_FADV_SEQUENTIAL', where the platform has it."""
+	if hasattr(os, 'posix_fadvise'):
+		try:
+			os.posix_fadvise(fd, offset, length, getattr(os, advice))
+		except OSError:
+			pass
+
+def parseRange(value):
+	"""Return the start in seconds of an RTSP 'npt=' range such as 'npt=10.5-', or None if it has no usable start."""
+	value = value.strip()
+	if not value.startswith('npt='):
+		return None
+	start = value[4:].split('-')[0].strip()
+	if start == 'now' or start == '':
+		return None
+	if ':' in start: # npt-hhmmss
+		seconds = 0.0
+		for part in start.split(':'):
+			seconds = seconds * 60 + float(part)
+		return seconds
+	return float(start)
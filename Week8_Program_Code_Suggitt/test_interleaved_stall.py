@@ -0,0 +1,106 @@
+"""
+Regression test: a client that takes RTP interleaved on its RTSP connection and stops reading must not hold up the
+pacing thread, and with it every other session on Server.py, when it sends another request.
+
+Run from this directory: python -m unittest test_interleaved_stall
+"""
+import os, socket, subprocess, sys, tempfile, time, unittest
+
+from RtspParser import RtspParser, RtspMessage, formatRequest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FRAME_BYTES = 20000
+FRAMES = 400
+
+def freePort():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def readReply(sock, parser):
+	while True:
+		data = sock.recv(65536)
+		if not data:
+			raise ConnectionError('Connection closed by the server')
+		for item in parser.feed(data):
+			if isinstance(item, RtspMessage):
+				return item
+
+class InterleavedStallTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		frame = b'\xff\xd8' + bytes(FRAME_BYTES - 4) + b'\xff\xd9'
+		with open(os.path.join(self.dir.name, 'movie.Mjpeg'), 'wb') as f:
+			for _ in range(FRAMES):
+				f.write(b'%05d' % len(frame) + frame)
+		self.port = freePort()
+		env = dict(os.environ, METRICS_PORT='0', READ_AHEAD='0', LOG_LEVEL='WARNING')
+		self.server = subprocess.Popen([sys.executable, os.path.join(HERE, 'Server.py'), str(self.port)], cwd=self.dir.name,
+			env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		self.sockets = []
+		deadline = time.monotonic() + 5
+		while True:
+			try:
+				socket.create_connection(('127.0.0.1', self.port)).close()
+				break
+			except OSError:
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(0.05)
+
+	def tearDown(self):
+		for sock in self.sockets:
+			sock.close()
+		self.server.kill()
+		self.server.wait()
+		self.dir.cleanup()
+
+	def connect(self, rcvbuf=None):
+		sock = socket.socket()
+		if rcvbuf:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+		sock.connect(('127.0.0.1', self.port))
+		sock.settimeout(5)
+		self.sockets.append(sock)
+		return sock, RtspParser()
+
+	def countPackets(self, sock, seconds):
+		count = 0
+		end = time.monotonic() + seconds
+		while time.monotonic() < end:
+			try:
+				sock.recv(65536)
+				count += 1
+			except socket.timeout:
+				pass
+		return count
+
+	def testStalledInterleavedClientDoesNotStopUdpClient(self):
+		# A UDP viewer
+		rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		rtp.bind(('127.0.0.1', 0))
+		rtp.settimeout(0.1)
+		self.sockets.append(rtp)
+		udp, udpParser = self.connect()
+		udp.sendall(formatRequest('SETUP', 'movie.Mjpeg', 1, [('Transport', 'RTP/UDP;client_port=%d' % rtp.getsockname()[1])]))
+		session = readReply(udp, udpParser).session()
+		udp.sendall(formatRequest('PLAY', 'movie.Mjpeg', 2, [('Session', session)]))
+		self.assertEqual(readReply(udp, udpParser).code, 200)
+
+		# An interleaved viewer that reads its replies, then stops reading
+		tcp, tcpParser = self.connect(rcvbuf=4096)
+		tcp.sendall(formatRequest('SETUP', 'movie.Mjpeg', 1, [('Transport', 'RTP/AVP/TCP;interleaved=0-1')]))
+		tcpSession = readReply(tcp, tcpParser).session()
+		# At several times the normal rate the socket buffers fill within the second counted below
+		tcp.sendall(formatRequest('PLAY', 'movie.Mjpeg', 2, [('Session', tcpSession), ('Speed', '8')]))
+		before = self.countPackets(rtp, 1.0)
+		self.assertGreater(before, 0)
+
+		# Its keep-alive reply cannot be sent, which must only hold up its own connection
+		tcp.sendall(formatRequest('GET_PARAMETER', 'movie.Mjpeg', 3, [('Session', tcpSession)]))
+		time.sleep(0.2)
+		after = self.countPackets(rtp, 1.0)
+		self.assertGreater(after, before // 2)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,107 @@
+"""
+Regression test: a live session that is paused and played again must keep its SSRC and carry on its RTP sequence
+numbers, or the receiver counts the jump as loss and reports it back through RTCP.
+
+Run from this directory: python -m unittest test_live_resume
+"""
+import os, socket, struct, subprocess, sys, tempfile, time, unittest
+
+from RtspParser import RtspParser, RtspMessage, formatRequest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FRAME_BYTES = 5000
+FRAMES = 100
+
+def freePort():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def readReply(sock, parser):
+	while True:
+		data = sock.recv(65536)
+		if not data:
+			raise ConnectionError('Connection closed by the server')
+		for item in parser.feed(data):
+			if isinstance(item, RtspMessage):
+				return item
+
+class LiveResumeTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		frame = b'\xff\xd8' + bytes(FRAME_BYTES - 4) + b'\xff\xd9'
+		with open(os.path.join(self.dir.name, 'movie.Mjpeg'), 'wb') as f:
+			for _ in range(FRAMES):
+				f.write(b'%05d' % len(frame) + frame)
+		self.sockets = []
+		self.server = None
+
+	def tearDown(self):
+		for sock in self.sockets:
+			sock.close()
+		if self.server:
+			self.server.kill()
+			self.server.wait()
+		self.dir.cleanup()
+
+	def startServer(self, script):
+		port = freePort()
+		env = dict(os.environ, METRICS_PORT='0', LOG_LEVEL='WARNING')
+		self.server = subprocess.Popen([sys.executable, os.path.join(HERE, script), str(port)], cwd=self.dir.name,
+			env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		deadline = time.monotonic() + 5
+		while True:
+			try:
+				return socket.create_connection(('127.0.0.1', port))
+			except OSError:
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(0.05)
+
+	def receive(self, rtp, seconds):
+		"""Return (ssrc, sequence number) of every RTP packet that arrives within seconds."""
+		packets = []
+		end = time.monotonic() + seconds
+		while time.monotonic() < end:
+			try:
+				data = rtp.recv(65536)
+			except socket.timeout:
+				continue
+			_, _, seqnum, _, ssrc = struct.unpack_from('!BBHII', data)
+			packets.append((ssrc, seqnum))
+		return packets
+
+	def checkResume(self, script):
+		rtsp = self.startServer(script)
+		rtsp.settimeout(5)
+		self.sockets.append(rtsp)
+		rtp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		rtp.bind(('127.0.0.1', 0))
+		rtp.settimeout(0.1)
+		self.sockets.append(rtp)
+		parser = RtspParser()
+		rtsp.sendall(formatRequest('SETUP', 'live/movie.Mjpeg', 1,
+			[('Transport', 'RTP/UDP;client_port=%d' % rtp.getsockname()[1])]))
+		session = readReply(rtsp, parser).session()
+		rtsp.sendall(formatRequest('PLAY', 'live/movie.Mjpeg', 2, [('Session', session)]))
+		self.assertEqual(readReply(rtsp, parser).code, 200)
+		before = self.receive(rtp, 0.5)
+		rtsp.sendall(formatRequest('PAUSE', 'live/movie.Mjpeg', 3, [('Session', session)]))
+		self.assertEqual(readReply(rtsp, parser).code, 200)
+		before += self.receive(rtp, 0.3) # A frame already being sent
+		rtsp.sendall(formatRequest('PLAY', 'live/movie.Mjpeg', 4, [('Session', session)]))
+		self.assertEqual(readReply(rtsp, parser).code, 200)
+		after = self.receive(rtp, 0.5)
+
+		self.assertTrue(before and after)
+		self.assertEqual({ssrc for ssrc, _ in before + after}, {before[0][0]})
+		self.assertEqual(after[0][1], (before[-1][1] + 1) & 0xffff)
+
+	def testThreadedServer(self):
+		self.checkResume('Server.py')
+
+	def testAsyncServer(self):
+		self.checkResume('AsyncServer.py')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,50 @@
+"""
+Round trip of RtpPacket.encode and decode, including sequence numbers above 255, whose high byte the original encode
+dropped, and a non-zero CSRC count and marker bit.
+
+Run from this directory: python -m unittest test_rtp_packet
+"""
+import unittest
+
+from RtpPacket import RtpPacket, HEADER_SIZE, packHeader
+
+class RtpPacketTest(unittest.TestCase):
+	def roundTrip(self, seqnum, marker, cc, timestamp=0x12345678, ssrc=0xdeadbeef):
+		packet = RtpPacket()
+		packet.encode(2, 0, 0, cc, seqnum, marker, 26, ssrc, b'payload', timestamp)
+		data = packet.getPacket()
+		decoded = RtpPacket()
+		decoded.decode(bytearray(data))
+		return data, decoded
+
+	def testHeaderFields(self):
+		for seqnum in (0, 0xff, 0x100, 0x1234, 0xffff):
+			for marker in (0, 1):
+				with self.subTest(seqnum=seqnum, marker=marker):
+					data, decoded = self.roundTrip(seqnum, marker, 3)
+					self.assertEqual(len(data), HEADER_SIZE + len(b'payload'))
+					self.assertEqual(data[2:4], seqnum.to_bytes(2, 'big'))
+					self.assertEqual(data[0], 2 << 6 | 3)
+					self.assertEqual(decoded.version(), 2)
+					self.assertEqual(decoded.seqNum(), seqnum)
+					self.assertEqual(decoded.marker(), marker)
+					self.assertEqual(decoded.payloadType(), 26)
+					self.assertEqual(decoded.timestamp(), 0x12345678)
+					self.assertEqual(decoded.ssrc(), 0xdeadbeef)
+					self.assertEqual(bytes(decoded.getPayload()), b'payload')
+
+	def testFieldsWrap(self):
+		_, decoded = self.roundTrip(0x10001, 1, 0, timestamp=0x100000005, ssrc=0x1ffffffff)
+		self.assertEqual(decoded.seqNum(), 1)
+		self.assertEqual(decoded.timestamp(), 5)
+		self.assertEqual(decoded.ssrc(), 0xffffffff)
+
+	def testPackHeaderMatchesEncode(self):
+		packet = RtpPacket()
+		packet.encode(2, 0, 0, 2, 0xabcd, 1, 26, 42, b'', 90000)
+		buffer = bytearray(2 * HEADER_SIZE)
+		packHeader(buffer, HEADER_SIZE, 2, 0, 0, 2, 0xabcd, 1, 26, 90000, 42)
+		self.assertEqual(bytes(buffer[HEADER_SIZE:]), bytes(packet.header))
+
+if __name__ == '__main__':
+	unittest.main()